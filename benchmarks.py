@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals, print_function
+import json
+import logging
+import timeit
+from sys import argv
+from fbchat.utils import *
+from fbchat.graphql import *
+
+"""
+
+Benchmarks for `fbchat`, run offline on generated responses shaped like the ones Facebook sends.
+Run all benchmarks with `python benchmarks.py`, or only some of them with e.g. `python benchmarks.py decode`
+
+"""
+
+# Number of messages in the generated `thread_info` responses
+sizes = [20, 200, 2000]
+
+
+def make_message(i):
+    return {
+        'message_id': 'mid.$cAAAAA{:010d}'.format(i),
+        'message_sender': {'id': str(100000000000000 + i % 7), 'email': '{}@facebook.com'.format(i % 7)},
+        'timestamp_precise': str(1510000000000 + i * 1000),
+        'unread': False,
+        'message': {'text': 'Message number {} with some text, and an emoji 😍'.format(i), 'ranges': []},
+        'sticker': None,
+        'blob_attachments': [],
+        'extensible_attachment': None,
+        'message_reactions': [{'user': {'id': str(100000000000000 + i % 3)}, 'reaction': '😍'}] if i % 5 == 0 else [],
+        'tags_list': ['source:messenger:web', 'inbox'],
+        'snippet': '',
+        '__typename': 'UserMessage',
+    }
+
+
+def make_thread_info_response(n):
+    """Returns an encoded `graphqlbatch` response with a `thread_info` query for a thread with `n` messages"""
+    response = {'q0': {'response': {'message_thread': {
+        'thread_key': {'thread_fbid': None, 'other_user_id': '100000000000001'},
+        'name': None,
+        'messages_count': n,
+        'messages': {'nodes': [make_message(i) for i in range(n)], 'page_info': {'has_previous_page': True}},
+        'all_participants': {'nodes': [{'messaging_actor': {'id': '100000000000001'}}]},
+        'customization_info': {'emoji': None, 'outgoing_bubble_color': None, 'participant_customizations': []},
+    }}}}
+    status = {'successful_results': 1, 'error_results': 0, 'skipped_results': 0}
+    return (json.dumps(response, ensure_ascii=False) + '\r\n' + json.dumps(status)).encode(facebookEncoding)
+
+
+def make_send_response(n):
+    """Returns an encoded response like the ones from `ReqUrl.SEND`, with `10 * n` actions"""
+    payload = {'__ar': 1, 'payload': {'actions': [{'message_id': 'mid.$cAAAAA{:010d}'.format(i), 'thread_fbid': None, 'timestamp': 1510000000000 + i} for i in range(n * 10)]}}
+    return ('for (;;);' + json.dumps(payload)).encode(facebookEncoding)
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print('  {:<36} {:>10.3f} ms'.format(name, seconds * 1000))
+
+
+def bench_decode():
+    """Decoding with `json` responses with `check_content` and `graphql_response_to_json`, compared to slicing the decoded response first"""
+    set_json_backend('json')
+    for n in sizes:
+        number = max(1, 2000 // n)
+
+        content = make_send_response(n)
+        print('send response, {} KB:'.format(len(content) // 1024))
+        bench('slice, then json.loads', lambda: json.loads(strip_to_json(get_decoded(content))), number)
+        bench('check_content', lambda: check_content(get_decoded(content)), number)
+
+        content = make_thread_info_response(n)
+        print('thread_info response with {} messages, {} KB:'.format(n, len(content) // 1024))
+        bench('slice, then json.loads', lambda: json.loads(strip_to_json(get_decoded(content)), cls=ConcatJSONDecoder), number)
+        bench('graphql_response_to_json', lambda: graphql_response_to_json(get_decoded(content)), number)
+    set_json_backend()
+
+
+def bench_backends():
+    """Decoding and encoding with each installed JSON backend, see `set_json_backend`"""
+    backends = []
+    for backend in JSON_BACKENDS:
+        try:
+            set_json_backend(backend)
+            backends.append(backend)
+        except FBchatUserError:
+            print('  {} is not installed'.format(backend))
+    for n in sizes:
+        number = max(1, 2000 // n)
+        send_response = make_send_response(n)
+        thread_info_response = make_thread_info_response(n)
+        queries = [GraphQL(doc_id='1386147188135407', params={'id': str(i), 'message_limit': n, 'load_messages': True}) for i in range(50)]
+        print('{} KB send response, {} KB thread_info response:'.format(len(send_response) // 1024, len(thread_info_response) // 1024))
+        for backend in backends:
+            set_json_backend(backend)
+            bench('{} check_content'.format(backend), lambda: check_content(send_response), number)
+            bench('{} graphql_response_to_json'.format(backend), lambda: graphql_response_to_json(thread_info_response), number)
+            bench('{} graphql_queries_to_json'.format(backend), lambda: graphql_queries_to_json(*queries), 100)
+    set_json_backend()
+
+
+def bench_stream():
+    """Time until the first result of a `graphqlbatch` response with 20 queries is available, when it arrives in chunks of 8 KB"""
+    for n in sizes:
+        number = max(1, 2000 // n)
+        content = b'\r\n'.join(make_thread_info_response(n).replace(b'"q0"', '"q{}"'.format(i).encode('ascii')).split(b'\r\n')[0] for i in range(20))
+        content += b'\r\n{"successful_results":20,"error_results":0,"skipped_results":0}'
+        chunks = [content[i:i+8192] for i in range(0, len(content), 8192)]
+        print('20 thread_info results with {} messages each, {} KB:'.format(n, len(content) // 1024))
+        bench('graphql_response_to_json', lambda: graphql_response_to_json(b''.join(chunks)), number)
+        bench('iter_graphql_response, first', lambda: next(iter_graphql_response(chunks)), number)
+        bench('iter_graphql_response, all', lambda: list(iter_graphql_response(chunks)), number)
+
+
+def bench_queries():
+    """Encoding `graphqlbatch` queries with `graphql_queries_to_json`, compared to encoding the whole queries every time"""
+    for name, query in [('SEARCH_USER', GraphQL.SEARCH_USER), ('SEARCH_THREAD', GraphQL.SEARCH_THREAD)]:
+        params = {'search': 'Mark', 'limit': 10}
+        old = json.dumps({'q0': {'priority': 0, 'q': query, 'query_params': params}})
+        new = graphql_queries_to_json(GraphQL(query=query, params=params))
+        print('{}, {} bytes before, {} bytes now:'.format(name, len(old), len(new)))
+        bench('json.dumps', lambda: json.dumps({'q0': {'priority': 0, 'q': query, 'query_params': params}}), 10000)
+        bench('graphql_queries_to_json', lambda: graphql_queries_to_json(GraphQL(query=query, params=params)), 10000)
+
+
+def bench_messages():
+    """Converting the messages of a `thread_info` response with `graphql_to_message`, `graphql_to_messages` (with and without a projection) and `LazyMessage`"""
+    for n in sizes:
+        number = max(1, 2000 // n)
+        nodes = graphql_response_to_json(make_thread_info_response(n))[0]['message_thread']['messages']['nodes']
+        print('{} messages:'.format(n))
+        bench('graphql_to_message', lambda: [graphql_to_message(message) for message in nodes], number)
+        bench('graphql_to_messages', lambda: graphql_to_messages(nodes), number)
+        bench('graphql_to_messages, Projection.TEXT', lambda: graphql_to_messages(nodes, projection=Projection.TEXT), number)
+        bench('LazyMessage, reading uid and text', lambda: [(m.uid, m.text) for m in (LazyMessage(message) for message in nodes)], number)
+
+
+benchmarks = {
+    'decode': bench_decode,
+    'backends': bench_backends,
+    'stream': bench_stream,
+    'queries': bench_queries,
+    'messages': bench_messages,
+}
+
+if __name__ == '__main__':
+    log.setLevel(logging.WARNING)
+    for name in argv[1:] or sorted(benchmarks):
+        print('Running {}: {}'.format(name, benchmarks[name].__doc__))
+        benchmarks[name]()
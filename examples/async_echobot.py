@@ -0,0 +1,19 @@
+# -*- coding: UTF-8 -*-
+
+import asyncio
+from fbchat import log, AsyncClient
+
+# Subclass fbchat.AsyncClient and override required methods
+class EchoBot(AsyncClient):
+    def onMessage(self, author_id, message_object, thread_id, thread_type, **kwargs):
+        log.info("{} from {} in {}".format(message_object, thread_id, thread_type.name))
+
+        # If you're not the author, echo. The events are regular functions, so the reply is scheduled on the event loop
+        if author_id != self.uid:
+            asyncio.ensure_future(self.send(message_object, thread_id=thread_id, thread_type=thread_type))
+
+async def main():
+    async with EchoBot("<email>", "<password>") as client:
+        await client.listen()
+
+asyncio.get_event_loop().run_until_complete(main())
@@ -2,8 +2,12 @@
 
 from __future__ import unicode_literals
 from datetime import datetime
+import sys
 from .client import *
 
+if sys.version_info >= (3, 5):
+    from .async_client import AsyncClient
+
 
 """
     fbchat
@@ -27,3 +31,6 @@ __description__ = 'Facebook Chat (Messenger) for Python'
 __all__ = [
     'Client',
 ]
+
+if sys.version_info >= (3, 5):
+    __all__.append('AsyncClient')
@@ -0,0 +1,1073 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import asyncio
+import collections
+import functools
+import inspect
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+from .client import *
+from .client import _labeled, _label_methods
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from contextvars import ContextVar
+    # The outermost public method running in the current task, see `AsyncClient._getCaller`. Requests sent on Python 3.6 and older are labeled as 'unknown'
+    _caller = ContextVar('caller', default='unknown')
+except ImportError:
+    _caller = None
+
+
+def _encode_payload(payload):
+    """Mimics how `requests` encodes a payload. Values that are `None` are left out"""
+    return [(k, str(v)) for k, v in payload.items() if v is not None]
+
+def _payload_size(data):
+    """Returns the size of an encoded payload. The size of multipart data is unknown before it's sent, and counted as 0"""
+    if isinstance(data, list):
+        return len(urlencode(data))
+    return 0
+
+def check_async_request(r, content, as_json=True, decode=True):
+    """See :func:`utils.check_request`"""
+    if not r.ok:
+        raise FBchatFacebookError('Error when sending request: Got {} response'.format(r.status), request_status_code=r.status)
+
+    return check_content(content if as_json or not decode else get_decoded(content), as_json=as_json)
+
+
+class _AsyncBatch(object):
+    def __init__(self):
+        self.queries = []
+        # Set when the batch is full, and should be sent right away
+        self.full = asyncio.Event()
+        self.task = None
+
+
+class AsyncGraphQLBatcher(object):
+    """
+    Merges GraphQL queries from different coroutines into one `graphqlbatch` request, see :class:`GraphQLBatcher`.
+    The batches are sent by separate tasks, so cancelling a caller doesn't affect the other queries in its batch
+    """
+
+    def __init__(self, send, window=0.01, max_size=50):
+        """
+        :param send: A coroutine function that sends a list of queries in one request, and returns partial results, like :func:`AsyncClient.graphql_requests_partial`
+        :param window: How many seconds the first query of a batch waits for other queries
+        :param max_size: The maximum number of queries in one batch
+        """
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self._batch = None
+        #: Number of queries that have been requested
+        self.queries = 0
+        #: Number of batches that have been sent
+        self.batches = 0
+
+    async def request(self, query):
+        """
+        Adds `query` to a batch, and returns its result when the batch has been sent
+
+        :raises: FBchatException if request failed
+        """
+        self.queries += 1
+        batch = self._batch
+        if batch is None:
+            batch = self._batch = _AsyncBatch()
+            batch.task = asyncio.ensure_future(self._flush(batch))
+        index = len(batch.queries)
+        batch.queries.append(query)
+        if len(batch.queries) >= self.max_size:
+            self._batch = None
+            batch.full.set()
+
+        return get_batch_result(await asyncio.shield(batch.task), index)
+
+    async def _flush(self, batch):
+        try:
+            await asyncio.wait_for(batch.full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        if self._batch is batch:
+            self._batch = None
+        self.batches += 1
+        return await self.send(*batch.queries)
+
+
+class _GraphQLResultIterator(object):
+    """
+    Streams the results of a `graphqlbatch` request, see :func:`AsyncClient.iter_graphql_requests`.
+    The connection is held until every result has been read, or until :func:`aclose` is called
+    """
+
+    def __init__(self, client, payload):
+        self._client = client
+        self._payload = payload
+        self._url = client.req_url.GRAPHQL
+        # The iterator is created by the public method, so that's where the metrics are labeled
+        self._labels = client._getLabels(self._url)
+        self._r = None
+        self._started = False
+        self._done = False
+        self._results = collections.deque()
+        self._size = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Releases the connection, if the caller stops iterating before the end"""
+        self._started = True
+        self._done = True
+        self._results.clear()
+        self._release()
+
+    async def __anext__(self):
+        if not self._started:
+            self._started = True
+            await self._client._retry(self._url, self._open, method='POST')
+        try:
+            while not self._results and not self._done:
+                await self._read()
+        except Exception:
+            self._release()
+            raise
+        if not self._results:
+            raise StopAsyncIteration
+        return self._results.popleft()
+
+    async def _open(self):
+        data = self._client._generatePayload(self._payload)
+        self._r, _ = await self._client._request('POST', self._url, headers=self._client._header, data=_encode_payload(data), timeout=30, stream=True, labels=self._labels)
+        self._decoder = GraphQLResponseDecoder()
+        self._results.clear()
+        self._done = False
+        self._size = 0
+        try:
+            if not self._r.ok:
+                raise FBchatFacebookError('Error when sending request: Got {} response'.format(self._r.status), request_status_code=self._r.status)
+            # Reads until the first result, so errors like an expired session are retried
+            while not self._results and not self._done:
+                await self._read()
+        except Exception:
+            self._release()
+            raise
+
+    async def _read(self):
+        chunk = await self._r.content.readany()
+        if chunk:
+            self._size += len(chunk)
+            self._results.extend(self._decoder.feed(chunk))
+        else:
+            self._done = True
+            self._release()
+            self._results.extend(self._decoder.close())
+
+    def _release(self):
+        if self._r is not None:
+            self._r.release()
+            self._r = None
+            self._client.metrics.inc('fbchat_response_bytes_total', self._size, **self._labels)
+
+
+class _PrefetchIterator(object):
+    """
+    Yields the items of pages fetched by a background task, see :func:`Client._iterPrefetched` and :func:`AsyncClient.iterThreads`.
+    If `reverse` is set, every page is fetched before the items are yielded, in reverse order
+    """
+
+    def __init__(self, fetch_page, cursor, prefetch, reverse=False):
+        self._fetch_page = fetch_page
+        self._cursor = cursor
+        self._prefetch = prefetch
+        self._reverse = reverse
+        self._pages = asyncio.Queue(max(prefetch, 1))
+        self._task = None
+        self._items = collections.deque()
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def __anext__(self):
+        if self._reverse:
+            self._reverse = False
+            items = []
+            page = await self._nextPage()
+            while page is not None:
+                items.extend(page)
+                page = await self._nextPage()
+            self._items.extend(reversed(items))
+        while not self._items:
+            page = await self._nextPage()
+            if page is None:
+                raise StopAsyncIteration
+            self._items.extend(page)
+        return self._items.popleft()
+
+    async def _nextPage(self):
+        """Returns the next page, or `None` after the last one"""
+        if self._done:
+            return None
+        if self._prefetch < 1:
+            items, self._cursor = await self._fetch_page(self._cursor)
+            self._done = self._cursor is None
+            return items
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._produce())
+        kind, value = await self._pages.get()
+        if kind == 'page':
+            return value
+        self._done = True
+        if kind == 'error':
+            raise value
+        return None
+
+    async def _produce(self):
+        cursor = self._cursor
+        try:
+            while True:
+                items, cursor = await self._fetch_page(cursor)
+                await self._pages.put(('page', items))
+                if cursor is None:
+                    break
+            await self._pages.put(('done', None))
+        except Exception as e:
+            await self._pages.put(('error', e))
+
+    async def aclose(self):
+        """Stops fetching pages, if the caller stops iterating before the end"""
+        self._done = True
+        self._items.clear()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+
+class AsyncClient(Client):
+    """An asyncio version of :class:`Client`, where every request to Facebook is sent through one shared `aiohttp` session.
+
+    All methods that send requests are coroutines, and have the same arguments and return values as in :class:`Client`.
+    Logging in is still done with blocking requests while the client is initialized, after which
+    the session cookies are shared with the `aiohttp` session.
+    The events (`onMessage` and so on) are still regular functions.
+
+    `aiohttp` can't size the connection pool per host, so the largest value in `pool_sizes` is used as the
+    maximum number of concurrent connections to every host, and requests always wait for a free connection.
+
+    Requires `aiohttp`, which can be installed with ``pip install fbchat[async]``
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Initializes and logs in the client. Takes the same arguments as :class:`Client`
+
+        :raises: FBchatUserError if `aiohttp` is not installed
+        :raises: FBchatException on failed login
+        """
+        if aiohttp is None:
+            raise FBchatUserError('AsyncClient requires aiohttp. Install it with `pip install fbchat[async]`')
+        self._async_session = None
+        self._cookies_synced = False
+        self._async_repair_lock = None
+        super(AsyncClient, self).__init__(*args, **kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """Closes the underlying `aiohttp` session"""
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    """
+    INTERNAL REQUEST METHODS
+    """
+
+    def _getAsyncSession(self):
+        if self._async_session is None or self._async_session.closed:
+            connector = aiohttp.TCPConnector(limit=sum(self.pool_sizes.values()), limit_per_host=max(self.pool_sizes.values()))
+            self._async_session = aiohttp.ClientSession(connector=connector)
+            self._cookies_synced = False
+        if not self._cookies_synced:
+            self._syncCookies()
+        return self._async_session
+
+    def _syncCookies(self):
+        """Copies the cookies from the `requests` session (used while logging in) to the `aiohttp` session"""
+        cookies = SimpleCookie()
+        for cookie in self._session.cookies:
+            cookies[cookie.name] = cookie.value
+            cookies[cookie.name]['domain'] = cookie.domain
+            cookies[cookie.name]['path'] = cookie.path
+        self._async_session.cookie_jar.update_cookies(cookies)
+        self._cookies_synced = True
+
+    async def _request(self, method, url, timeout=30, stream=False, labels=None, endpoint=None, **kwargs):
+        """
+        Sends a request, and returns the response and its body.
+        If `stream` is `True`, the body is not read (`None` is returned instead), and the response has to be released afterwards.
+        The request is rate limited and labeled by `endpoint`, or by `url` if it isn't set
+        """
+        endpoint = endpoint or url
+        delay = self.rate_limiter.reserve(endpoint)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if labels is None:
+            labels = self._getLabels(endpoint)
+        start = time.time()
+        session = self._getAsyncSession()
+        content = None
+        try:
+            r = await session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs)
+            if not stream:
+                try:
+                    # The body has to be read before the connection is released
+                    content = await r.read()
+                finally:
+                    r.release()
+        except Exception:
+            self.metrics.inc('fbchat_requests_total', status='error', **labels)
+            raise
+        finally:
+            self.metrics.observe('fbchat_request_duration_seconds', time.time() - start, **labels)
+        self.metrics.inc('fbchat_requests_total', status=r.status, **labels)
+        self.metrics.inc('fbchat_request_bytes_total', _payload_size(kwargs.get('data')), **labels)
+        if content is not None:
+            self.metrics.inc('fbchat_response_bytes_total', len(content), **labels)
+        return r, content
+
+    async def prewarmConnections(self, hosts=None, timeout=10):
+        """See :func:`Client.prewarmConnections`"""
+        if hosts is None:
+            hosts = {host: 1 for host in self.pool_sizes if host.endswith('-edge-chat.facebook.com')}
+
+        async def connect(host):
+            try:
+                await self._request('HEAD', 'https://{}/'.format(host), headers=self._header, timeout=timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                log.debug('Could not prewarm a connection to {}'.format(host))
+
+        await asyncio.gather(*[connect(host) for host, connections in hosts.items() for i in range(connections)])
+
+    async def _fix_fb_errors(self, error_code, generation=None):
+        """See :func:`Client._fix_fb_errors`. Coroutines that fail while the session is being refreshed wait for it"""
+        if error_code == '1357004':
+            if self._async_repair_lock is None:
+                self._async_repair_lock = asyncio.Lock()
+            async with self._async_repair_lock:
+                if generation is None or generation == self._session_generation:
+                    log.warning('Got error #1357004. Doing a _postLogin, and resending request')
+                    await asyncio.get_event_loop().run_in_executor(None, self._postLogin)
+            return True
+        return False
+
+    async def _retry(self, url, request, method='GET'):
+        """See :func:`Client._retry`. `request` is a coroutine function"""
+        retries = self.retry_policy.get_retries(url)
+        idempotent = self.retry_policy.is_idempotent(method, url)
+        start = time.time()
+        attempt = 0
+        while True:
+            generation = self._session_generation
+            try:
+                return await request()
+            except Exception as e:
+                retryable = self.retry_policy.is_retryable(e, idempotent) or (idempotent and isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError)))
+                if attempt >= retries or not retryable:
+                    raise e
+                if isinstance(e, FBchatFacebookError) and await self._fix_fb_errors(e.fb_error_code, generation):
+                    delay = 0
+                else:
+                    delay = self.retry_policy.get_delay(attempt)
+                if not self.retry_policy.allows(time.time() - start, delay):
+                    raise e
+                log.debug('Retrying request to {} in {:.2f} seconds, because of: {!r}'.format(url, delay, e))
+                self.metrics.inc('fbchat_retries_total', **self._getLabels(url))
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _get(self, url, query=None, timeout=30, fix_request=False, as_json=False):
+        async def request():
+            payload = self._generatePayload(query)
+            r, content = await self._request('GET', url, headers=self._header, params=_encode_payload(payload), timeout=timeout)
+            if not fix_request:
+                return r
+            return self._decodeResponse(url, check_async_request, r, content, as_json=as_json)
+        return await self._retry(url, request)
+
+    async def _post(self, url, query=None, timeout=30, fix_request=False, as_json=False):
+        async def request():
+            payload = self._generatePayload(query)
+            r, content = await self._request('POST', url, headers=self._header, data=_encode_payload(payload), timeout=timeout)
+            if not fix_request:
+                return r
+            return self._decodeResponse(url, check_async_request, r, content, as_json=as_json)
+        return await self._retry(url, request, method='POST')
+
+    async def _graphql(self, payload, partial=False, count=None):
+        async def request():
+            data = self._generatePayload(payload)
+            r, content = await self._request('POST', self.req_url.GRAPHQL, headers=self._header, data=_encode_payload(data), timeout=30)
+            rtn = self._decodeResponse(self.req_url.GRAPHQL, lambda: graphql_response_to_json(check_async_request(r, content, as_json=False, decode=False), partial=partial, count=count))
+            if partial:
+                self._checkPartialErrors(rtn[1])
+            return rtn
+        return await self._retry(self.req_url.GRAPHQL, request, method='POST')
+
+    async def _postFile(self, url, files=None, query=None, timeout=30, fix_request=False, as_json=False):
+        # Removes 'Content-Type' from the header, aiohttp sets the multipart boundary itself
+        headers = dict((i, self._header[i]) for i in self._header if i != 'Content-Type')
+        async def request():
+            payload = self._generatePayload(query)
+            data = aiohttp.FormData(_encode_payload(payload))
+            for name, (filename, content, mimetype) in (files or {}).items():
+                # Rewinds files that were partially read by a failed attempt
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                data.add_field(name, content, filename=filename, content_type=mimetype)
+            r, content = await self._request('POST', url, headers=headers, data=data, timeout=timeout)
+            if not fix_request:
+                return r
+            return self._decodeResponse(url, check_async_request, r, content, as_json=as_json)
+        return await self._retry(url, request, method='POST')
+
+    def _getCaller(self):
+        if _caller is not None and _caller.get() != 'unknown':
+            return _caller.get()
+        return super(AsyncClient, self)._getCaller()
+
+    async def _graphqlChunks(self, chunks, partial=False):
+        if len(chunks) == 1:
+            return [await self._graphql(self._graphqlPayload(chunks[0]), partial=partial, count=len(chunks[0]))]
+        semaphore = asyncio.Semaphore(self._getPoolSize(self.req_url.GRAPHQL))
+
+        async def send(chunk):
+            async with semaphore:
+                return await self._graphql(self._graphqlPayload(chunk), partial=partial, count=len(chunk))
+
+        return await asyncio.gather(*[send(chunk) for chunk in chunks])
+
+    async def graphql_requests(self, *queries):
+        """
+        See :func:`Client.graphql_requests`
+
+        :raises: FBchatException if request failed
+        """
+        results = await self._graphqlChunks(self._chunkQueries(queries))
+        return tuple(result for chunk_results in results for result in chunk_results)
+
+    async def graphql_requests_partial(self, *queries):
+        """
+        See :func:`Client.graphql_requests_partial`
+
+        :raises: FBchatException if request failed
+        """
+        chunks = self._chunkQueries(queries)
+        return self._mergePartialResults(chunks, await self._graphqlChunks(chunks, partial=True))
+
+    def iter_graphql_requests(self, *queries):
+        """
+        See :func:`Client.iter_graphql_requests`. Returns an asynchronous iterator, which holds a connection until every result has been read.
+        Use it in an ``async with`` block (or call its `aclose` method), so the connection is released if you stop early::
+
+            async with client.iter_graphql_requests(*queries) as results:
+                async for index, result in results:
+                    ...
+
+        :raises: FBchatException if request failed
+        """
+        return _GraphQLResultIterator(self, self._graphqlPayload(queries))
+
+    def _createGraphQLBatcher(self, window):
+        return AsyncGraphQLBatcher(self.graphql_requests_partial, window=window)
+
+    async def graphql_request(self, query):
+        """
+        Shorthand for `graphql_requests(query)[0]`.
+        If `graphql_batch_window` is set, the query may be sent together with queries from other coroutines
+
+        :raises: FBchatException if request failed
+        """
+        if self.graphql_batcher is not None:
+            return await self.graphql_batcher.request(query)
+        return (await self.graphql_requests(query))[0]
+
+    """
+    END INTERNAL REQUEST METHODS
+    """
+
+    """
+    LOGIN METHODS
+    """
+
+    def _postLogin(self):
+        super(AsyncClient, self)._postLogin()
+        # The cookies are copied to the `aiohttp` session before the next request
+        self._cookies_synced = False
+
+    def getSession(self):
+        """Retrieves session cookies
+
+        :return: A dictionay containing session cookies
+        :rtype: dict
+        """
+        if self._async_session is None:
+            return super(AsyncClient, self).getSession()
+        return {cookie.key: cookie.value for cookie in self._async_session.cookie_jar}
+
+    async def logout(self):
+        """
+        Safely logs out the client, and closes the `aiohttp` session
+
+        :return: True if the action was successful
+        :rtype: bool
+        """
+        data = {
+            'ref': "mb",
+            'h': self.fb_h
+        }
+
+        r = await self._get(self.req_url.LOGOUT, data)
+
+        await self.close()
+        self._resetValues()
+
+        return r.ok
+
+    """
+    END LOGIN METHODS
+    """
+
+    """
+    FETCH METHODS
+    """
+
+    async def fetchAllUsers(self):
+        """See :func:`Client.fetchAllUsers`"""
+        data = {
+            'viewer': self.uid,
+        }
+        j = await self._post(self.req_url.ALL_USERS, query=data, fix_request=True, as_json=True)
+        return self._parseAllUsers(j)
+
+    async def refreshUserDirectory(self):
+        """See :func:`Client.refreshUserDirectory`"""
+        changed = self.user_directory.update(await self.fetchAllUsers())
+        self._saveUserDirectory(changed)
+        return changed
+
+    async def searchForUsers(self, name, limit=1):
+        """See :func:`Client.searchForUsers`"""
+        if self.user_directory is not None:
+            if self.user_directory.is_stale():
+                await self.refreshUserDirectory()
+            users = self.user_directory.search(name, limit=limit)
+            if users:
+                return users
+
+        j = await self.graphql_request(GraphQL(query=GraphQL.SEARCH_USER, params={'search': name, 'limit': limit}))
+
+        return [graphql_to_user(node) for node in j[name]['users']['nodes']]
+
+    async def searchForPages(self, name, limit=1):
+        """See :func:`Client.searchForPages`"""
+        j = await self.graphql_request(GraphQL(query=GraphQL.SEARCH_PAGE, params={'search': name, 'limit': limit}))
+
+        return [graphql_to_page(node) for node in j[name]['pages']['nodes']]
+
+    async def searchForGroups(self, name, limit=1):
+        """See :func:`Client.searchForGroups`"""
+        j = await self.graphql_request(GraphQL(query=GraphQL.SEARCH_GROUP, params={'search': name, 'limit': limit}))
+
+        return [graphql_to_group(node) for node in j['viewer']['groups']['nodes']]
+
+    async def searchForThreads(self, name, limit=1):
+        """See :func:`Client.searchForThreads`"""
+        j = await self.graphql_request(GraphQL(query=GraphQL.SEARCH_THREAD, params={'search': name, 'limit': limit}))
+
+        return self._parseSearchThreads(j[name]['threads']['nodes'])
+
+    async def _fetchInfo(self, *ids):
+        entries, missing = self.profile_cache.get_many([str(_id) for _id in ids])
+        if missing:
+            j = await self._post(self.req_url.INFO, self._infoData(missing), fix_request=True, as_json=True)
+            entries.update(self._cacheInfo(self._parseInfo(j)))
+        return entries
+
+    async def _prefetchInfo(self, *ids):
+        try:
+            return await self._fetchInfo(*ids)
+        except FBchatException as e:
+            log.debug('Could not prefetch profiles of {}: {}'.format(', '.join(ids), e))
+            return {}
+
+    async def _fetchMissingInfo(self, ids, prefetched):
+        missing = [_id for _id in ids if _id not in prefetched]
+        rtn = dict(prefetched)
+        if missing:
+            rtn.update(await self._fetchInfo(*missing))
+        return rtn
+
+    async def fetchUserInfo(self, *user_ids):
+        """See :func:`Client.fetchUserInfo`"""
+        threads = await self.fetchThreadInfo(*user_ids, thread_type=ThreadType.USER)
+        return self._filterThreads(threads, ThreadType.USER)
+
+    async def fetchPageInfo(self, *page_ids):
+        """See :func:`Client.fetchPageInfo`"""
+        threads = await self.fetchThreadInfo(*page_ids, thread_type=ThreadType.PAGE)
+        return self._filterThreads(threads, ThreadType.PAGE)
+
+    async def fetchGroupInfo(self, *group_ids):
+        """See :func:`Client.fetchGroupInfo`"""
+        threads = await self.fetchThreadInfo(*group_ids)
+        return self._filterThreads(threads, ThreadType.GROUP)
+
+    async def fetchThreadInfo(self, *thread_ids, projection=Projection.FULL, thread_type=None):
+        """See :func:`Client.fetchThreadInfo`"""
+        queries = self._threadInfoQueries(thread_ids)
+        prefetch_ids = self._getPrefetchIds(thread_ids, projection, thread_type)
+        prefetched = {}
+        if prefetch_ids:
+            (results, errors), prefetched = await asyncio.gather(
+                self.graphql_requests_partial(*queries),
+                self._prefetchInfo(*prefetch_ids),
+            )
+        else:
+            results, errors = await self.graphql_requests_partial(*queries)
+        fetched_ids, j = self._splitPartialResults(thread_ids, results)
+        pages_and_user_ids = self._getPagesAndUserIds(fetched_ids, j)
+        pages_and_users = {}
+        if len(pages_and_user_ids) != 0 and projection == Projection.FULL:
+            pages_and_users = await self._fetchMissingInfo(pages_and_user_ids, prefetched)
+
+        rtn = self._parseThreadInfo(fetched_ids, j, pages_and_users, projection)
+        self._checkPartialResults(thread_ids, rtn, errors)
+        return rtn
+
+    async def fetchThreadMessages(self, thread_id=None, limit=20, before=None, lazy=False, projection=Projection.FULL):
+        """See :func:`Client.fetchThreadMessages`"""
+        thread_id, thread_type = self._getThread(thread_id, None)
+
+        j = await self.graphql_request(self._threadMessagesQuery(thread_id, limit, before))
+        return self._parseThreadMessages(thread_id, j, lazy=lazy, projection=projection)
+
+    def iterThreadMessages(self, thread_id=None, page_size=100, prefetch=2, before=None, oldest_first=False, lazy=False, projection=Projection.FULL):
+        """
+        See :func:`Client.iterThreadMessages`. Returns an asynchronous iterator, to be used with ``async for``.
+        Call its `aclose()` coroutine when stopping early (or use it in an ``async with`` block), to cancel the prefetching
+
+        :raises: FBchatException if request failed
+        """
+        boundary = set()
+
+        async def fetch_page(before):
+            messages = await self.fetchThreadMessages(thread_id, limit=page_size, before=before, lazy=lazy, projection=projection)
+            return self._messagePage(messages, page_size, boundary)
+
+        return _PrefetchIterator(fetch_page, before, prefetch, reverse=oldest_first)
+
+    async def fetchThreadList(self, offset=None, limit=20, thread_location=ThreadLocation.INBOX, before=None, lazy=False):
+        """See :func:`Client.fetchThreadList`"""
+        if offset is not None:
+            log.warning('Using `offset` in `fetchThreadList` is no longer supported, since Facebook migrated to the use of GraphQL in this request. Use `before` instead')
+
+        j = await self.graphql_request(self._threadListQuery(limit, thread_location, before))
+        return [graphql_to_thread(node, lazy=lazy) for node in j['viewer']['message_threads']['nodes']]
+
+    def iterThreads(self, thread_location=ThreadLocation.INBOX, page_size=20, prefetch=2, before=None):
+        """
+        See :func:`Client.iterThreads`. Returns an asynchronous iterator, to be used with ``async for``.
+        Call its `aclose()` coroutine when stopping early (or use it in an ``async with`` block), to cancel the prefetching
+
+        :raises: FBchatException if request failed
+        """
+        seen = set()
+
+        async def fetch_page(before):
+            return self._threadPage(await self.fetchThreadList(limit=page_size, thread_location=thread_location, before=before), page_size, seen)
+
+        return _PrefetchIterator(fetch_page, before, prefetch)
+
+    async def fetchUnread(self):
+        """See :func:`Client.fetchUnread`"""
+        form = {
+            'client': 'mercury_sync',
+            'folders[0]': 'inbox',
+            'last_action_timestamp': now() - 60*1000
+        }
+
+        j = await self._post(self.req_url.THREAD_SYNC, form, fix_request=True, as_json=True)
+
+        return {
+            "message_counts": j['payload']['message_counts'],
+            "unseen_threads": j['payload']['unseen_thread_ids']
+        }
+
+    async def fetchImageUrl(self, image_id):
+        """See :func:`Client.fetchImageUrl`"""
+        image_id = str(image_id)
+        return (await self.fetchImageUrls(image_id))[image_id]
+
+    async def fetchImageUrls(self, *image_ids):
+        """See :func:`Client.fetchImageUrls`"""
+        image_ids = list(OrderedDict.fromkeys(str(image_id) for image_id in image_ids))
+        urls, missing = self.image_url_cache.get_many(image_ids)
+        if missing:
+            semaphore = asyncio.Semaphore(self._getPoolSize(ReqUrl.ATTACHMENT_PHOTO))
+
+            async def fetch(image_id):
+                async with semaphore:
+                    return await self._fetchImageUrl(image_id)
+
+            # The errors are returned, so the other urls are still cached, see `_cacheImageUrls`
+            fetched = await asyncio.gather(*[fetch(image_id) for image_id in missing], return_exceptions=True)
+            urls.update(self._cacheImageUrls(zip(missing, fetched)))
+        return urls
+
+    async def _fetchImageUrl(self, image_id):
+        j = await self._get(ReqUrl.ATTACHMENT_PHOTO, query={'photo_id': image_id}, fix_request=True, as_json=True)
+        return self._parseImageUrl(j)
+
+    """
+    END FETCH METHODS
+    """
+
+    """
+    SEND METHODS
+    """
+
+    async def _doSendRequest(self, data):
+        j = await self._post(self.req_url.SEND, data, fix_request=True, as_json=True)
+        return self._parseSendResponse(j)
+
+    async def send(self, message, thread_id=None, thread_type=ThreadType.USER):
+        """See :func:`Client.send`"""
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+        data = self._getSendData(message=message, thread_id=thread_id, thread_type=thread_type)
+
+        return await self._doSendRequest(data)
+
+    async def sendMessage(self, message, thread_id=None, thread_type=ThreadType.USER):
+        """
+        Deprecated. Use :func:`fbchat.AsyncClient.send` instead
+        """
+        return await self.send(Message(text=message), thread_id=thread_id, thread_type=thread_type)
+
+    async def sendEmoji(self, emoji=None, size=EmojiSize.SMALL, thread_id=None, thread_type=ThreadType.USER):
+        """
+        Deprecated. Use :func:`fbchat.AsyncClient.send` instead
+        """
+        return await self.send(Message(text=emoji, emoji_size=size), thread_id=thread_id, thread_type=thread_type)
+
+    async def _uploadImage(self, image_path, data, mimetype):
+        j = await self._postFile(self.req_url.UPLOAD, {
+            'file': (
+                image_path,
+                data,
+                mimetype
+            )
+        }, fix_request=True, as_json=True)
+        # Return the image_id
+        if not mimetype == 'image/gif':
+            return j['payload']['metadata'][0]['image_id']
+        else:
+            return j['payload']['metadata'][0]['gif_id']
+
+    async def sendImage(self, image_id, message=None, thread_id=None, thread_type=ThreadType.USER, is_gif=False):
+        """
+        Deprecated. Use :func:`fbchat.AsyncClient.send` instead
+        """
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+        data = self._getImageSendData(image_id, message=message, thread_id=thread_id, thread_type=thread_type, is_gif=is_gif)
+        return await self._doSendRequest(data)
+
+    async def sendRemoteImage(self, image_url, message=None, thread_id=None, thread_type=ThreadType.USER):
+        """See :func:`Client.sendRemoteImage`"""
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+        mimetype = guess_type(image_url)[0]
+        is_gif = (mimetype == 'image/gif')
+        r, remote_image = await self._request('GET', image_url, endpoint=get_host(image_url))
+        image_id = await self._uploadImage(image_url, remote_image, mimetype)
+        return await self.sendImage(image_id=image_id, message=message, thread_id=thread_id, thread_type=thread_type, is_gif=is_gif)
+
+    async def sendLocalImage(self, image_path, message=None, thread_id=None, thread_type=ThreadType.USER):
+        """See :func:`Client.sendLocalImage`"""
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+        mimetype = guess_type(image_path)[0]
+        is_gif = (mimetype == 'image/gif')
+        with open(image_path, 'rb') as f:
+            image_id = await self._uploadImage(image_path, f, mimetype)
+        return await self.sendImage(image_id=image_id, message=message, thread_id=thread_id, thread_type=thread_type, is_gif=is_gif)
+
+    async def addUsersToGroup(self, user_ids, thread_id=None):
+        """See :func:`Client.addUsersToGroup`"""
+        thread_id, thread_type = self._getThread(thread_id, None)
+        data = self._getAddUsersData(user_ids, thread_id)
+        return await self._doSendRequest(data)
+
+    async def removeUserFromGroup(self, user_id, thread_id=None):
+        """See :func:`Client.removeUserFromGroup`"""
+        thread_id, thread_type = self._getThread(thread_id, None)
+
+        data = {
+            "uid": user_id,
+            "tid": thread_id
+        }
+
+        j = await self._post(self.req_url.REMOVE_USER, data, fix_request=True, as_json=True)
+
+    async def changeThreadTitle(self, title, thread_id=None, thread_type=ThreadType.USER):
+        """See :func:`Client.changeThreadTitle`"""
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+
+        if thread_type == ThreadType.USER:
+            # The thread is a user, so we change the user's nickname
+            return await self.changeNickname(title, thread_id, thread_id=thread_id, thread_type=thread_type)
+        else:
+            data = self._getSendData(thread_id=thread_id, thread_type=thread_type)
+
+            data['action_type'] = 'ma-type:log-message'
+            data['log_message_data[name]'] = title
+            data['log_message_type'] = 'log:thread-name'
+
+            return await self._doSendRequest(data)
+
+    async def changeNickname(self, nickname, user_id, thread_id=None, thread_type=ThreadType.USER):
+        """See :func:`Client.changeNickname`"""
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+
+        data = {
+            'nickname': nickname,
+            'participant_id': user_id,
+            'thread_or_other_fbid': thread_id
+        }
+
+        j = await self._post(self.req_url.THREAD_NICKNAME, data, fix_request=True, as_json=True)
+
+    async def changeThreadColor(self, color, thread_id=None):
+        """See :func:`Client.changeThreadColor`"""
+        thread_id, thread_type = self._getThread(thread_id, None)
+
+        data = {
+            'color_choice': color.value,
+            'thread_or_other_fbid': thread_id
+        }
+
+        j = await self._post(self.req_url.THREAD_COLOR, data, fix_request=True, as_json=True)
+
+    async def changeThreadEmoji(self, emoji, thread_id=None):
+        """See :func:`Client.changeThreadEmoji`"""
+        thread_id, thread_type = self._getThread(thread_id, None)
+
+        data = {
+            'emoji_choice': emoji,
+            'thread_or_other_fbid': thread_id
+        }
+
+        j = await self._post(self.req_url.THREAD_EMOJI, data, fix_request=True, as_json=True)
+
+    async def reactToMessage(self, message_id, reaction):
+        """See :func:`Client.reactToMessage`"""
+        j = await self._post(self._getReactionUrl(message_id, reaction), fix_request=True, as_json=True)
+
+    async def eventReminder(self, thread_id, time, title, location='', location_id=''):
+        """See :func:`Client.eventReminder`"""
+        j = await self._post(self._getEventReminderUrl(thread_id, time, title, location, location_id), fix_request=True, as_json=True)
+
+    async def setTypingStatus(self, status, thread_id=None, thread_type=None):
+        """See :func:`Client.setTypingStatus`"""
+        thread_id, thread_type = self._getThread(thread_id, thread_type)
+
+        data = {
+            "typ": status.value,
+            "thread": thread_id,
+            "to": thread_id if thread_type == ThreadType.USER else "",
+            "source": "mercury-chat"
+        }
+
+        j = await self._post(self.req_url.TYPING, data, fix_request=True, as_json=True)
+
+    """
+    END SEND METHODS
+    """
+
+    async def markAsDelivered(self, userID, threadID):
+        """See :func:`Client.markAsDelivered`"""
+        data = {
+            "message_ids[0]": threadID,
+            "thread_ids[%s][0]" % userID: threadID
+        }
+
+        r = await self._post(self.req_url.DELIVERED, data)
+        return r.ok
+
+    async def markAsRead(self, userID):
+        """See :func:`Client.markAsRead`"""
+        data = {
+            "watermarkTimestamp": now(),
+            "shouldSendReadReceipt": True,
+            "ids[%s]" % userID: True
+        }
+
+        r = await self._post(self.req_url.READ_STATUS, data)
+        return r.ok
+
+    async def markAsSeen(self):
+        """See :func:`Client.markAsSeen`"""
+        r = await self._post(self.req_url.MARK_SEEN, {"seen_timestamp": 0})
+        return r.ok
+
+    async def friendConnect(self, friend_id):
+        """See :func:`Client.friendConnect`"""
+        data = {
+            "to_friend": friend_id,
+            "action": "confirm"
+        }
+
+        r = await self._post(self.req_url.CONNECT, data)
+        return r.ok
+
+    """
+    LISTEN METHODS
+    """
+
+    async def _ping(self, sticky, pool):
+        data = {
+            'channel': self.user_channel,
+            'clientid': self.client_id,
+            'partition': -2,
+            'cap': 0,
+            'uid': self.uid,
+            'sticky_token': sticky,
+            'sticky_pool': pool,
+            'viewer_uid': self.uid,
+            'state': 'active'
+        }
+        await self._get(self.req_url.PING, data, fix_request=True, as_json=False)
+
+    async def _fetchSticky(self):
+        data = {
+            "msgs_recv": 0,
+            "channel": self.user_channel,
+            "clientid": self.client_id
+        }
+
+        j = await self._get(self.req_url.STICKY, data, fix_request=True, as_json=True)
+
+        if j.get('lb_info') is None:
+            raise FBchatException('Missing lb_info: {}'.format(j))
+
+        return j['lb_info']['sticky'], j['lb_info']['pool']
+
+    async def _pullMessage(self, sticky, pool):
+        data = {
+            "msgs_recv": 0,
+            "sticky_token": sticky,
+            "sticky_pool": pool,
+            "clientid": self.client_id,
+        }
+
+        j = await self._get(ReqUrl.STICKY, data, fix_request=True, as_json=True)
+
+        self.seq = j.get('seq', '0')
+        return j
+
+    async def startListening(self):
+        """See :func:`Client.startListening`"""
+        self.listening = True
+        self.sticky, self.pool = await self._fetchSticky()
+
+    def _handleMessage(self, content):
+        # Tasks started by the callbacks inherit the context, so it's cleared as well
+        if _caller is None:
+            return super(AsyncClient, self)._handleMessage(content)
+        token = _caller.set('unknown')
+        try:
+            super(AsyncClient, self)._handleMessage(content)
+        finally:
+            _caller.reset(token)
+
+    async def doOneListen(self, markAlive=True):
+        """See :func:`Client.doOneListen`"""
+        try:
+            if markAlive:
+                await self._ping(self.sticky, self.pool)
+            content = await self._pullMessage(self.sticky, self.pool)
+            self._listen_failures = 0
+            if content:
+                start = time.time()
+                self._handleMessage(content)
+                self.metrics.observe('fbchat_callback_duration_seconds', time.time() - start)
+        except KeyboardInterrupt:
+            return False
+        except asyncio.TimeoutError:
+            pass
+        except aiohttp.ClientConnectionError:
+            # If the client has lost their internet connection, keep trying, waiting a bit longer each time (See `retry_policy`)
+            await asyncio.sleep(self.retry_policy.get_delay(self._listen_failures))
+            self._listen_failures += 1
+        except FBchatFacebookError as e:
+            # Fix 502 and 503 pull errors
+            if e.request_status_code in [502, 503]:
+                self.req_url.change_pull_channel()
+                await self.startListening()
+            elif not await self._fix_fb_errors(e.fb_error_code):
+                # Requests to the pull channels aren't retried, so an expired session is refreshed here
+                raise e
+        except Exception as e:
+            return self.onListenError(exception=e)
+
+        return True
+
+    async def listen(self, markAlive=True):
+        """See :func:`Client.listen`"""
+        await self.startListening()
+        self.onListening()
+
+        while self.listening and await self.doOneListen(markAlive):
+            pass
+
+        self.stopListening()
+
+    """
+    END LISTEN METHODS
+    """
+
+
+def _labeled_coroutine(name, func):
+    """Like `_labeled`, for coroutines. The label is kept in a context variable, which the tasks they start inherit"""
+    @functools.wraps(func)
+    async def coroutine(self, *args, **kwargs):
+        if _caller is None or _caller.get() != 'unknown':
+            return await func(self, *args, **kwargs)
+        token = _caller.set(name)
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            _caller.reset(token)
+    return coroutine
+
+
+_label_methods(AsyncClient, lambda name, func: (_labeled_coroutine if inspect.iscoroutinefunction(func) else _labeled)(name, func))
@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import threading
+from .models import *
+
+
+class _Batch(object):
+    def __init__(self):
+        self.queries = []
+        self.results = None
+        self.error = None
+        # Set when the batch is full, and should be sent right away
+        self.full = threading.Event()
+        # Set when the results (or the error) are available
+        self.done = threading.Event()
+
+
+class GraphQLBatcher(object):
+    """
+    Merges GraphQL queries from different threads into one `graphqlbatch` request.
+
+    The first query starts a new batch, and waits `window` seconds for other queries to join it
+    (or until the batch has `max_size` queries), and then sends all the queries in one request.
+    Every caller gets their own result back, and a query that fails only raises an exception for the caller that sent it
+    """
+
+    def __init__(self, send, window=0.01, max_size=50):
+        """
+        :param send: A function that sends a list of queries in one request, and returns partial results, like :func:`Client.graphql_requests_partial`
+        :param window: How many seconds the first query of a batch waits for other queries
+        :param max_size: The maximum number of queries in one batch
+        """
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._batch = None
+        #: Number of queries that have been requested
+        self.queries = 0
+        #: Number of batches that have been sent
+        self.batches = 0
+
+    def request(self, query):
+        """
+        Adds `query` to a batch, and returns its result when the batch has been sent
+
+        :raises: FBchatException if request failed
+        """
+        with self._lock:
+            self.queries += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            index = len(batch.queries)
+            batch.queries.append(query)
+            if len(batch.queries) >= self.max_size:
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+                self.batches += 1
+            try:
+                batch.results = self.send(*batch.queries)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return get_batch_result(batch.results, index)
+
+
+def get_batch_result(partial_results, index):
+    """Returns the result of query number `index` from partial results, or raises its error"""
+    results, errors = partial_results
+    if index in errors:
+        raise errors[index]
+    if index not in results:
+        raise FBchatException('Facebook did not return a result for query number {}'.format(index))
+    return results[index]
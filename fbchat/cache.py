@@ -0,0 +1,115 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import threading
+from collections import OrderedDict
+from .ratelimit import clock
+
+
+class TTLCache(object):
+    """
+    A thread-safe cache, where entries expire `ttl` seconds after they were stored.
+    When more than `max_size` entries are stored, the least recently used ones are evicted
+    """
+
+    def __init__(self, max_size=1000, ttl=300):
+        """
+        :param max_size: The maximum number of entries
+        :param ttl: How many seconds entries are kept. If `0`, nothing is cached
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        #: Number of lookups that were found in the cache
+        self.hits = 0
+        #: Number of lookups that weren't found in the cache, or had expired
+        self.misses = 0
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        # Move the entry to the end, so it's evicted last
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        """Returns the value stored for `key`, or `default` if it isn't cached"""
+        values, missing = self.get_many([key])
+        return values.get(key, default)
+
+    def get_many(self, keys):
+        """
+        Looks up several keys at once
+
+        :return: A dict with the values that were cached, labeled by key, and a list of the keys that weren't
+        :rtype: tuple
+        """
+        values = {}
+        missing = []
+        with self._lock:
+            now = clock()
+            for key in keys:
+                entry = self._get(key, now)
+                if entry is None:
+                    self.misses += 1
+                    missing.append(key)
+                else:
+                    self.hits += 1
+                    values[key] = entry[1]
+        return values, missing
+
+    def set(self, key, value, ttl=None):
+        """Stores `value` for `key`, see :func:`set_many`"""
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, values, ttl=None):
+        """
+        Stores several values, given as a dict labeled by key
+
+        :param ttl: If set, the values expire after this many seconds instead, if that's sooner than `ttl` of the cache
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or not self.max_size:
+            return
+        with self._lock:
+            expires = clock() + ttl
+            for key, value in values.items():
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Removes `keys` from the cache"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        """
+        Returns `hits`, `misses`, `hit_rate` (the fraction of lookups that were cached) and `size` (the number of cached entries)
+
+        :rtype: dict
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self._entries),
+            }
@@ -10,14 +10,76 @@ from mimetypes import guess_type
 from .utils import *
 from .models import *
 from .graphql import *
+from .retry import *
+from .ratelimit import *
+from .metrics import *
+from .batching import *
+from .cache import *
+from .directory import *
 import time
+import threading
+import functools
+import inspect
+from collections import OrderedDict
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+
+def _labeled(name, func):
+    """
+    Wraps the public method `func`, so the requests it sends are labeled with `name` in the metrics, see :func:`Client._getCaller`.
+    When public methods call each other, the outermost one keeps the label
+    """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator(self, *args, **kwargs):
+            items = func(self, *args, **kwargs)
+            try:
+                while True:
+                    previous = self._setCaller(name)
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    finally:
+                        self._local.caller = previous
+                    yield item
+            finally:
+                items.close()
+        return generator
+
+    @functools.wraps(func)
+    def method(self, *args, **kwargs):
+        previous = self._setCaller(name)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._local.caller = previous
+    return method
+
 
+def _label_methods(cls, wrap=_labeled):
+    """Wraps the public methods defined in `cls` with `wrap(name, func)`"""
+    for name, func in list(vars(cls).items()):
+        if not name.startswith('_') and inspect.isfunction(func):
+            setattr(cls, name, wrap(name, func))
+    return cls
 
 
 class Client(object):
     """A client for the Facebook Chat (Messenger).
 
     See https://fbchat.readthedocs.io for complete documentation of the API.
+
+    One client can be shared between multiple threads: Sending, fetching and listening can happen concurrently,
+    see :ref:`intro_threading` for what is and isn't safe
     """
 
     listening = False
@@ -30,7 +92,7 @@ class Client(object):
     Note: Modifying this results in undefined behaviour
     """
 
-    def __init__(self, email, password, user_agent=None, max_tries=5, session_cookies=None, logging_level=logging.INFO):
+    def __init__(self, email, password, user_agent=None, max_tries=5, session_cookies=None, logging_level=logging.INFO, pool_sizes=None, pool_block=False, retry_policy=None, rate_limiter=None, metrics=None, graphql_batch_window=None, graphql_chunk_size=50, profile_cache=None, user_directory=None, image_url_cache=None):
         """Initializes and logs in the client
 
         :param email: Facebook `email`, `id` or `phone number`
@@ -39,14 +101,77 @@ class Client(object):
         :param max_tries: Maximum number of times to try logging in
         :param session_cookies: Cookies from a previous session (Will default to login if these are invalid)
         :param logging_level: Configures the `logging level <https://docs.python.org/3/library/logging.html#logging-levels>`_. Defaults to `INFO`
+        :param pool_sizes: Maximum number of connections to keep alive, labeled by host. Updates the defaults in :any:`utils.POOL_SIZES`
+        :param pool_block: Whether requests should wait for a free connection when a host's pool is exhausted, instead of opening a connection that is thrown away afterwards
+        :param retry_policy: Decides how failed requests are retried. Defaults to `RetryPolicy()`
+        :param rate_limiter: Paces the requests sent to each endpoint. Defaults to `RateLimiter()`, which doesn't limit anything
+        :param metrics: Collects latency and throughput metrics. Defaults to `MetricsRegistry()`
+        :param graphql_batch_window: If set, queries sent with :func:`graphql_request` within this many seconds of each other are sent in one request, see :class:`GraphQLBatcher`
+        :param graphql_chunk_size: The maximum number of queries :func:`graphql_requests` sends in one request. Larger lists of queries are split up, and sent concurrently
+        :param profile_cache: Caches the user and page profiles fetched by :func:`fetchThreadInfo`. Defaults to `TTLCache()`, which keeps 1000 profiles for 5 minutes.
+            Use `TTLCache(ttl=0)` to always fetch them
+        :param user_directory: If set, :func:`searchForUsers` searches this :class:`UserDirectory` first, and only sends a request if no users are found
+        :param image_url_cache: Caches the urls fetched by :func:`fetchImageUrls`. Defaults to `TTLCache(max_size=10000, ttl=3600)`.
+            Urls are never kept past the expiry Facebook signed them with
         :type max_tries: int
         :type session_cookies: dict
         :type logging_level: int
+        :type pool_sizes: dict
+        :type pool_block: bool
+        :type retry_policy: RetryPolicy
+        :type rate_limiter: RateLimiter
+        :type metrics: MetricsRegistry
+        :type graphql_batch_window: float
+        :type graphql_chunk_size: int
+        :type profile_cache: TTLCache
+        :type user_directory: UserDirectory
+        :type image_url_cache: TTLCache
         :raises: FBchatException on failed login
         """
 
         self.sticky, self.pool = (None, None)
-        self._session = requests.session()
+        # Guards `req_counter` and `payloadDefault`, which are shared by all threads sending requests
+        self._state_lock = threading.Lock()
+        # Makes sure only one thread refreshes the session at a time, see `_fix_fb_errors`
+        self._repair_lock = threading.Lock()
+        # Incremented every time the session is (re)initialized
+        self._session_generation = 0
+        self.pool_sizes = dict(POOL_SIZES)
+        if pool_sizes:
+            self.pool_sizes.update(pool_sizes)
+        self.pool_block = pool_block
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        #: A :class:`RetryPolicy`, which decides how failed requests are retried
+        self.retry_policy = retry_policy
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        #: A :class:`RateLimiter`, which paces the requests sent to each endpoint
+        self.rate_limiter = rate_limiter
+        if metrics is None:
+            metrics = MetricsRegistry()
+        #: A :class:`MetricsRegistry`, which collects latency and throughput metrics for every request
+        self.metrics = metrics
+        self.graphql_chunk_size = graphql_chunk_size
+        if profile_cache is None:
+            profile_cache = TTLCache()
+        #: A :class:`TTLCache` with the user and page profiles fetched by :func:`fetchThreadInfo`, labeled by ID
+        self.profile_cache = profile_cache
+        if image_url_cache is None:
+            image_url_cache = TTLCache(max_size=10000, ttl=3600)
+        #: A :class:`TTLCache` with the urls fetched by :func:`fetchImageUrls`, labeled by image ID
+        self.image_url_cache = image_url_cache
+        #: A :class:`UserDirectory`, if `user_directory` is set
+        self.user_directory = user_directory
+        # Holds the outermost public method running in each thread, see `_getCaller`
+        self._local = threading.local()
+        #: A :class:`GraphQLBatcher`, if `graphql_batch_window` is set
+        self.graphql_batcher = None
+        if graphql_batch_window is not None:
+            self.graphql_batcher = self._createGraphQLBatcher(graphql_batch_window)
+        # Number of times in a row the listening loop has lost its connection
+        self._listen_failures = 0
+        self._session = self._createSession()
         self.req_counter = 1
         self.seq = "0"
         self.payloadDefault = {}
@@ -79,104 +204,418 @@ class Client(object):
     INTERNAL REQUEST METHODS
     """
 
+    def _createSession(self):
+        """Creates a `requests` session, with a separately sized connection pool for each host in `pool_sizes`"""
+        session = requests.session()
+        for host, size in self.pool_sizes.items():
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=self.pool_block)
+            session.mount('https://{}'.format(host), adapter)
+        return session
+
+    def prewarmConnections(self, hosts=None, timeout=10):
+        """
+        Opens connections to Facebook's hosts ahead of time, so later requests don't have to wait for TCP and TLS handshakes.
+        By default, this connects to all the pull channels, so switching channel (which happens when Facebook returns 502 or 503 while listening) is fast
+
+        Hosts that can't be reached are ignored
+
+        :param hosts: The hosts to connect to, and how many connections to open to each of them. Defaults to one connection to each pull channel
+        :param timeout: See `requests timeout <http://docs.python-requests.org/en/master/user/advanced/#timeouts>`_
+        :type hosts: dict
+        """
+        if hosts is None:
+            hosts = {host: 1 for host in self.pool_sizes if host.endswith('-edge-chat.facebook.com')}
+
+        def connect(host):
+            try:
+                self._session.head('https://{}/'.format(host), headers=self._header, timeout=timeout)
+            except requests.RequestException:
+                log.debug('Could not prewarm a connection to {}'.format(host))
+
+        # The connections are opened at the same time, otherwise they would just reuse each other
+        workers = []
+        for host, connections in hosts.items():
+            for i in range(connections):
+                worker = threading.Thread(target=connect, args=(host,))
+                worker.start()
+                workers.append(worker)
+        for worker in workers:
+            worker.join()
+
     def _generatePayload(self, query):
         """Adds the following defaults to the payload:
           __rev, __user, __a, ttstamp, fb_dtsg, __req
         """
-        payload = self.payloadDefault.copy()
+        with self._state_lock:
+            payload = self.payloadDefault.copy()
+            req_counter = self.req_counter
+            self.req_counter += 1
         if query:
             payload.update(query)
-        payload['__req'] = str_base(self.req_counter, 36)
+        payload['__req'] = str_base(req_counter, 36)
         payload['seq'] = self.seq
-        self.req_counter += 1
         return payload
 
-    def _fix_fb_errors(self, error_code):
+    def _fix_fb_errors(self, error_code, generation=None):
         """
         This fixes "Please try closing and re-opening your browser window" errors (1357004)
         This error usually happens after 1-2 days of inactivity
         It may be a bad idea to do this in an exception handler, if you have a better method, please suggest it!
+
+        When many requests fail at once, only one of them refreshes the session, while the others wait for it.
+        `generation` is the value of `_session_generation` from when the failed request was sent,
+        if the session has been refreshed since then, the request is just resent
         """
         if error_code == '1357004':
-            log.warning('Got error #1357004. Doing a _postLogin, and resending request')
-            self._postLogin()
+            with self._repair_lock:
+                if generation is None or generation == self._session_generation:
+                    log.warning('Got error #1357004. Doing a _postLogin, and resending request')
+                    self._postLogin()
             return True
         return False
 
-    def _get(self, url, query=None, timeout=30, fix_request=False, as_json=False, error_retries=3):
-        payload = self._generatePayload(query)
-        r = self._session.get(url, headers=self._header, params=payload, timeout=timeout)
-        if not fix_request:
-            return r
+    def _retry(self, url, request, method='GET'):
+        """
+        Calls `request` until it succeeds, or until `retry_policy` gives up, and then raises the last exception.
+        If the session has expired, it's refreshed before `request` is called again
+        """
+        retries = self.retry_policy.get_retries(url)
+        idempotent = self.retry_policy.is_idempotent(method, url)
+        start = time.time()
+        attempt = 0
+        while True:
+            generation = self._session_generation
+            try:
+                return request()
+            except Exception as e:
+                if attempt >= retries or not self.retry_policy.is_retryable(e, idempotent):
+                    raise e
+                if isinstance(e, FBchatFacebookError) and self._fix_fb_errors(e.fb_error_code, generation):
+                    delay = 0
+                else:
+                    delay = self.retry_policy.get_delay(attempt)
+                if not self.retry_policy.allows(time.time() - start, delay):
+                    raise e
+                log.debug('Retrying request to {} in {:.2f} seconds, because of: {!r}'.format(url, delay, e))
+                self.metrics.inc('fbchat_retries_total', **self._getLabels(url))
+                time.sleep(delay)
+                attempt += 1
+
+    def _doRequest(self, method, url, endpoint=None, **kwargs):
+        """
+        Sends a single request. All requests sent by `_get`, `_post`, `_postFile` and `_graphql` go through here.
+        The request is rate limited and labeled by `endpoint`, or by `url` if it isn't set
+        """
+        endpoint = endpoint or url
+        self.rate_limiter.acquire(endpoint)
+        labels = self._getLabels(endpoint)
+        start = time.time()
         try:
-            return check_request(r, as_json=as_json)
-        except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
-                return self._get(url, query=query, timeout=timeout, fix_request=fix_request, as_json=as_json, error_retries=error_retries-1)
-            raise e
-
-    def _post(self, url, query=None, timeout=30, fix_request=False, as_json=False, error_retries=3):
-        payload = self._generatePayload(query)
-        r = self._session.post(url, headers=self._header, data=payload, timeout=timeout)
-        if not fix_request:
-            return r
+            r = self._session.request(method, url, **kwargs)
+        except Exception:
+            self.metrics.inc('fbchat_requests_total', status='error', **labels)
+            raise
+        finally:
+            self.metrics.observe('fbchat_request_duration_seconds', time.time() - start, **labels)
+        self.metrics.inc('fbchat_requests_total', status=r.status_code, **labels)
+        self.metrics.inc('fbchat_request_bytes_total', len(r.request.body or ''), **labels)
+        if not kwargs.get('stream'):
+            # Streamed responses are counted by `_iterContent`
+            self.metrics.inc('fbchat_response_bytes_total', len(r.content), **labels)
+        return r
+
+    def _iterContent(self, url, r, chunk_size=8192):
+        """Yields the chunks of a streamed response, and records its size in the metrics"""
+        size = 0
         try:
-            return check_request(r, as_json=as_json)
-        except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
-                return self._post(url, query=query, timeout=timeout, fix_request=fix_request, as_json=as_json, error_retries=error_retries-1)
-            raise e
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.metrics.inc('fbchat_response_bytes_total', size, **self._getLabels(url))
+
+    def _getLabels(self, url):
+        """
+        Returns the metric labels for a request to `url`: The endpoint, and the outermost public method that sent the request.
+        Internal methods and callbacks calling other public methods are counted towards the method that called them
+        """
+        return {'endpoint': get_endpoint(url), 'method': self._getCaller()}
+
+    def _getCaller(self):
+        """Returns the outermost public method that is running in this thread, or the one that started the current worker thread"""
+        return getattr(self._local, 'caller', None) or 'unknown'
+
+    def _setCaller(self, name):
+        """Labels the requests sent from this thread with `name`, unless a public method already did, and returns the previous label"""
+        previous = getattr(self._local, 'caller', None)
+        if previous is None:
+            self._local.caller = name
+        return previous
+
+    def _getPoolSize(self, url):
+        """Returns the maximum number of connections that are kept alive to the host of `url`"""
+        return self.pool_sizes.get(urlparse(url).netloc, 1)
+
+    def _runConcurrently(self, funcs, max_workers):
+        """
+        Calls the functions in `funcs` from up to `max_workers` threads (including the current one), and returns their results in order.
+        If any of them fail, the first exception is raised after all of them have finished
+        """
+        results = [None] * len(funcs)
+        errors = [None] * len(funcs)
+        indexes = iter(range(len(funcs)))
+        lock = threading.Lock()
+        caller = getattr(self._local, 'caller', None)
+
+        def work():
+            # The worker threads are labeled with the method that started them, see `_getCaller`.
+            # The label of the calling thread is restored afterwards
+            previous = getattr(self._local, 'caller', None)
+            self._local.caller = caller
+            try:
+                while True:
+                    with lock:
+                        i = next(indexes, None)
+                    if i is None:
+                        return
+                    try:
+                        results[i] = funcs[i]()
+                    except Exception as e:
+                        errors[i] = e
+            finally:
+                self._local.caller = previous
+
+        workers = [threading.Thread(target=work) for i in range(min(max_workers, len(funcs)) - 1)]
+        for worker in workers:
+            worker.start()
+        work()
+        for worker in workers:
+            worker.join()
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    def _iterPrefetched(self, fetch_page, cursor, prefetch):
+        """
+        Yields the items of the pages returned by `fetch_page(cursor)`, which returns a page (a list) and the cursor of the next page,
+        or `None` after the last page. A background thread fetches up to `prefetch` pages ahead of the caller
+        """
+        if prefetch < 1:
+            while True:
+                items, cursor = fetch_page(cursor)
+                for item in items:
+                    yield item
+                if cursor is None:
+                    return
+
+        pages = queue.Queue(prefetch)
+        stop = threading.Event()
+        caller = getattr(self._local, 'caller', None)
+
+        def put(page):
+            # Gives up if the caller stopped iterating, so the thread doesn't wait forever
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
 
-    def _graphql(self, payload, error_retries=3):
-        content = self._post(self.req_url.GRAPHQL, payload, fix_request=True, as_json=False)
+        def produce(cursor):
+            self._local.caller = caller
+            try:
+                while True:
+                    items, cursor = fetch_page(cursor)
+                    if not put(('page', items)) or cursor is None:
+                        break
+                put(('done', None))
+            except Exception as e:
+                put(('error', e))
+
+        producer = threading.Thread(target=produce, args=(cursor,))
+        producer.daemon = True
+        producer.start()
         try:
-            return graphql_response_to_json(content)
-        except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
-                return self._graphql(payload, error_retries=error_retries-1)
-            raise e
+            while True:
+                kind, value = pages.get()
+                if kind == 'done':
+                    return
+                if kind == 'error':
+                    raise value
+                for item in value:
+                    yield item
+        finally:
+            stop.set()
+
+    def _decodeResponse(self, url, decode, *args, **kwargs):
+        """Calls `decode` with the given arguments, and records the time spent in the metrics"""
+        start = time.time()
+        try:
+            return decode(*args, **kwargs)
+        finally:
+            self.metrics.observe('fbchat_decode_duration_seconds', time.time() - start, **self._getLabels(url))
+
+    def _get(self, url, query=None, timeout=30, fix_request=False, as_json=False):
+        def request():
+            payload = self._generatePayload(query)
+            r = self._doRequest('GET', url, headers=self._header, params=payload, timeout=timeout)
+            if not fix_request:
+                return r
+            return self._decodeResponse(url, check_request, r, as_json=as_json)
+        return self._retry(url, request)
+
+    def _post(self, url, query=None, timeout=30, fix_request=False, as_json=False):
+        def request():
+            payload = self._generatePayload(query)
+            r = self._doRequest('POST', url, headers=self._header, data=payload, timeout=timeout)
+            if not fix_request:
+                return r
+            return self._decodeResponse(url, check_request, r, as_json=as_json)
+        return self._retry(url, request, method='POST')
+
+    def _graphql(self, payload, partial=False, count=None):
+        def request():
+            data = self._generatePayload(payload)
+            r = self._doRequest('POST', self.req_url.GRAPHQL, headers=self._header, data=data, timeout=30)
+            rtn = self._decodeResponse(self.req_url.GRAPHQL, lambda: graphql_response_to_json(check_request(r, as_json=False, decode=False), partial=partial, count=count))
+            if partial:
+                self._checkPartialErrors(rtn[1])
+            return rtn
+        return self._retry(self.req_url.GRAPHQL, request, method='POST')
+
+    def _checkPartialErrors(self, errors):
+        """Raises the errors from partial results that are worth retrying the whole request for, like an expired session"""
+        for error in errors.values():
+            if self.retry_policy.is_retryable(error):
+                raise error
 
     def _cleanGet(self, url, query=None, timeout=30):
         return self._session.get(url, headers=self._header, params=query, timeout=timeout)
 
     def _cleanPost(self, url, query=None, timeout=30):
-        self.req_counter += 1
+        with self._state_lock:
+            self.req_counter += 1
         return self._session.post(url, headers=self._header, data=query, timeout=timeout)
 
-    def _postFile(self, url, files=None, query=None, timeout=30, fix_request=False, as_json=False, error_retries=3):
-        payload=self._generatePayload(query)
+    def _postFile(self, url, files=None, query=None, timeout=30, fix_request=False, as_json=False):
         # Removes 'Content-Type' from the header
         headers = dict((i, self._header[i]) for i in self._header if i != 'Content-Type')
-        r = self._session.post(url, headers=headers, data=payload, timeout=timeout, files=files)
-        if not fix_request:
-            return r
-        try:
-            return check_request(r, as_json=as_json)
-        except FBchatFacebookError as e:
-            if error_retries > 0 and self._fix_fb_errors(e.fb_error_code):
-                return self._postFile(url, files=files, query=query, timeout=timeout, fix_request=fix_request, as_json=as_json, error_retries=error_retries-1)
-            raise e
+        def request():
+            # Rewinds files that were partially read by a failed attempt
+            for f in (files or {}).values():
+                if hasattr(f[1], 'seek'):
+                    f[1].seek(0)
+            payload = self._generatePayload(query)
+            r = self._doRequest('POST', url, headers=headers, data=payload, timeout=timeout, files=files)
+            if not fix_request:
+                return r
+            return self._decodeResponse(url, check_request, r, as_json=as_json)
+        return self._retry(url, request, method='POST')
+
+    def _graphqlPayload(self, queries):
+        return {
+            'method': 'GET',
+            'response_format': 'json',
+            'queries': graphql_queries_to_json(*queries)
+        }
+
+    def _chunkQueries(self, queries):
+        """Splits `queries` into lists of at most `graphql_chunk_size` queries"""
+        size = self.graphql_chunk_size or len(queries) or 1
+        return [queries[i:i + size] for i in range(0, len(queries), size)] or [queries]
+
+    def _mergePartialResults(self, chunks, chunk_results):
+        """Merges the partial results of each chunk of queries, see :func:`graphql_requests_partial`"""
+        results, errors = {}, {}
+        offset = 0
+        for chunk, (_results, _errors) in zip(chunks, chunk_results):
+            results.update((offset + i, result) for i, result in _results.items())
+            errors.update((offset + i, error) for i, error in _errors.items())
+            offset += len(chunk)
+        return results, errors
+
+    def _graphqlChunks(self, chunks, partial=False):
+        """Sends each chunk of queries in its own request, concurrently, and returns the results of each chunk"""
+        if len(chunks) == 1:
+            return [self._graphql(self._graphqlPayload(chunks[0]), partial=partial, count=len(chunks[0]))]
+        return self._runConcurrently([
+            lambda chunk=chunk: self._graphql(self._graphqlPayload(chunk), partial=partial, count=len(chunk)) for chunk in chunks
+        ], self._getPoolSize(self.req_url.GRAPHQL))
 
     def graphql_requests(self, *queries):
         """
-        .. todo::
-            Documenting this
+        Sends GraphQL queries, and returns their results in the same order.
+
+        If there are more than `graphql_chunk_size` queries, they're split into chunks, which are sent concurrently
+        (over as many connections as the connection pool allows). Each chunk is retried on its own
 
         :raises: FBchatException if request failed
         """
+        results = self._graphqlChunks(self._chunkQueries(queries))
+        return tuple(result for chunk_results in results for result in chunk_results)
 
-        return tuple(self._graphql({
-            'method': 'GET',
-            'response_format': 'json',
-            'queries': graphql_queries_to_json(*queries)
-        }))
+    def graphql_requests_partial(self, *queries):
+        """
+        Like :func:`graphql_requests`, but queries that fail don't make the other queries fail
+
+        :return: Two dicts labeled by the index of the queries: The results of the queries that succeeded,
+            and the errors (:class:`models.FBchatFacebookError`) of the queries that failed
+        :rtype: tuple
+        :raises: FBchatException if request failed
+        """
+        chunks = self._chunkQueries(queries)
+        return self._mergePartialResults(chunks, self._graphqlChunks(chunks, partial=True))
+
+    def iter_graphql_requests(self, *queries):
+        """
+        Like :func:`graphql_requests`, but yields `(index, result)` tuples as soon as each result has been received,
+        instead of waiting for the whole response. `index` is the index of the query the result belongs to.
+
+        The request is sent when the iteration starts, and is only retried if it fails before the first result is yielded.
+        The queries are always sent in one request, regardless of `graphql_chunk_size`
+
+        :raises: FBchatException if request failed
+        """
+        url = self.req_url.GRAPHQL
+        payload = self._graphqlPayload(queries)
+
+        def request():
+            data = self._generatePayload(payload)
+            r = self._doRequest('POST', url, headers=self._header, data=data, timeout=30, stream=True)
+            try:
+                if not r.ok:
+                    raise FBchatFacebookError('Error when sending request: Got {} response'.format(r.status_code), request_status_code=r.status_code)
+                results = iter_graphql_response(self._iterContent(url, r))
+                # Reads until the first result, so errors like an expired session are retried
+                first = next(results, None)
+            except Exception:
+                r.close()
+                raise
+            return r, first, results
+
+        r, first, results = self._retry(url, request, method='POST')
+        try:
+            if first is not None:
+                yield first
+                for result in results:
+                    yield result
+        finally:
+            r.close()
+
+    def _createGraphQLBatcher(self, window):
+        return GraphQLBatcher(self.graphql_requests_partial, window=window)
 
     def graphql_request(self, query):
         """
-        Shorthand for `graphql_requests(query)[0]`
+        Shorthand for `graphql_requests(query)[0]`.
+        If `graphql_batch_window` is set, the query may be sent together with queries from other threads
 
         :raises: FBchatException if request failed
         """
+        if self.graphql_batcher is not None:
+            return self.graphql_batcher.request(query)
         return self.graphql_requests(query)[0]
 
     """
@@ -188,14 +627,14 @@ class Client(object):
     """
 
     def _resetValues(self):
-        self.payloadDefault={}
-        self._session = requests.session()
-        self.req_counter = 1
+        with self._state_lock:
+            self.payloadDefault = {}
+            self.req_counter = 1
+        self._session = self._createSession()
         self.seq = "0"
         self.uid = None
 
     def _postLogin(self):
-        self.payloadDefault = {}
         self.client_id = hex(int(random()*2147483648))[2:]
         self.start_time = now()
         self.uid = self._session.cookies.get_dict().get('c_user')
@@ -205,19 +644,23 @@ class Client(object):
         self.user_channel = "p_" + self.uid
         self.ttstamp = ''
 
-        r = self._get(self.req_url.BASE)
+        r = self._cleanGet(self.req_url.BASE)
         soup = bs(r.text, "lxml")
         self.fb_dtsg = soup.find("input", {'name':'fb_dtsg'})['value']
         self.fb_h = soup.find("input", {'name':'h'})['value']
         for i in self.fb_dtsg:
             self.ttstamp += str(ord(i))
         self.ttstamp += '2'
-        # Set default payload
-        self.payloadDefault['__rev'] = int(r.text.split('"client_revision":',1)[1].split(",",1)[0])
-        self.payloadDefault['__user'] = self.uid
-        self.payloadDefault['__a'] = '1'
-        self.payloadDefault['ttstamp'] = self.ttstamp
-        self.payloadDefault['fb_dtsg'] = self.fb_dtsg
+        # Set default payload. It's replaced in one go, so concurrent requests never see a half-built payload
+        payload_default = {}
+        payload_default['__rev'] = int(r.text.split('"client_revision":',1)[1].split(",",1)[0])
+        payload_default['__user'] = self.uid
+        payload_default['__a'] = '1'
+        payload_default['ttstamp'] = self.ttstamp
+        payload_default['fb_dtsg'] = self.fb_dtsg
+        with self._state_lock:
+            self.payloadDefault = payload_default
+            self._session_generation += 1
 
         self.form = {
             'channel' : self.user_channel,
@@ -239,7 +682,7 @@ class Client(object):
         if not (self.email and self.password):
             raise FBchatUserError("Email and password not found.")
 
-        soup = bs(self._get(self.req_url.MOBILE).text, "lxml")
+        soup = bs(self._cleanGet(self.req_url.MOBILE).text, "lxml")
         data = dict((elem['name'], elem['value']) for elem in soup.findAll("input") if elem.has_attr('value') and elem.has_attr('name'))
         data['email'] = self.email
         data['pass'] = self.password
@@ -468,6 +911,9 @@ class Client(object):
             'viewer': self.uid,
         }
         j = self._post(self.req_url.ALL_USERS, query=data, fix_request=True, as_json=True)
+        return self._parseAllUsers(j)
+
+    def _parseAllUsers(self, j):
         if j.get('payload') is None:
             raise FBchatException('Missing payload while fetching users: {}'.format(j))
 
@@ -483,10 +929,30 @@ class Client(object):
 
         return users
 
+    def refreshUserDirectory(self):
+        """
+        Updates :any:`Client.user_directory` with :func:`fetchAllUsers`, and saves it if it has a `path`
+
+        :return: The number of users that were added, changed and removed
+        :rtype: int
+        :raises: FBchatException if request failed
+        """
+        changed = self.user_directory.update(self.fetchAllUsers())
+        self._saveUserDirectory(changed)
+        return changed
+
+    def _saveUserDirectory(self, changed):
+        log.debug('{} users changed in the user directory'.format(changed))
+        if self.user_directory.path is not None:
+            self.user_directory.save()
+
     def searchForUsers(self, name, limit=1):
         """
         Find and get user by his/her name
 
+        If :any:`Client.user_directory` is set, it's searched first (and refreshed if it's stale),
+        and a request is only sent if no users are found there
+
         :param name: Name of the user
         :param limit: The max. amount of users to fetch
         :return: :class:`models.User` objects, ordered by relevance
@@ -494,6 +960,13 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
+        if self.user_directory is not None:
+            if self.user_directory.is_stale():
+                self.refreshUserDirectory()
+            users = self.user_directory.search(name, limit=limit)
+            if users:
+                return users
+
         j = self.graphql_request(GraphQL(query=GraphQL.SEARCH_USER, params={'search': name, 'limit': limit}))
 
         return [graphql_to_user(node) for node in j[name]['users']['nodes']]
@@ -541,8 +1014,11 @@ class Client(object):
 
         j = self.graphql_request(GraphQL(query=GraphQL.SEARCH_THREAD, params={'search': name, 'limit': limit}))
 
+        return self._parseSearchThreads(j[name]['threads']['nodes'])
+
+    def _parseSearchThreads(self, nodes):
         rtn = []
-        for node in j[name]['threads']['nodes']:
+        for node in nodes:
             if node['__typename'] == 'User':
                 rtn.append(graphql_to_user(node))
             elif node['__typename'] == 'MessageThread':
@@ -560,11 +1036,22 @@ class Client(object):
         return rtn
 
     def _fetchInfo(self, *ids):
-        data = {
+        entries, missing = self.profile_cache.get_many([str(_id) for _id in ids])
+        if missing:
+            j = self._post(self.req_url.INFO, self._infoData(missing), fix_request=True, as_json=True)
+            entries.update(self._cacheInfo(self._parseInfo(j)))
+        return entries
+
+    def _infoData(self, ids):
+        return {
             "ids[{}]".format(i): _id for i, _id in enumerate(ids)
         }
-        j = self._post(self.req_url.INFO, data, fix_request=True, as_json=True)
 
+    def _cacheInfo(self, entries):
+        self.profile_cache.set_many(entries)
+        return entries
+
+    def _parseInfo(self, j):
         if j.get('payload') is None or j['payload'].get('profiles') is None:
             raise FBchatException('No users/pages returned: {}'.format(j))
 
@@ -600,8 +1087,8 @@ class Client(object):
         """
         Get users' info from IDs, unordered
 
-        .. warning::
-            Sends two requests, to fetch all available info!
+        .. note::
+            Sends two requests concurrently, to fetch all available info
 
         :param user_ids: One or more user ID(s) to query
         :return: :class:`models.User` objects, labeled by their ID
@@ -609,22 +1096,15 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
-        threads = self.fetchThreadInfo(*user_ids)
-        users = {}
-        for k in threads:
-            if threads[k].type == ThreadType.USER:
-                users[k] = threads[k]
-            else:
-                raise FBchatUserError('Thread {} was not a user'.format(threads[k]))
-
-        return users
+        threads = self.fetchThreadInfo(*user_ids, thread_type=ThreadType.USER)
+        return self._filterThreads(threads, ThreadType.USER)
 
     def fetchPageInfo(self, *page_ids):
         """
         Get pages' info from IDs, unordered
 
-        .. warning::
-            Sends two requests, to fetch all available info!
+        .. note::
+            Sends two requests concurrently, to fetch all available info
 
         :param page_ids: One or more page ID(s) to query
         :return: :class:`models.Page` objects, labeled by their ID
@@ -632,15 +1112,8 @@ class Client(object):
         :raises: FBchatException if request failed
         """
 
-        threads = self.fetchThreadInfo(*page_ids)
-        pages = {}
-        for k in threads:
-            if threads[k].type == ThreadType.PAGE:
-                pages[k] = threads[k]
-            else:
-                raise FBchatUserError('Thread {} was not a page'.format(threads[k]))
-
-        return pages
+        threads = self.fetchThreadInfo(*page_ids, thread_type=ThreadType.PAGE)
+        return self._filterThreads(threads, ThreadType.PAGE)
 
     def fetchGroupInfo(self, *group_ids):
         """
@@ -653,40 +1126,110 @@ class Client(object):
         """
 
         threads = self.fetchThreadInfo(*group_ids)
-        groups = {}
+        return self._filterThreads(threads, ThreadType.GROUP)
+
+    def _filterThreads(self, threads, thread_type):
+        rtn = {}
         for k in threads:
-            if threads[k].type == ThreadType.GROUP:
-                groups[k] = threads[k]
+            if threads[k].type == thread_type:
+                rtn[k] = threads[k]
             else:
-                raise FBchatUserError('Thread {} was not a group'.format(threads[k]))
+                raise FBchatUserError('Thread {} was not a {}'.format(threads[k], thread_type.name.lower()))
 
-        return groups
+        return rtn
 
-    def fetchThreadInfo(self, *thread_ids):
+    def fetchThreadInfo(self, *thread_ids, **kwargs):
         """
         Get threads' info from IDs, unordered
 
         .. warning::
             Sends two requests if users or pages are present, to fetch all available info!
+            Use a `projection` other than `Projection.FULL` to only send one request
 
         :param thread_ids: One or more thread ID(s) to query
+        :param projection: A :class:`models.Projection`. With `Projection.IDS`, the threads only have their IDs.
+            With the other projections, user and page profiles aren't fetched, so one-to-one threads are :class:`models.User` objects
+            with only the info that's in the thread (even if they're pages)
+        :param thread_type: If the threads are known to be users or pages (`ThreadType.USER` or `ThreadType.PAGE`),
+            their profiles are fetched at the same time as the threads, instead of afterwards
         :return: :class:`models.Thread` objects, labeled by their ID
         :rtype: dict
+        :raises: FBchatPartialResultError if some of the threads could not be fetched. The ones that could are in its `results`
         :raises: FBchatException if request failed
         """
+        projection, thread_type = self._getThreadInfoOptions(kwargs)
+
+        queries = self._threadInfoQueries(thread_ids)
+        prefetch_ids = self._getPrefetchIds(thread_ids, projection, thread_type)
+        prefetched = {}
+        if prefetch_ids:
+            (results, errors), prefetched = self._runConcurrently([
+                lambda: self.graphql_requests_partial(*queries),
+                lambda: self._prefetchInfo(*prefetch_ids),
+            ], 2)
+        else:
+            results, errors = self.graphql_requests_partial(*queries)
+        fetched_ids, j = self._splitPartialResults(thread_ids, results)
+        pages_and_user_ids = self._getPagesAndUserIds(fetched_ids, j)
+        pages_and_users = {}
+        if len(pages_and_user_ids) != 0 and projection == Projection.FULL:
+            pages_and_users = self._fetchMissingInfo(pages_and_user_ids, prefetched)
 
+        rtn = self._parseThreadInfo(fetched_ids, j, pages_and_users, projection)
+        self._checkPartialResults(thread_ids, rtn, errors)
+        return rtn
+
+    def _getThreadInfoOptions(self, kwargs):
+        projection = kwargs.pop('projection', Projection.FULL)
+        thread_type = kwargs.pop('thread_type', None)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: {}'.format(', '.join(kwargs)))
+        return projection, thread_type
+
+    def _getPrefetchIds(self, thread_ids, projection, thread_type):
+        """Returns the IDs whose profiles can be fetched at the same time as the threads"""
+        if projection != Projection.FULL or thread_type not in (ThreadType.USER, ThreadType.PAGE):
+            return []
+        return [str(thread_id) for thread_id in thread_ids]
+
+    def _prefetchInfo(self, *ids):
+        # If the IDs weren't users or pages after all, they're fetched again after the threads, when their types are known
+        try:
+            return self._fetchInfo(*ids)
+        except FBchatException as e:
+            log.debug('Could not prefetch profiles of {}: {}'.format(', '.join(ids), e))
+            return {}
+
+    def _fetchMissingInfo(self, ids, prefetched):
+        missing = [_id for _id in ids if _id not in prefetched]
+        rtn = dict(prefetched)
+        if missing:
+            rtn.update(self._fetchInfo(*missing))
+        return rtn
+
+    def _splitPartialResults(self, ids, results):
+        """Returns the IDs that have a result, and their results"""
+        indexes = sorted(results)
+        return [ids[i] for i in indexes], [results[i] for i in indexes]
+
+    def _checkPartialResults(self, ids, rtn, errors):
+        if errors:
+            errors = dict((ids[i], error) for i, error in errors.items())
+            raise FBchatPartialResultError('Could not fetch {}: {}'.format(', '.join(str(k) for k in errors), errors[next(iter(errors))]), rtn, errors)
+
+    def _threadInfoQueries(self, thread_ids):
         queries = []
         for thread_id in thread_ids:
-            queries.append(GraphQL(doc_id='1386147188135407', params={
+            queries.append(GraphQL(doc_id=GraphQL.DOC_ID_THREAD_INFO, params={
                 'id': thread_id,
                 'message_limit': 0,
                 'load_messages': False,
                 'load_read_receipts': False,
                 'before': None
             }))
+        return queries
 
-        j = self.graphql_requests(*queries)
-
+    def _getPagesAndUserIds(self, thread_ids, j):
         for i, entry in enumerate(j):
             if entry.get('message_thread') is None:
                 # If you don't have an existing thread with this person, attempt to retrieve user data anyways
@@ -697,22 +1240,23 @@ class Client(object):
                     'thread_type': 'ONE_TO_ONE'
                 }
 
-        pages_and_user_ids = [k['message_thread']['thread_key']['other_user_id'] for k in j if k['message_thread'].get('thread_type') == 'ONE_TO_ONE']
-        pages_and_users = {}
-        if len(pages_and_user_ids) != 0:
-            pages_and_users = self._fetchInfo(*pages_and_user_ids)
+        return [k['message_thread']['thread_key']['other_user_id'] for k in j if k['message_thread'].get('thread_type') == 'ONE_TO_ONE']
 
+    def _parseThreadInfo(self, thread_ids, j, pages_and_users, projection=Projection.FULL):
         rtn = {}
         for i, entry in enumerate(j):
             entry = entry['message_thread']
             if entry.get('thread_type') == 'GROUP':
                 _id = entry['thread_key']['thread_fbid']
-                rtn[_id] = graphql_to_group(entry)
+                rtn[_id] = Group(_id) if projection == Projection.IDS else graphql_to_group(entry)
             elif entry.get('thread_type') == 'ROOM':
                 _id = entry['thread_key']['thread_fbid']
-                rtn[_id] = graphql_to_room(entry)
+                rtn[_id] = Room(_id) if projection == Projection.IDS else graphql_to_room(entry)
             elif entry.get('thread_type') == 'ONE_TO_ONE':
                 _id = entry['thread_key']['other_user_id']
+                if projection != Projection.FULL:
+                    rtn[_id] = User(_id) if projection == Projection.IDS else graphql_to_thread_user(entry)
+                    continue
                 if pages_and_users.get(_id) is None:
                     raise FBchatException('Could not fetch thread {}'.format(_id))
                 entry.update(pages_and_users[_id])
@@ -725,13 +1269,16 @@ class Client(object):
 
         return rtn
 
-    def fetchThreadMessages(self, thread_id=None, limit=20, before=None):
+    def fetchThreadMessages(self, thread_id=None, limit=20, before=None, lazy=False, projection=Projection.FULL):
         """
         Get the last messages in a thread
 
         :param thread_id: User/Group ID to get messages from. See :ref:`intro_threads`
         :param limit: Max. number of messages to retrieve
         :param before: A timestamp, indicating from which point to retrieve messages
+        :param lazy: If set, the messages are :class:`graphql.LazyMessage` objects, which only convert the attributes that are accessed.
+            Faster when only a few attributes of each message are needed
+        :param projection: A :class:`models.Projection`, the fields of the messages to convert. Ignored if `lazy` is set
         :type limit: int
         :type before: int
         :return: :class:`models.Message` objects
@@ -741,26 +1288,86 @@ class Client(object):
 
         thread_id, thread_type = self._getThread(thread_id, None)
 
-        j = self.graphql_request(GraphQL(doc_id='1386147188135407', params={
+        j = self.graphql_request(self._threadMessagesQuery(thread_id, limit, before))
+        return self._parseThreadMessages(thread_id, j, lazy=lazy, projection=projection)
+
+    def iterThreadMessages(self, thread_id=None, page_size=100, prefetch=2, before=None, oldest_first=False, lazy=False, projection=Projection.FULL):
+        """
+        Iterates over every message in a thread, fetching the pages with :func:`fetchThreadMessages`.
+        The next pages are fetched in the background, while the caller handles the current one
+
+        :param thread_id: User/Group ID to get messages from. See :ref:`intro_threads`
+        :param page_size: Number of messages to fetch per request
+        :param prefetch: Maximum number of pages to fetch ahead of the caller. If `0`, pages are fetched when they're needed
+        :param before: A timestamp, indicating from which point to start
+        :param oldest_first: If set, the messages are yielded from oldest to newest, instead of from newest to oldest.
+            Since pages are fetched going back in time, this fetches every page before yielding the first message
+        :param lazy: See :func:`fetchThreadMessages`
+        :param projection: See :func:`fetchThreadMessages`
+        :type page_size: int
+        :type prefetch: int
+        :type before: int
+        :type oldest_first: bool
+        :return: A generator of :class:`models.Message` objects
+        :raises: FBchatException if request failed
+        """
+        boundary = set()
+
+        def fetch_page(before):
+            messages = self.fetchThreadMessages(thread_id, limit=page_size, before=before, lazy=lazy, projection=projection)
+            return self._messagePage(messages, page_size, boundary)
+
+        messages = self._iterPrefetched(fetch_page, before, prefetch)
+        if oldest_first:
+            messages = reversed(list(messages))
+        for message in messages:
+            yield message
+
+    def _messagePage(self, messages, page_size, boundary):
+        """
+        Takes a page from :func:`fetchThreadMessages` (newest first), and returns the messages that weren't on the previous page,
+        and the `before` timestamp of the next page, or `None` after the last page.
+        `boundary` holds the IDs of the messages at the previous page's `before` timestamp, since pages overlap there
+        """
+        new = [message for message in messages if message.uid not in boundary]
+        if not new and len(messages) >= page_size:
+            # The next page would start at the same timestamp, and be the same again
+            log.warning('Stopped fetching messages at {}: More than {} messages had the same timestamp, so older messages were left out. Use a larger page size'.format(messages[-1].timestamp, page_size))
+        if not new or len(messages) < page_size or messages[-1].timestamp is None:
+            return new, None
+        before = messages[-1].timestamp
+        # If the whole page has the same timestamp, the next page starts at the same point, so the IDs are kept
+        if messages[0].timestamp != before:
+            boundary.clear()
+        boundary.update(message.uid for message in messages if message.timestamp == before)
+        return new, int(before)
+
+    def _threadMessagesQuery(self, thread_id, limit, before):
+        return GraphQL(doc_id=GraphQL.DOC_ID_THREAD_INFO, params={
             'id': thread_id,
             'message_limit': limit,
             'load_messages': True,
             'load_read_receipts': False,
             'before': before
-        }))
+        })
 
+    def _parseThreadMessages(self, thread_id, j, lazy=False, projection=Projection.FULL):
         if j.get('message_thread') is None:
             raise FBchatException('Could not fetch thread {}: {}'.format(thread_id, j))
 
-        return list(reversed([graphql_to_message(message) for message in j['message_thread']['messages']['nodes']]))
+        nodes = j['message_thread']['messages']['nodes']
+        if lazy:
+            return [LazyMessage(message) for message in reversed(nodes)]
+        return list(reversed(graphql_to_messages(nodes, projection=projection)))
 
-    def fetchThreadList(self, offset=None, limit=20, thread_location=ThreadLocation.INBOX, before=None):
+    def fetchThreadList(self, offset=None, limit=20, thread_location=ThreadLocation.INBOX, before=None, lazy=False):
         """Get thread list of your facebook account
 
         :param offset: Deprecated. Do not use!
         :param limit: Max. number of threads to retrieve. Capped at 20
         :param thread_location: models.ThreadLocation: INBOX, PENDING, ARCHIVED or OTHER
         :param before: A timestamp (in milliseconds), indicating from which point to retrieve threads
+        :param lazy: If set, the threads are :class:`graphql.LazyUser` and :class:`graphql.LazyGroup` objects, which only convert the attributes that are accessed
         :type limit: int
         :type before: int
         :return: :class:`models.Thread` objects
@@ -771,6 +1378,47 @@ class Client(object):
         if offset is not None:
             log.warning('Using `offset` in `fetchThreadList` is no longer supported, since Facebook migrated to the use of GraphQL in this request. Use `before` instead')
 
+        j = self.graphql_request(self._threadListQuery(limit, thread_location, before))
+        return [graphql_to_thread(node, lazy=lazy) for node in j['viewer']['message_threads']['nodes']]
+
+    def iterThreads(self, thread_location=ThreadLocation.INBOX, page_size=20, prefetch=2, before=None):
+        """
+        Iterates over every thread in a location, newest first, fetching the pages with :func:`fetchThreadList`.
+        The next pages are fetched in the background, while the caller handles the current one
+
+        :param thread_location: models.ThreadLocation: INBOX, PENDING, ARCHIVED or OTHER
+        :param page_size: Number of threads to fetch per request. Capped at 20
+        :param prefetch: Maximum number of pages to fetch ahead of the caller. If `0`, pages are fetched when they're needed
+        :param before: A timestamp (in milliseconds), indicating from which point to start
+        :type page_size: int
+        :type prefetch: int
+        :type before: int
+        :return: A generator of :class:`models.Thread` objects
+        :raises: FBchatException if request failed
+        """
+        seen = set()
+
+        def fetch_page(before):
+            return self._threadPage(self.fetchThreadList(limit=page_size, thread_location=thread_location, before=before), page_size, seen)
+
+        for thread in self._iterPrefetched(fetch_page, before, prefetch):
+            yield thread
+
+    def _threadPage(self, threads, page_size, seen):
+        """
+        Returns the threads that haven't been seen on previous pages (pages overlap at the `before` timestamp),
+        and the `before` timestamp of the next page, or `None` after the last page
+        """
+        new = [thread for thread in threads if thread.uid not in seen]
+        seen.update(thread.uid for thread in new)
+        if not new and len(threads) >= page_size:
+            # A whole page had the same timestamp as the previous one, so the next page would be the same again
+            log.warning('Stopped listing threads at {}: More than {} threads had the same timestamp, so older threads were left out'.format(threads[-1].last_message_timestamp, page_size))
+        if not new or len(threads) < page_size or threads[-1].last_message_timestamp is None:
+            return new, None
+        return new, int(threads[-1].last_message_timestamp)
+
+    def _threadListQuery(self, limit, thread_location, before):
         if limit > 20 or limit < 1:
             raise FBchatUserError('`limit` should be between 1 and 20')
 
@@ -779,15 +1427,13 @@ class Client(object):
         else:
             raise FBchatUserError('"thread_location" must be a value of ThreadLocation')
 
-        j = self.graphql_request(GraphQL(doc_id='1349387578499440', params={
+        return GraphQL(doc_id=GraphQL.DOC_ID_THREAD_LIST, params={
             'limit': limit,
             'tags': [loc_str],
             'before': before,
             'includeDeliveryReceipts': True,
             'includeSeqID': False
-        }))
-
-        return [graphql_to_thread(node) for node in j['viewer']['message_threads']['nodes']]
+        })
 
     def fetchUnread(self):
         """
@@ -813,20 +1459,71 @@ class Client(object):
     def fetchImageUrl(self, image_id):
         """Fetches the url to the original image from an image attachment ID
 
-        :param image_id: The image you want to fethc
+        :param image_id: The image you want to fetch
         :type image_id: str
         :return: An url where you can download the original image
         :rtype: str
-        :raises: FBChatException if request failed
+        :raises: FBchatException if request failed
         """
         image_id = str(image_id)
-        j = check_request(self._get(ReqUrl.ATTACHMENT_PHOTO, query={'photo_id': str(image_id)}))
+        return self.fetchImageUrls(image_id)[image_id]
+
+    def fetchImageUrls(self, *image_ids):
+        """
+        Fetches the urls to the original images from several image attachment IDs, concurrently.
+        The urls are cached in :any:`Client.image_url_cache` until shortly before they expire
+
+        :param image_ids: The images you want to fetch
+        :return: The urls where you can download the original images, labeled by image ID
+        :rtype: dict
+        :raises: FBchatException if request failed
+        """
+        image_ids = list(OrderedDict.fromkeys(str(image_id) for image_id in image_ids))
+        urls, missing = self.image_url_cache.get_many(image_ids)
+        if missing:
+            fetched = self._runConcurrently([
+                lambda image_id=image_id: self._tryFetchImageUrl(image_id) for image_id in missing
+            ], self._getPoolSize(ReqUrl.ATTACHMENT_PHOTO))
+            urls.update(self._cacheImageUrls(zip(missing, fetched)))
+        return urls
+
+    def _tryFetchImageUrl(self, image_id):
+        # Returns the error instead of raising it, so the other urls are still cached, see `_cacheImageUrls`
+        try:
+            return self._fetchImageUrl(image_id)
+        except Exception as e:
+            return e
+
+    def _fetchImageUrl(self, image_id):
+        j = self._get(ReqUrl.ATTACHMENT_PHOTO, query={'photo_id': image_id}, fix_request=True, as_json=True)
+        return self._parseImageUrl(j)
 
+    def _parseImageUrl(self, j):
         url = get_jsmods_require(j, 3)
         if url is None:
-            raise FBChatException('Could not fetch image url from: {}'.format(j))
+            raise FBchatException('Could not fetch image url from: {}'.format(j))
         return url
 
+    def _cacheImageUrls(self, fetched):
+        """
+        Caches the urls until a minute before they expire, and returns them as a dict.
+        `fetched` holds `(image ID, url)` tuples, where the url is an exception if it couldn't be fetched.
+        The first of those is raised after the other urls are cached
+        """
+        urls = {}
+        errors = []
+        now = time.time()
+        for image_id, url in fetched:
+            if isinstance(url, BaseException):
+                errors.append(url)
+                continue
+            urls[image_id] = url
+            expiry = get_url_expiry(url)
+            self.image_url_cache.set(image_id, url, ttl=None if expiry is None else expiry - now - 60)
+        if errors:
+            raise errors[0]
+        return urls
+
     """
     END FETCH METHODS
     """
@@ -888,7 +1585,9 @@ class Client(object):
     def _doSendRequest(self, data):
         """Sends the data to `SendURL`, and returns the message ID or None on failure"""
         j = self._post(self.req_url.SEND, data, fix_request=True, as_json=True)
+        return self._parseSendResponse(j)
 
+    def _parseSendResponse(self, j):
         try:
             message_ids = [action['message_id'] for action in j['payload']['actions'] if 'message_id' in action]
             if len(message_ids) != 1:
@@ -900,7 +1599,8 @@ class Client(object):
         # update JS token if received in response
         fb_dtsg = get_jsmods_require(j, 2)
         if fb_dtsg is not None:
-            self.payloadDefault['fb_dtsg'] = fb_dtsg
+            with self._state_lock:
+                self.payloadDefault['fb_dtsg'] = fb_dtsg
 
         return message_id
 
@@ -954,6 +1654,10 @@ class Client(object):
         Deprecated. Use :func:`fbchat.Client.send` instead
         """
         thread_id, thread_type = self._getThread(thread_id, thread_type)
+        data = self._getImageSendData(image_id, message=message, thread_id=thread_id, thread_type=thread_type, is_gif=is_gif)
+        return self._doSendRequest(data)
+
+    def _getImageSendData(self, image_id, message=None, thread_id=None, thread_type=ThreadType.USER, is_gif=False):
         data = self._getSendData(message=self._oldMessage(message), thread_id=thread_id, thread_type=thread_type)
 
         data['action_type'] = 'ma-type:user-generated-message'
@@ -964,7 +1668,7 @@ class Client(object):
         else:
             data['gif_ids[0]'] = image_id
 
-        return self._doSendRequest(data)
+        return data
 
     def sendRemoteImage(self, image_url, message=None, thread_id=None, thread_type=ThreadType.USER):
         """
@@ -1014,6 +1718,10 @@ class Client(object):
         :raises: FBchatException if request failed
         """
         thread_id, thread_type = self._getThread(thread_id, None)
+        data = self._getAddUsersData(user_ids, thread_id)
+        return self._doSendRequest(data)
+
+    def _getAddUsersData(self, user_ids, thread_id):
         data = self._getSendData(thread_id=thread_id, thread_type=ThreadType.GROUP)
 
         data['action_type'] = 'ma-type:log-message'
@@ -1031,7 +1739,7 @@ class Client(object):
             else:
                 data['log_message_data[added_participants][' + str(i) + ']'] = "fbid:" + str(user_id)
 
-        return self._doSendRequest(data)
+        return data
 
     def removeUserFromGroup(self, user_id, thread_id=None):
         """
@@ -1144,6 +1852,9 @@ class Client(object):
         :type reaction: models.MessageReaction
         :raises: FBchatException if request failed
         """
+        j = self._post(self._getReactionUrl(message_id, reaction), fix_request=True, as_json=True)
+
+    def _getReactionUrl(self, message_id, reaction):
         full_data = {
             "doc_id": 1491398900900362,
             "dpr": 1,
@@ -1165,7 +1876,7 @@ class Client(object):
                 .replace('u%27', '%27')\
                 .replace('%5CU{}'.format(MessageReactionFix[reaction.value][0]), MessageReactionFix[reaction.value][1])
 
-        j = self._post('{}/?{}'.format(self.req_url.MESSAGE_REACTION, url_part), fix_request=True, as_json=True)
+        return '{}/?{}'.format(self.req_url.MESSAGE_REACTION, url_part)
 
     def eventReminder(self, thread_id, time, title, location='', location_id=''):
         """
@@ -1184,6 +1895,9 @@ class Client(object):
         :param location_id: Event location ID
         :raises: FBchatException if request failed
         """
+        j = self._post(self._getEventReminderUrl(thread_id, time, title, location, location_id), fix_request=True, as_json=True)
+
+    def _getEventReminderUrl(self, thread_id, time, title, location, location_id):
         full_data = {
             "event_type": "EVENT",
             "dpr": 1,
@@ -1201,7 +1915,7 @@ class Client(object):
         }
         url_part = urllib.parse.urlencode(full_data)
 
-        j = self._post('{}/?{}'.format(self.req_url.EVENT_REMINDER, url_part), fix_request=True, as_json=True)
+        return '{}/?{}'.format(self.req_url.EVENT_REMINDER, url_part)
 
 
     def setTypingStatus(self, status, thread_id=None, thread_type=None):
@@ -1328,6 +2042,15 @@ class Client(object):
         self.seq = j.get('seq', '0')
         return j
 
+    def _handleMessage(self, content):
+        """Calls `_parseMessage` without a label, so the requests sent by the callbacks are labeled by the public methods they call, instead of `listen`"""
+        previous = getattr(self._local, 'caller', None)
+        self._local.caller = None
+        try:
+            self._parseMessage(content)
+        finally:
+            self._local.caller = previous
+
     def _parseMessage(self, content):
         """Get message and author name from content. May contain multiple messages in the content."""
 
@@ -1560,21 +2283,26 @@ class Client(object):
             if markAlive:
                 self._ping(self.sticky, self.pool)
             content = self._pullMessage(self.sticky, self.pool)
+            self._listen_failures = 0
             if content:
-                self._parseMessage(content)
+                start = time.time()
+                self._handleMessage(content)
+                self.metrics.observe('fbchat_callback_duration_seconds', time.time() - start)
         except KeyboardInterrupt:
             return False
         except requests.Timeout:
             pass
         except requests.ConnectionError:
-            # If the client has lost their internet connection, keep trying every 30 seconds
-            time.sleep(30)
+            # If the client has lost their internet connection, keep trying, waiting a bit longer each time (See `retry_policy`)
+            time.sleep(self.retry_policy.get_delay(self._listen_failures))
+            self._listen_failures += 1
         except FBchatFacebookError as e:
             # Fix 502 and 503 pull errors
             if e.request_status_code in [502, 503]:
                 self.req_url.change_pull_channel()
                 self.startListening()
-            else:
+            elif not self._fix_fb_errors(e.fb_error_code):
+                # Requests to the pull channels aren't retried, so an expired session is refreshed here
                 raise e
         except Exception as e:
             return self.onListenError(exception=e)
@@ -1873,3 +2601,6 @@ class Client(object):
     """
     END EVENTS
     """
+
+
+_label_methods(Client)
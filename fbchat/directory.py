@@ -0,0 +1,204 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import os
+import threading
+import unicodedata
+from collections import Counter
+from .models import *
+from .utils import *
+import time
+
+# The attributes of :class:`models.User`, which are compared by `UserDirectory.update` and stored by `UserDirectory.save`
+_fields = ('photo', 'name', 'last_message_timestamp', 'message_count', 'url', 'first_name', 'last_name', 'is_friend', 'gender', 'affinity', 'nickname', 'own_nickname', 'color', 'emoji')
+
+
+def normalize_name(name):
+    """Lowercases `name`, and removes accents, so e.g. `Åse` matches `ase`"""
+    name = unicodedata.normalize('NFKD', name or '')
+    return ''.join(c for c in name if not unicodedata.combining(c)).lower().strip()
+
+
+def _user_to_json(user):
+    data = {field: getattr(user, field) for field in _fields}
+    data['uid'] = user.uid
+    if data['color'] is not None:
+        data['color'] = data['color'].value
+    return data
+
+
+def _json_to_user(data):
+    data = dict(data)
+    if data.get('color') is not None:
+        data['color'] = ThreadColor(data['color'])
+    return User(**data)
+
+
+def _trigrams(text):
+    text = '  {} '.format(text)
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+class UserDirectory(object):
+    """
+    A local index of the users the client is chatting with, filled by :func:`Client.fetchAllUsers`.
+    Users can be looked up by ID, or searched by name with :func:`search`, without sending any requests.
+
+    Names are indexed by the prefixes of their words, and by trigrams for names with typos or missing spaces
+    """
+
+    def __init__(self, path=None, refresh_interval=3600, min_similarity=0.4):
+        """
+        :param path: If set, the directory is loaded from and saved to this file
+        :param refresh_interval: After how many seconds :func:`is_stale` returns `True`
+        :param min_similarity: The fraction of trigrams a name must share with a search to be returned, when no names start with the search
+        :type refresh_interval: float
+        :type min_similarity: float
+        """
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.min_similarity = min_similarity
+        self._users = {}
+        self._names = {}
+        self._prefixes = {}
+        self._trigrams = {}
+        # The number of trigrams in each name
+        self._sizes = {}
+        self._lock = threading.RLock()
+        #: When the directory was last updated, as a UNIX timestamp
+        self.updated_at = None
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, uid):
+        return str(uid) in self._users
+
+    def get(self, uid):
+        """Returns the :class:`models.User` with ID `uid`, or `None`"""
+        return self._users.get(str(uid))
+
+    def is_stale(self):
+        """Returns whether the directory is empty, or hasn't been updated for `refresh_interval` seconds"""
+        return self.updated_at is None or time.time() - self.updated_at > self.refresh_interval
+
+    def _index(self, uid, name):
+        self._names[uid] = name
+        for word in name.split():
+            for i in range(1, len(word) + 1):
+                self._prefixes.setdefault(word[:i], set()).add(uid)
+        trigrams = _trigrams(name)
+        self._sizes[uid] = len(trigrams)
+        for trigram in trigrams:
+            self._trigrams.setdefault(trigram, set()).add(uid)
+
+    def _unindex(self, uid):
+        name = self._names.pop(uid, None)
+        if name is None:
+            return
+        for word in name.split():
+            for i in range(1, len(word) + 1):
+                self._discard(self._prefixes, word[:i], uid)
+        del self._sizes[uid]
+        for trigram in _trigrams(name):
+            self._discard(self._trigrams, trigram, uid)
+
+    def _discard(self, index, key, uid):
+        uids = index.get(key)
+        if uids is not None:
+            uids.discard(uid)
+            if not uids:
+                del index[key]
+
+    def update(self, users, complete=True):
+        """
+        Adds or updates `users`. Only the users whose name changed are reindexed
+
+        :param users: :class:`models.User` objects, e.g. from :func:`Client.fetchAllUsers`
+        :param complete: Whether `users` are all the users, in which case the users that aren't in it are removed
+        :return: The number of users that were added, changed and removed
+        :rtype: int
+        """
+        changed = 0
+        with self._lock:
+            uids = set()
+            for user in users:
+                uid = str(user.uid)
+                uids.add(uid)
+                old = self._users.get(uid)
+                if old is not None and all(getattr(old, field) == getattr(user, field) for field in _fields):
+                    continue
+                changed += 1
+                self._users[uid] = user
+                name = normalize_name(user.name)
+                if self._names.get(uid) != name:
+                    self._unindex(uid)
+                    self._index(uid, name)
+            if complete:
+                for uid in set(self._users) - uids:
+                    changed += 1
+                    del self._users[uid]
+                    self._unindex(uid)
+            self.updated_at = time.time()
+        return changed
+
+    def search(self, name, limit=1):
+        """
+        Finds users by name. Users with words starting with every word of `name` are returned first,
+        and if there aren't any, the users with the most similar names
+
+        :param name: Name of the user
+        :param limit: The max. amount of users to return
+        :return: :class:`models.User` objects, ordered by relevance
+        :rtype: list
+        """
+        query = normalize_name(name)
+        if not query:
+            return []
+        with self._lock:
+            uids = None
+            for word in query.split():
+                matches = self._prefixes.get(word, set())
+                uids = matches if uids is None else uids & matches
+            if uids:
+                # Exact names first, then the shortest names, which the search matches most closely
+                ranked = sorted(uids, key=lambda uid: (self._names[uid] != query, len(self._names[uid]), self._names[uid]))
+            else:
+                trigrams = _trigrams(query)
+                scores = Counter()
+                for trigram in trigrams:
+                    scores.update(self._trigrams.get(trigram, ()))
+                # The similarity is at most `score / len(trigrams)`, so names with fewer shared trigrams can be skipped right away
+                min_score = self.min_similarity * len(trigrams)
+                similarities = {}
+                for uid, score in scores.items():
+                    if score < min_score:
+                        continue
+                    similarity = float(score) / (len(trigrams) + self._sizes[uid] - score)
+                    if similarity >= self.min_similarity:
+                        similarities[uid] = similarity
+                ranked = sorted(similarities, key=lambda uid: (-similarities[uid], self._names[uid]))
+            return [self._users[uid] for uid in ranked[:limit]]
+
+    def save(self, path=None):
+        """Saves the directory to `path`, or to the path it was created with"""
+        path = path or self.path
+        with self._lock:
+            data = {
+                'updated_at': self.updated_at,
+                'users': [_user_to_json(user) for user in self._users.values()],
+            }
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json_dumps(data).encode('utf-8'))
+        replace_file(path + '.tmp', path)
+
+    def load(self, path=None):
+        """Replaces the users with the ones saved in `path`, or in the path it was created with"""
+        path = path or self.path
+        with open(path, 'rb') as f:
+            data = json_loads(f.read())
+        with self._lock:
+            self.update([_json_to_user(user) for user in data['users']])
+            self.updated_at = data['updated_at']
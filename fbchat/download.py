@@ -0,0 +1,336 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Downloads attachments concurrently to an on-disk cache, see :class:`DownloadManager`
+"""
+
+from __future__ import unicode_literals
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from .client import *
+import time
+try:
+    from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+except ImportError:
+    from urlparse import urlparse, urlunparse, parse_qsl
+    from urllib import urlencode
+
+# Query parameters that sign CDN urls. They change every time a url is fetched, while the file stays the same
+_signature_params = re.compile(r'^(oh|oe|__gda__|_nc_\w+)$')
+
+
+def get_attachment_url(attachment):
+    """
+    Returns the url where an attachment can be downloaded, or `None` if it doesn't have one.
+    The url of the original image of an :class:`models.ImageAttachment` has to be fetched with :func:`Client.fetchImageUrl`,
+    so the url of its large preview is returned instead
+    """
+    if isinstance(attachment, (FileAttachment, AudioAttachment)):
+        return attachment.url
+    if isinstance(attachment, VideoAttachment):
+        return attachment.preview_url
+    if isinstance(attachment, ImageAttachment):
+        return attachment.large_preview_url
+    return None
+
+
+def _cache_key(url):
+    """Returns `url` without the parameters that sign it, so the same file is found under a freshly signed url"""
+    parts = urlparse(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _signature_params.match(k))
+    return urlunparse(parts._replace(query=urlencode(query), fragment=''))
+
+
+class _Download(object):
+    def __init__(self, url, path):
+        self.url = url
+        # The temporary file the parts are written to
+        self.path = path
+        self.size = None
+        self.downloaded = 0
+        self.parts = []
+        self.error = None
+
+
+class DownloadManager(object):
+    """
+    Downloads files concurrently, and keeps them in a directory named after the SHA-256 hash of their content.
+
+    Large files are split into parts of `part_size` bytes, which are downloaded in parallel with `Range` requests,
+    and written straight to disk. Urls that have been downloaded before aren't downloaded again, even when Facebook has signed them anew,
+    and files with the same content are only stored once.
+
+    Downloads are sent like the other requests of the client, so connections to the CDN are reused,
+    and they count towards its :class:`RateLimiter` and :class:`MetricsRegistry`, labeled by the host of the file. If `workers` is larger than 10,
+    raise the pool sizes of the CDN hosts with the `pool_sizes` argument of :class:`Client`
+    """
+
+    def __init__(self, client, directory, workers=4, part_size=4 * 2 ** 20, chunk_size=64 * 2 ** 10, timeout=60):
+        """
+        :param client: A logged in :class:`Client`
+        :param directory: The directory to store the files in. Created if it doesn't exist
+        :param workers: The number of parts to download concurrently
+        :param part_size: Files larger than this many bytes are downloaded in several parts
+        :param chunk_size: How many bytes are read from the network at a time
+        :param timeout: See `requests timeout <http://docs.python-requests.org/en/master/user/advanced/#timeouts>`_
+        :type workers: int
+        :type part_size: int
+        :type chunk_size: int
+        """
+        self.client = client
+        self.directory = directory
+        self.workers = workers
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        for path in (directory, self._path('tmp')):
+            self._makedirs(path)
+        self._index_path = self._path('index.json')
+        # The hash and size of the content of every url that has been downloaded, labeled by `_cache_key`
+        self._index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'rb') as f:
+                self._index = json_loads(f.read())
+        #: The number of files downloaded and found in the cache, and the bytes and seconds spent downloading
+        self.stats = {'files': 0, 'cached': 0, 'bytes': 0, 'seconds': 0.0}
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # Another thread might have created it
+            if not os.path.isdir(path):
+                raise
+
+    def get_path(self, sha256):
+        """Returns where the file with the SHA-256 hash `sha256` (in hex) is stored"""
+        return self._path('objects', sha256[:2], sha256)
+
+    def get_cached(self, url):
+        """Returns the path of the file downloaded from `url`, or `None` if it hasn't been downloaded"""
+        with self._lock:
+            entry = self._index.get(_cache_key(url))
+        if entry is not None and os.path.exists(self.get_path(entry['sha256'])):
+            return self.get_path(entry['sha256'])
+        return None
+
+    def on_progress(self, url, downloaded, size):
+        """
+        Called every time a chunk of a file has been written. Override this to report progress
+
+        :param url: The url of the file
+        :param downloaded: The number of bytes written so far
+        :param size: The size of the file, or `None` if the server didn't tell
+        """
+        pass
+
+    def get_stats(self):
+        """
+        Returns :any:`DownloadManager.stats`, and `bytes_per_second`, the average throughput
+
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        stats['bytes_per_second'] = stats['bytes'] / stats['seconds'] if stats['seconds'] else 0.0
+        return stats
+
+    def _progress(self, download, size):
+        with self._lock:
+            download.downloaded += size
+            self.stats['bytes'] += size
+            downloaded = download.downloaded
+        self.on_progress(download.url, downloaded, download.size)
+
+    def _fetch(self, download, start=0, end=None):
+        """
+        Writes the bytes from `start` to `end` (inclusive) to the file, or from `start` to the end of the file if `end` is `None`.
+        Returns the response, so the caller can read its headers
+        """
+        headers = dict(self.client._header)
+        headers['Range'] = 'bytes={}-{}'.format(start, '' if end is None else end)
+        # Every file has its own url, so the requests are labeled by the host instead
+        endpoint = get_host(download.url)
+
+        def request():
+            r = self.client._doRequest('GET', download.url, endpoint=endpoint, headers=headers, stream=True, timeout=self.timeout)
+            written = 0
+            try:
+                if r.status_code == 416:
+                    # The file is empty, so no range can be satisfied
+                    return r
+                if not r.ok:
+                    raise FBchatFacebookError('Error when downloading {}: Got {} response'.format(download.url, r.status_code), request_status_code=r.status_code)
+                if r.status_code != 206 and start > 0:
+                    raise FBchatException('The server stopped supporting ranges while downloading {}'.format(download.url))
+                with open(download.path, 'r+b') as f:
+                    f.seek(start)
+                    for chunk in self.client._iterContent(endpoint, r, chunk_size=self.chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+                        self._progress(download, len(chunk))
+            except Exception:
+                # The part is written again from the start when it's retried
+                self._progress(download, -written)
+                raise
+            finally:
+                r.close()
+            return r
+        return self.client._retry(endpoint, request)
+
+    def _fetch_first(self, download):
+        """
+        Downloads the first part of a file. The response tells the size of the file, and whether the server supports ranges,
+        and the other parts are added to `download.parts`
+        """
+        r = self._fetch(download, 0, self.part_size - 1)
+        if r.status_code == 416:
+            download.size = 0
+        elif r.status_code == 206 and r.headers.get('Content-Range', '').rsplit('/', 1)[-1].isdigit():
+            # Content-Range looks like "bytes 0-1023/4096"
+            download.size = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+            download.parts = [(start, min(start + self.part_size, download.size) - 1) for start in range(self.part_size, download.size, self.part_size)]
+        else:
+            # The server sent the whole file, or didn't tell its size (Content-Range looks like "bytes 0-1023/*").
+            # In that case, a full first part means there might be more, which is fetched in one go, since it can't be split up
+            if r.status_code == 206 and download.downloaded >= self.part_size:
+                self._fetch(download, self.part_size)
+            download.size = download.downloaded
+
+    def _store(self, download):
+        """Checks the size of a finished file, and moves it to the path of its hash"""
+        with open(download.path, 'r+b') as f:
+            f.truncate(download.size)
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                sha256.update(chunk)
+        if download.downloaded != download.size:
+            raise FBchatException('Downloaded {} bytes from {}, but expected {}'.format(download.downloaded, download.url, download.size))
+        sha256 = sha256.hexdigest()
+        path = self.get_path(sha256)
+        if os.path.exists(path):
+            # Another url had the same content
+            os.remove(download.path)
+        else:
+            self._makedirs(os.path.dirname(path))
+            replace_file(download.path, path)
+        with self._lock:
+            self._index[_cache_key(download.url)] = {'sha256': sha256, 'size': download.size}
+        return path
+
+    def _attempt(self, download, func, *args):
+        """Calls `func`, unless an earlier step of the download failed, and stores the error if it fails"""
+        if download.error is not None:
+            return None
+        try:
+            return func(download, *args)
+        except Exception as e:
+            download.error = e
+            return None
+
+    def _save_index(self):
+        with self._lock:
+            data = json_dumps(self._index).encode('utf-8')
+        with open(self._index_path + '.tmp', 'wb') as f:
+            f.write(data)
+        replace_file(self._index_path + '.tmp', self._index_path)
+
+    def download(self, url):
+        """
+        Downloads `url`, unless it has been downloaded before
+
+        :return: The path of the file
+        :rtype: str
+        :raises: FBchatException if the download failed
+        """
+        return self.download_many([url])[url]
+
+    def download_many(self, urls):
+        """
+        Downloads several urls concurrently, skipping the ones that have been downloaded before.
+        If a download fails, the others are still finished, and the first error is raised at the end
+
+        :param urls: The urls to download
+        :return: The paths of the files, labeled by url
+        :rtype: dict
+        :raises: FBchatException if a download failed
+        """
+        paths = {}
+        downloads = []
+        for url in OrderedDict.fromkeys(urls):
+            path = self.get_cached(url)
+            if path is not None:
+                paths[url] = path
+                continue
+            fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=self._path('tmp'))
+            os.close(fd)
+            downloads.append(_Download(url, tmp_path))
+        with self._lock:
+            self.stats['cached'] += len(paths)
+        if not downloads:
+            return paths
+
+        start = time.time()
+        try:
+            # The first part of every file is fetched first, since the number of parts isn't known until then
+            self.client._runConcurrently([
+                lambda d=d: self._attempt(d, self._fetch_first) for d in downloads
+            ], self.workers)
+            self.client._runConcurrently([
+                lambda d=d, part=part: self._attempt(d, self._fetch, *part) for d in downloads for part in d.parts
+            ], self.workers)
+            stored = self.client._runConcurrently([
+                lambda d=d: self._attempt(d, self._store) for d in downloads
+            ], self.workers)
+        finally:
+            for d in downloads:
+                if os.path.exists(d.path):
+                    os.remove(d.path)
+            with self._lock:
+                self.stats['seconds'] += time.time() - start
+
+        self._save_index()
+        done = [(d, path) for d, path in zip(downloads, stored) if d.error is None]
+        size = sum(d.size for d, path in done)
+        with self._lock:
+            self.stats['files'] += len(done)
+        self.client.metrics.inc('fbchat_downloads_total', len(done))
+        self.client.metrics.inc('fbchat_download_bytes_total', size)
+        log.info('Downloaded {} files ({} bytes) in {:.2f} seconds'.format(len(done), size, time.time() - start))
+        paths.update((d.url, path) for d, path in done)
+
+        for d in downloads:
+            if d.error is not None:
+                raise d.error
+        return paths
+
+    def download_attachments(self, attachments):
+        """
+        Downloads several attachments concurrently. Images are downloaded in their original size,
+        and the urls of the other attachments are found with :func:`get_attachment_url`.
+        Attachments without a url are left out
+
+        :param attachments: :class:`models.Attachment` objects, e.g. from :any:`Message.attachments`
+        :return: The paths of the files, labeled by attachment ID
+        :rtype: dict
+        :raises: FBchatException if request or download failed
+        """
+        image_ids = [attachment.uid for attachment in attachments if isinstance(attachment, ImageAttachment) and attachment.uid]
+        image_urls = self.client.fetchImageUrls(*image_ids) if image_ids else {}
+        urls = {}
+        for attachment in attachments:
+            url = None
+            if isinstance(attachment, ImageAttachment):
+                url = image_urls.get(str(attachment.uid))
+            url = url or get_attachment_url(attachment)
+            if url:
+                urls[attachment.uid] = url
+        paths = self.download_many(urls.values())
+        return {uid: paths[url] for uid, url in urls.items()}
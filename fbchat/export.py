@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+
+"""
+Exports the threads and messages of an account to a directory, see :class:`Exporter`.
+Run ``fbchat-export --help`` for the console version
+"""
+
+from __future__ import unicode_literals
+import argparse
+import gzip
+import os
+import threading
+from getpass import getpass
+from .client import *
+
+
+def _thread_view(node):
+    """Wraps a thread from `fetchThreadList`, so its ID and timestamp can be read without converting the rest"""
+    if node.get('thread_type') == 'ONE_TO_ONE':
+        return LazyUser(node)
+    return LazyGroup(node)
+
+
+class Exporter(object):
+    """
+    Exports every thread in the given locations, and every message in those threads, to a directory.
+
+    Threads are written to `threads-<LOCATION>.jsonl.gz`, and the messages of each thread (newest first)
+    to `messages/<thread ID>.jsonl.gz`. Every line is an object returned by Facebook's GraphQL API, as is.
+    After every page, the cursor of the thread is saved next to its file, so an interrupted export resumes where it stopped
+    """
+
+    def __init__(self, client, directory, locations=None, workers=4, page_size=100, requests_per_second=None):
+        """
+        :param client: A logged in :class:`Client`
+        :param directory: The directory to write to. Created if it doesn't exist
+        :param locations: The :class:`models.ThreadLocation` to export. Defaults to all of them
+        :param workers: The number of threads to export concurrently
+        :param page_size: The number of messages to fetch per request. Threads are listed at most 20 at a time
+        :param requests_per_second: If set, the GraphQL requests of all the workers are limited to this rate.
+            The limit only applies to this exporter, and comes on top of the limits of `client.rate_limiter`
+        :type workers: int
+        :type page_size: int
+        :type requests_per_second: float
+        """
+        self.client = client
+        self.directory = directory
+        self.locations = list(locations or ThreadLocation)
+        self.workers = workers
+        self.page_size = page_size
+        #: The :class:`RateLimiter` of this exporter's requests
+        self.rate_limiter = RateLimiter()
+        if requests_per_second is not None:
+            self.rate_limiter.set_limit(client.req_url.GRAPHQL, requests_per_second, burst=workers)
+        self._lock = threading.Lock()
+        #: The number of threads and messages written by this exporter
+        self.stats = {'threads': 0, 'messages': 0}
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def _load_checkpoint(self, path, default):
+        if not os.path.exists(path):
+            return default
+        with open(path, 'rb') as f:
+            return json_loads(f.read())
+
+    def _save_checkpoint(self, path, checkpoint):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(json_dumps(checkpoint).encode('utf-8'))
+        replace_file(path + '.tmp', path)
+
+    def _truncate(self, path, size):
+        """Removes anything written after the last checkpoint, so a page isn't written twice when resuming"""
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+    def _write(self, path, objs):
+        """Appends `objs` as a gzip member, and returns the new size of the file"""
+        if not objs:
+            return os.path.getsize(path) if os.path.exists(path) else 0
+        with gzip.open(path, 'ab') as f:
+            for obj in objs:
+                f.write(json_dumps(obj).encode('utf-8') + b'\n')
+        return os.path.getsize(path)
+
+    def _count(self, key, n):
+        with self._lock:
+            self.stats[key] += n
+
+    def export_threads(self, location):
+        """
+        Writes every thread in `location` to `threads-<LOCATION>.jsonl.gz`
+
+        :return: The IDs of the threads
+        :rtype: list
+        :raises: FBchatException if request failed
+        """
+        path = self._path('threads-{}.jsonl.gz'.format(location.name))
+        checkpoint_path = self._path('threads-{}.json'.format(location.name))
+        checkpoint = self._load_checkpoint(checkpoint_path, {'before': None, 'size': 0, 'thread_ids': [], 'done': False})
+        if checkpoint['done']:
+            return checkpoint['thread_ids']
+        self._truncate(path, checkpoint['size'])
+        seen = set(checkpoint['thread_ids'])
+        # Facebook lists at most 20 threads at a time
+        page_size = min(self.page_size, 20)
+
+        while True:
+            self.rate_limiter.acquire(self.client.req_url.GRAPHQL)
+            j = self.client.graphql_request(self.client._threadListQuery(page_size, location, checkpoint['before']))
+            threads = [_thread_view(node) for node in j['viewer']['message_threads']['nodes']]
+            new, before = self.client._threadPage(threads, page_size, seen)
+            checkpoint['size'] = self._write(path, [thread._graphql for thread in new])
+            checkpoint['thread_ids'].extend(thread.uid for thread in new)
+            checkpoint['before'] = before
+            checkpoint['done'] = before is None
+            self._save_checkpoint(checkpoint_path, checkpoint)
+            self._count('threads', len(new))
+            if checkpoint['done']:
+                log.info('Listed {} threads in {}'.format(len(checkpoint['thread_ids']), location.name))
+                return checkpoint['thread_ids']
+
+    def export_messages(self, thread_id):
+        """
+        Writes every message in a thread to `messages/<thread ID>.jsonl.gz`, newest first
+
+        :raises: FBchatException if request failed
+        """
+        path = self._path('messages', '{}.jsonl.gz'.format(thread_id))
+        checkpoint_path = self._path('messages', '{}.json'.format(thread_id))
+        checkpoint = self._load_checkpoint(checkpoint_path, {'before': None, 'boundary': [], 'size': 0, 'count': 0, 'done': False})
+        if checkpoint['done']:
+            return
+        self._truncate(path, checkpoint['size'])
+        boundary = set(checkpoint['boundary'])
+
+        while True:
+            self.rate_limiter.acquire(self.client.req_url.GRAPHQL)
+            messages = self.client.fetchThreadMessages(thread_id, limit=self.page_size, before=checkpoint['before'], lazy=True)
+            new, before = self.client._messagePage(messages, self.page_size, boundary)
+            checkpoint['size'] = self._write(path, [message._graphql for message in new])
+            checkpoint['count'] += len(new)
+            checkpoint['before'] = before
+            checkpoint['boundary'] = list(boundary)
+            checkpoint['done'] = before is None
+            self._save_checkpoint(checkpoint_path, checkpoint)
+            self._count('messages', len(new))
+            if checkpoint['done']:
+                log.info('Exported {} messages from thread {}'.format(checkpoint['count'], thread_id))
+                return
+
+    def run(self):
+        """
+        Exports the threads in every location, and then their messages, `workers` threads at a time.
+        If a thread fails, the others are still exported, and the first error is raised at the end.
+        Running it again resumes the threads that weren't finished
+
+        :return: The number of threads and messages written, see :any:`Exporter.stats`
+        :rtype: dict
+        :raises: FBchatException if request failed
+        """
+        for directory in (self.directory, self._path('messages')):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        thread_ids = []
+        seen = set()
+        for ids in self.client._runConcurrently([
+            lambda location=location: self.export_threads(location) for location in self.locations
+        ], self.workers):
+            thread_ids.extend(_id for _id in ids if _id not in seen)
+            seen.update(ids)
+
+        self.client._runConcurrently([
+            lambda thread_id=thread_id: self.export_messages(thread_id) for thread_id in thread_ids
+        ], self.workers)
+        return dict(self.stats)
+
+
+def main(argv=None):
+    """The `fbchat-export` console command"""
+    parser = argparse.ArgumentParser(description='Exports the threads and messages of a Facebook account as compressed JSON Lines. '
+                                                 'Running it again with the same directory resumes an interrupted export')
+    parser.add_argument('email', help='Facebook email, id or phone number')
+    parser.add_argument('directory', help='The directory to write to')
+    parser.add_argument('--locations', nargs='+', choices=[location.name for location in ThreadLocation], help='The thread locations to export. Defaults to all of them')
+    parser.add_argument('--workers', type=int, default=4, help='The number of threads to export concurrently. Defaults to 4')
+    parser.add_argument('--page-size', type=int, default=100, help='The number of messages to fetch per request. Defaults to 100')
+    parser.add_argument('--rate', type=float, help='The maximum number of requests per second')
+    parser.add_argument('--cookies', help='A file to load the session cookies from, and save them to, so the export can resume without logging in again')
+    args = parser.parse_args(argv)
+
+    session_cookies = None
+    if args.cookies and os.path.exists(args.cookies):
+        with open(args.cookies, 'rb') as f:
+            session_cookies = json_loads(f.read())
+    password = None if session_cookies else getpass()
+    client = Client(args.email, password, session_cookies=session_cookies, pool_sizes={urlparse(ReqUrl.GRAPHQL).netloc: args.workers})
+    if args.cookies:
+        with open(args.cookies, 'wb') as f:
+            f.write(json_dumps(client.getSession()).encode('utf-8'))
+
+    locations = [ThreadLocation[name] for name in args.locations] if args.locations else None
+    exporter = Exporter(client, args.directory, locations=locations, workers=args.workers, page_size=args.page_size, requests_per_second=args.rate)
+    stats = exporter.run()
+    log.info('Exported {threads} threads and {messages} messages to {}'.format(args.directory, **stats))
+
+
+if __name__ == '__main__':
+    main()
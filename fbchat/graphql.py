@@ -11,11 +11,11 @@ FLAGS = re.VERBOSE | re.MULTILINE | re.DOTALL
 WHITESPACE = re.compile(r'[ \t\n\r]*', FLAGS)
 
 class ConcatJSONDecoder(json.JSONDecoder):
-    def decode(self, s, _w=WHITESPACE.match):
+    def decode(self, s, _w=WHITESPACE.match, idx=0):
         s_len = len(s)
 
         objs = []
-        end = 0
+        end = idx
         while end != s_len:
             obj, end = self.raw_decode(s, idx=_w(s, end).end())
             end = _w(s, end).end()
@@ -23,6 +23,76 @@ class ConcatJSONDecoder(json.JSONDecoder):
         return objs
 # End shameless copy
 
+_concat_json_decoder = ConcatJSONDecoder()
+
+class ConcatJSONStreamDecoder(object):
+    """
+    Incrementally decodes JSON objects that follow each other, like the responses from `graphqlbatch`.
+    Feed it chunks of the response (`str` or `bytes`), and it returns the objects as soon as they're complete.
+
+    The objects are usually separated by newlines, so complete lines are parsed one by one.
+    If they're not, the rest of the response is parsed by :class:`ConcatJSONDecoder` when the decoder is closed
+    """
+
+    def __init__(self):
+        # Chunks of the line that's currently being received
+        self._parts = []
+        # Whether the start of the first object has been found. Anything before it (like ``for (;;);``) is skipped
+        self._started = False
+        # The rest of the response, if it couldn't be parsed line by line
+        self._fallback = None
+
+    def feed(self, chunk):
+        """Adds `chunk` to the data that has been received, and returns a list of the objects that were completed by it"""
+        if not self._started:
+            try:
+                chunk = chunk[find_json_start(chunk):]
+            except FBchatException:
+                return []
+            self._started = True
+        newline = b'\n' if isinstance(chunk, bytes) else '\n'
+        last = chunk.rfind(newline)
+        if last == -1:
+            self._parts.append(chunk)
+            return []
+        lines = chunk[:last]
+        if self._parts:
+            lines = chunk[:0].join(self._parts) + lines
+        self._parts = [chunk[last + 1:]]
+        return self._parse(lines.split(newline))
+
+    def close(self):
+        """
+        Parses the rest of the data, and returns a list of the remaining objects
+
+        :raises: ValueError if the data is not valid JSON
+        """
+        if not self._started:
+            raise ValueError('No JSON object found')
+        rtn = self._parse([self._parts[0][:0].join(self._parts)] if self._parts else [])
+        self._parts = []
+        if self._fallback:
+            text = self._fallback[0][:0].join(self._fallback)
+            if isinstance(text, bytes):
+                text = get_decoded(text)
+            rtn.extend(_concat_json_decoder.decode(text))
+            self._fallback = None
+        return rtn
+
+    def _parse(self, lines):
+        rtn = []
+        for line in lines:
+            if self._fallback is None:
+                if not line.strip():
+                    continue
+                try:
+                    rtn.append(json_loads(line))
+                    continue
+                except ValueError:
+                    self._fallback = []
+            self._fallback.append(line + (b'\n' if isinstance(line, bytes) else '\n'))
+        return rtn
+
 def graphql_color_to_enum(color):
     if color is None:
         return None
@@ -128,7 +198,12 @@ def graphql_to_attachment(a):
             uid=a.get('legacy_attachment_id')
         )
 
-def graphql_to_message(message):
+def graphql_to_message(message, lazy=False):
+    """
+    :param lazy: If set, a :class:`LazyMessage` is returned, which converts the attributes when they're first accessed
+    """
+    if lazy:
+        return LazyMessage(message)
     if message.get('message_sender') is None:
         message['message_sender'] = {}
     if message.get('message') is None:
@@ -151,6 +226,70 @@ def graphql_to_message(message):
     # message.get('extensible_attachment')
     return rtn
 
+# Lookup tables for `graphql_to_messages`
+_reactions = {reaction.value: reaction for reaction in MessageReaction}
+_emoji_size_tags = {'hot_emoji_size:{}'.format(key): size for key, size in LIKES.items()}
+
+def _graphql_to_reaction(reaction):
+    try:
+        return _reactions[reaction]
+    except KeyError:
+        return MessageReaction(reaction)
+
+def _tags_to_emojisize(tags):
+    if not tags:
+        return None
+    for tag in tags:
+        if tag.startswith('hot_emoji_size:'):
+            if tag in _emoji_size_tags:
+                return _emoji_size_tags[tag]
+            # Logs the unknown size
+            return get_emojisize_from_tags(tags)
+    return None
+
+def graphql_to_messages(messages, projection=Projection.FULL):
+    """
+    Converts a list of messages returned by GraphQL, like :func:`graphql_to_message` does for one message,
+    but faster, and without modifying the messages
+
+    :param projection: A :class:`models.Projection`. The fields that aren't part of it are left at their default values
+    :rtype: list
+    """
+    text = projection != Projection.IDS
+    metadata = projection in (Projection.METADATA, Projection.FULL)
+    full = projection == Projection.FULL
+    rtn = []
+    append = rtn.append
+    empty = {}
+    for message in messages:
+        msg = Message()
+        msg.uid = str(message.get('message_id'))
+        msg.author = str((message.get('message_sender') or empty).get('id'))
+        msg.timestamp = message.get('timestamp_precise')
+        if text:
+            _message = message.get('message') or empty
+            msg.text = _message.get('text')
+            ranges = _message.get('ranges')
+            if ranges:
+                msg.mentions = [Mention(m.get('entity', empty).get('id'), offset=m.get('offset'), length=m.get('length')) for m in ranges]
+        if metadata:
+            msg.emoji_size = _tags_to_emojisize(message.get('tags_list'))
+            unread = message.get('unread')
+            if unread is not None:
+                msg.is_read = not unread
+            reactions = message.get('message_reactions')
+            if reactions:
+                msg.reactions = {str(r['user']['id']): _graphql_to_reaction(r['reaction']) for r in reactions}
+        if full:
+            sticker = message.get('sticker')
+            if sticker:
+                msg.sticker = graphql_to_sticker(sticker)
+            attachments = message.get('blob_attachments')
+            if attachments:
+                msg.attachments = [graphql_to_attachment(attachment) for attachment in attachments]
+        append(msg)
+    return rtn
+
 def graphql_to_user(user):
     if user.get('profile_picture') is None:
         user['profile_picture'] = {}
@@ -172,10 +311,15 @@ def graphql_to_user(user):
         message_count=user.get('messages_count')
     )
 
-def graphql_to_thread(thread):
+def graphql_to_thread(thread, lazy=False):
+    """
+    :param lazy: If set, a :class:`LazyUser` or :class:`LazyGroup` is returned, which converts the attributes when they're first accessed
+    """
     if thread['thread_type'] == 'GROUP':
-        return graphql_to_group(thread)
+        return graphql_to_group(thread, lazy=lazy)
     elif thread['thread_type'] == 'ONE_TO_ONE':
+        if lazy:
+            return LazyUser(thread)
         if thread.get('big_image_src') is None:
             thread['big_image_src'] = {}
         c_info = get_customization_info(thread)
@@ -205,7 +349,12 @@ def graphql_to_thread(thread):
     else:
         raise FBchatException('Unknown thread type: {}, with data: {}'.format(thread.get('thread_type'), thread))
 
-def graphql_to_group(group):
+def graphql_to_group(group, lazy=False):
+    """
+    :param lazy: If set, a :class:`LazyGroup` is returned, which converts the attributes when they're first accessed
+    """
+    if lazy:
+        return LazyGroup(group)
     if group.get('image') is None:
         group['image'] = {}
     c_info = get_customization_info(group)
@@ -259,50 +408,362 @@ def graphql_to_page(page):
         message_count=page.get('messages_count')
     )
 
+class LazyMessage(Message):
+    """
+    A :class:`models.Message` that wraps the message returned by GraphQL,
+    and only converts each attribute when it's first accessed. See :func:`graphql_to_message`
+    """
+
+    def __init__(self, message):
+        self._graphql = message
+
+    @lazy_property
+    def _message(self):
+        return self._graphql.get('message') or {}
+
+    @lazy_property
+    def text(self):
+        return self._message.get('text')
+
+    @lazy_property
+    def mentions(self):
+        return [Mention(m.get('entity', {}).get('id'), offset=m.get('offset'), length=m.get('length')) for m in self._message.get('ranges', [])]
+
+    @lazy_property
+    def emoji_size(self):
+        return get_emojisize_from_tags(self._graphql.get('tags_list'))
+
+    @lazy_property
+    def sticker(self):
+        return graphql_to_sticker(self._graphql.get('sticker'))
+
+    @lazy_property
+    def uid(self):
+        return str(self._graphql.get('message_id'))
+
+    @lazy_property
+    def author(self):
+        return str((self._graphql.get('message_sender') or {}).get('id'))
+
+    @lazy_property
+    def timestamp(self):
+        return self._graphql.get('timestamp_precise')
+
+    @lazy_property
+    def is_read(self):
+        if self._graphql.get('unread') is None:
+            return None
+        return not self._graphql['unread']
+
+    @lazy_property
+    def reactions(self):
+        return {str(r['user']['id']):MessageReaction(r['reaction']) for r in self._graphql.get('message_reactions') or []}
+
+    @lazy_property
+    def attachments(self):
+        return [graphql_to_attachment(attachment) for attachment in self._graphql.get('blob_attachments') or []]
+
+def _last_message_timestamp(thread):
+    if 'last_message' in thread:
+        return thread['last_message']['nodes'][0]['timestamp_precise']
+    return None
+
+class LazyUser(User):
+    """
+    A :class:`models.User` that wraps a `ONE_TO_ONE` thread returned by GraphQL,
+    and only converts each attribute when it's first accessed. See :func:`graphql_to_thread`
+    """
+    type = ThreadType.USER
+
+    def __init__(self, thread):
+        self._graphql = thread
+
+    @lazy_property
+    def _user(self):
+        participants = [node['messaging_actor'] for node in self._graphql['all_participants']['nodes']]
+        return next(p for p in participants if p['id'] == self._graphql['thread_key']['other_user_id'])
+
+    @lazy_property
+    def _customization_info(self):
+        return get_customization_info(self._graphql)
+
+    @lazy_property
+    def uid(self):
+        return str(self._user['id'])
+
+    @lazy_property
+    def url(self):
+        return self._user.get('url')
+
+    @lazy_property
+    def name(self):
+        return self._user.get('name')
+
+    @lazy_property
+    def first_name(self):
+        return self._user.get('short_name')
+
+    @lazy_property
+    def last_name(self):
+        return self._user.get('name').split(self._user.get('short_name'),1)[1].strip()
+
+    @lazy_property
+    def is_friend(self):
+        return self._user.get('is_viewer_friend')
+
+    @lazy_property
+    def gender(self):
+        return GENDERS.get(self._user.get('gender'))
+
+    @lazy_property
+    def affinity(self):
+        return self._user.get('affinity')
+
+    @lazy_property
+    def nickname(self):
+        return self._customization_info.get('nickname')
+
+    @lazy_property
+    def color(self):
+        return self._customization_info.get('color')
+
+    @lazy_property
+    def emoji(self):
+        return self._customization_info.get('emoji')
+
+    @lazy_property
+    def own_nickname(self):
+        return self._customization_info.get('own_nickname')
+
+    @lazy_property
+    def photo(self):
+        return (self._user.get('big_image_src') or {}).get('uri')
+
+    @lazy_property
+    def message_count(self):
+        return self._graphql.get('messages_count')
+
+    @lazy_property
+    def last_message_timestamp(self):
+        return _last_message_timestamp(self._graphql)
+
+class LazyGroup(Group):
+    """
+    A :class:`models.Group` that wraps a group returned by GraphQL,
+    and only converts each attribute when it's first accessed. See :func:`graphql_to_group`
+    """
+    type = ThreadType.GROUP
+
+    def __init__(self, group):
+        self._graphql = group
+
+    @lazy_property
+    def _customization_info(self):
+        return get_customization_info(self._graphql)
+
+    @lazy_property
+    def uid(self):
+        return str(self._graphql['thread_key']['thread_fbid'])
+
+    @lazy_property
+    def participants(self):
+        return set([node['messaging_actor']['id'] for node in self._graphql['all_participants']['nodes']])
+
+    @lazy_property
+    def nicknames(self):
+        return self._customization_info.get('nicknames')
+
+    @lazy_property
+    def color(self):
+        return self._customization_info.get('color')
+
+    @lazy_property
+    def emoji(self):
+        return self._customization_info.get('emoji')
+
+    @lazy_property
+    def photo(self):
+        return (self._graphql.get('image') or {}).get('uri')
+
+    @lazy_property
+    def name(self):
+        return self._graphql.get('name')
+
+    @lazy_property
+    def message_count(self):
+        return self._graphql.get('messages_count')
+
+    @lazy_property
+    def last_message_timestamp(self):
+        return _last_message_timestamp(self._graphql)
+
+def graphql_to_thread_user(thread):
+    """Converts a `ONE_TO_ONE` thread to a :class:`models.User`, with only the info in the thread, and not the user's profile"""
+    c_info = get_customization_info(thread)
+    return User(
+        thread['thread_key']['other_user_id'],
+        nickname=c_info.get('nickname'),
+        own_nickname=c_info.get('own_nickname'),
+        color=c_info.get('color'),
+        emoji=c_info.get('emoji'),
+        message_count=thread.get('messages_count'),
+        last_message_timestamp=_last_message_timestamp(thread)
+    )
+
 def graphql_queries_to_json(*queries):
     """
     Queries should be a list of GraphQL objects
     """
-    rtn = {}
-    for i, query in enumerate(queries):
-        rtn['q{}'.format(i)] = query.value
-    return json.dumps(rtn)
+    return '{' + ','.join('"q{}":{}'.format(i, query.to_json()) for i, query in enumerate(queries)) + '}'
 
-def graphql_response_to_json(content):
-    content = strip_to_json(content) # Usually only needed in some error cases
-    try:
-        j = json.loads(content, cls=ConcatJSONDecoder)
-    except Exception:
-        raise FBchatException('Error while parsing JSON: {}'.format(repr(content)))
-
-    rtn = [None]*(len(j))
-    for x in j:
-        if 'error_results' in x:
-            del rtn[-1]
-            continue
-        check_json(x)
-        [(key, value)] = x.items()
-        check_json(value)
-        if 'response' in value:
-            rtn[int(key[1:])] = value['response']
-        else:
-            rtn[int(key[1:])] = value['data']
+class GraphQLResponseDecoder(object):
+    """
+    Incrementally decodes a response from `graphqlbatch`.
+    Feed it chunks of the response, and it returns `(index, result)` tuples as soon as each query's result is complete
+    """
+
+    def __init__(self, errors=None):
+        """
+        :param errors: If set, queries that failed don't raise an exception, and their errors are stored in this dict, labeled by index
+        :type errors: dict
+        """
+        self._decoder = ConcatJSONStreamDecoder()
+        self._received = []
+        self.errors = errors
+
+    def feed(self, chunk):
+        """
+        Returns a list of the `(index, result)` tuples that were completed by `chunk`
+
+        :raises: FBchatException if the response is invalid, or FBchatFacebookError if a query failed
+        """
+        if len(self._received) < 10:
+            # Kept around for error messages
+            self._received.append(chunk)
+        try:
+            objs = self._decoder.feed(chunk)
+        except Exception:
+            raise FBchatException('Error while parsing JSON: {}'.format(repr(chunk)))
+        return self._results(objs)
+
+    def close(self):
+        """
+        Returns a list of the remaining `(index, result)` tuples
+
+        :raises: FBchatException if the response is invalid, or FBchatFacebookError if a query failed
+        """
+        try:
+            objs = self._decoder.close()
+        except Exception:
+            raise FBchatException('Error while parsing JSON: {}'.format(repr(self._received)))
+        return self._results(objs)
+
+    def _results(self, objs):
+        rtn = []
+        for x in objs:
+            # The last object is the status of the batch
+            if 'error_results' in x:
+                continue
+            check_json(x)
+            [(key, value)] = x.items()
+            try:
+                check_json(value)
+            except FBchatFacebookError as e:
+                if self.errors is None:
+                    raise
+                self.errors[int(key[1:])] = e
+                continue
+            if 'response' in value:
+                rtn.append((int(key[1:]), value['response']))
+            else:
+                rtn.append((int(key[1:]), value['data']))
+        return rtn
+
+def iter_graphql_response(chunks, errors=None):
+    """
+    Yields `(index, result)` tuples from the chunks of a `graphqlbatch` response, as soon as each result is complete
+
+    :param chunks: An iterable of `str` or `bytes`
+    :param errors: If set, queries that failed are skipped, and their errors are stored in this dict, labeled by index
+    :raises: FBchatException if the response is invalid, or FBchatFacebookError if a query failed
+    """
+    decoder = GraphQLResponseDecoder(errors=errors)
+    for chunk in chunks:
+        for result in decoder.feed(chunk):
+            yield result
+    for result in decoder.close():
+        yield result
+
+def graphql_response_to_json(content, partial=False, count=None):
+    """
+    Parses a response from `graphqlbatch` (`str` or `bytes`), and returns the results in the order of the queries
+
+    :param partial: If set, queries that failed don't raise an exception. Instead, two dicts labeled by the queries' index
+        (the `N` in `qN`) are returned: The results of the queries that succeeded, and the errors of the ones that failed
+    :param count: The number of queries that were sent. If set, queries that are missing from the response are treated as failed
+    :raises: FBchatException if the response is invalid, or FBchatFacebookError if a query failed (and `partial` isn't set)
+    """
+    errors = {} if partial else None
+    results = list(iter_graphql_response([content], errors=errors))
+
+    if count is not None:
+        missing = set(range(count)).difference(index for index, result in results)
+        if errors is not None:
+            missing.difference_update(errors)
+        for index in sorted(missing):
+            error = FBchatFacebookError('Facebook did not return a result for query q{}'.format(index))
+            if not partial:
+                raise error
+            errors[index] = error
+
+    if partial:
+        log.debug(results)
+        return dict(results), errors
+
+    # Sized by the number of queries (or else by the largest index), so results always end up at the index of their query
+    rtn = [None]*(count if count is not None else max(index for index, result in results) + 1 if results else 0)
+    for index, result in results:
+        if index >= len(rtn):
+            raise FBchatException('Got a result for query q{}, but only {} queries were sent'.format(index, len(rtn)))
+        rtn[index] = result
 
     log.debug(rtn)
 
     return rtn
 
+def minify_query(query):
+    """Collapses the whitespace in a GraphQL query, and removes it after opening brackets and commas, and before closing brackets and commas"""
+    query = re.sub(r'\s+', ' ', query).strip()
+    return re.sub(r'(?<=[{(,]) | (?=[}),])', '', query)
+
+# Compiled templates, labeled by query or doc_id. See `GraphQL.to_json`
+_templates = {}
+
 class GraphQL(object):
+    #: The query used by :func:`Client.fetchThreadInfo` and :func:`Client.fetchThreadMessages`
+    DOC_ID_THREAD_INFO = '1386147188135407'
+    #: The query used by :func:`Client.fetchThreadList`
+    DOC_ID_THREAD_LIST = '1349387578499440'
+
     def __init__(self, query=None, doc_id=None, params=None):
         if params is None:
             params = {}
         if query is not None:
+            key = ('q', query)
+            if key not in _templates:
+                query = minify_query(query)
+                _templates[key] = (query, '{{"priority":0,"q":{},"query_params":'.format(json_dumps(query)))
+            query, self._template = _templates[key]
             self.value = {
                 'priority': 0,
                 'q': query,
                 'query_params': params
             }
         elif doc_id is not None:
+            key = ('doc_id', doc_id)
+            if key not in _templates:
+                _templates[key] = (doc_id, '{{"doc_id":{},"query_params":'.format(json_dumps(doc_id)))
+            doc_id, self._template = _templates[key]
             self.value = {
                 'doc_id': doc_id,
                 'query_params': params
@@ -310,6 +771,13 @@ class GraphQL(object):
         else:
             raise FBchatUserError('A query or doc_id must be specified')
 
+    def to_json(self):
+        """
+        Returns :any:`GraphQL.value` encoded as JSON. The query (or doc_id) is minified and encoded once,
+        and reused by every :class:`GraphQL` with the same query, so only `query_params` is encoded on each call
+        """
+        return self._template + json_dumps(self.value['query_params']) + '}'
+
 
     FRAGMENT_USER = """
     QueryFragment User: User {
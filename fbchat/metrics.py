@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import threading
+
+#: Upper bounds (in seconds) of the buckets used by the latency histograms
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+#: The metrics recorded by the client, as `(type, description)` labeled by name
+METRICS = {
+    'fbchat_requests_total': ('counter', 'Number of requests sent to Facebook'),
+    'fbchat_request_duration_seconds': ('histogram', 'Time spent waiting for Facebook to respond'),
+    'fbchat_request_bytes_total': ('counter', 'Number of bytes sent to Facebook, not counting headers'),
+    'fbchat_response_bytes_total': ('counter', 'Number of bytes received from Facebook, not counting headers'),
+    'fbchat_retries_total': ('counter', 'Number of requests that were retried'),
+    'fbchat_decode_duration_seconds': ('histogram', 'Time spent checking and decoding responses'),
+    'fbchat_callback_duration_seconds': ('histogram', 'Time spent handling pulled events, including the `on...` callbacks'),
+    'fbchat_downloads_total': ('counter', 'Number of files downloaded by a `DownloadManager`'),
+    'fbchat_download_bytes_total': ('counter', 'Number of bytes in the files downloaded by a `DownloadManager`'),
+}
+
+
+def _label_items(labels):
+    """Returns the labels as sorted tuples. The values are stored as strings, so e.g. `status=200` and `status='error'` can be sorted together"""
+    return tuple(sorted((key, '{}'.format(value)) for key, value in labels.items()))
+
+
+def _escape(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value)) for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else '{}'.format(value)
+
+
+class Histogram(object):
+    """Counts observed values in buckets, like a Prometheus histogram"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        #: Number of values in each bucket (not cumulative), the last one holding the values larger than all the buckets
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    """
+    Collects the metrics listed in :any:`METRICS`, labeled by `endpoint` (see :func:`utils.get_endpoint`)
+    and by the public :class:`Client` `method` that sent the request (e.g. `send` or `fetchThreadInfo`)
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: Upper bounds of the histogram buckets, in seconds
+        """
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Increments the counter `name` by `value`"""
+        key = (name, _label_items(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Adds `value` to the histogram `name`"""
+        key = (name, _label_items(labels))
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = Histogram(self.buckets)
+            self._values[key].observe(value)
+
+    def get(self, name, **labels):
+        """
+        Returns the current value of a metric, summed over the labels that aren't given.
+        For histograms, this is a tuple with the number and the sum of the observed values
+
+        :rtype: int, float or tuple
+        """
+        labels = set(_label_items(labels))
+        total = None
+        with self._lock:
+            for (_name, _labels), value in self._values.items():
+                if _name != name or not labels.issubset(_labels):
+                    continue
+                if isinstance(value, Histogram):
+                    value = (value.count, value.sum)
+                    total = value if total is None else (total[0] + value[0], total[1] + value[1])
+                else:
+                    total = value if total is None else total + value
+        if total is None:
+            return (0, 0.0) if METRICS.get(name, ('counter',))[0] == 'histogram' else 0
+        return total
+
+    def reset(self):
+        """Forgets all recorded values"""
+        with self._lock:
+            self._values.clear()
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the `Prometheus text format <https://prometheus.io/docs/instrumenting/exposition_formats/>`_
+
+        :rtype: str
+        """
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: item[0])
+            lines = []
+            current = None
+            for (name, labels), value in items:
+                if name != current:
+                    current = name
+                    metric_type, description = METRICS.get(name, ('counter' if not isinstance(value, Histogram) else 'histogram', ''))
+                    lines.append('# HELP {} {}'.format(name, description))
+                    lines.append('# TYPE {} {}'.format(name, metric_type))
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                        cumulative += count
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, [('le', _format_value(bound))]), cumulative))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(value.sum)))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), value.count))
+                else:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
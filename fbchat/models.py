@@ -21,6 +21,18 @@ class FBchatFacebookError(FBchatException):
         self.fb_error_message = fb_error_message
         self.request_status_code = request_status_code
 
+class FBchatPartialResultError(FBchatFacebookError):
+    """Thrown by fbchat when some, but not all, of the requested items could be fetched"""
+    #: The items that were fetched, labeled by their ID
+    results = None
+    #: The errors of the items that couldn't be fetched, labeled by their ID
+    errors = None
+    def __init__(self, message, results, errors):
+        error = next(iter(errors.values()))
+        super(FBchatPartialResultError, self).__init__(message, fb_error_code=error.fb_error_code, fb_error_message=error.fb_error_message, request_status_code=error.request_status_code)
+        self.results = results
+        self.errors = errors
+
 class FBchatUserError(FBchatException):
     """Thrown by fbchat when wrong values are entered"""
 
@@ -456,6 +468,17 @@ class ThreadLocation(Enum):
     ARCHIVED = 'ARCHIVED'
     OTHER = 'OTHER'
 
+class Projection(Enum):
+    """Used to specify which fields of threads and messages to fetch and convert"""
+    #: Every field
+    FULL = 'full'
+    #: Everything except attachments and stickers, and for threads, only what's in the thread (no user or page profiles)
+    METADATA = 'metadata'
+    #: The IDs, authors and timestamps of messages, and their text and mentions
+    TEXT = 'text'
+    #: Only the IDs, and the authors and timestamps of messages
+    IDS = 'ids'
+
 class TypingStatus(Enum):
     """Used to specify whether the user is typing or has stopped typing"""
     STOPPED = 0
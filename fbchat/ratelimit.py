@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+import threading
+import time
+from .models import FBchatUserError
+from .utils import get_endpoint
+
+# Python 2 doesn't have a monotonic clock
+clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    """Allows `rate` requests per second on average, and bursts of up to `burst` requests"""
+
+    def __init__(self, rate, burst=1):
+        if not rate > 0:
+            raise FBchatUserError('The rate must be more than 0 requests per second, got {}'.format(rate))
+        if not burst >= 1:
+            raise FBchatUserError('The burst must be at least 1 request, got {}'.format(burst))
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self):
+        """
+        Takes a token, and returns how many seconds to wait before it may be used.
+        When no tokens are left, the bucket goes into debt, so tokens are handed out in the order they were reserved
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def get_queued(self):
+        """Returns the number of reservations that are still waiting for their token"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= 0:
+                return 0
+            return int(-self._tokens) + (1 if -self._tokens % 1 else 0)
+
+
+class RateLimiter(object):
+    """
+    Paces requests to Facebook, with a :class:`TokenBucket` for each endpoint.
+    Requests over the limit are queued (the caller waits until it's their turn) instead of failing
+    """
+
+    def __init__(self, limits=None):
+        """
+        :param limits: Tuples of `(rate, burst)` labeled by url, eg. ``{ReqUrl.SEND: (1, 5)}`` allows 5 messages at once, and then 1 message per second.
+            Endpoints that aren't listed aren't limited
+        :type limits: dict
+        """
+        self._buckets = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        for url, (rate, burst) in (limits or {}).items():
+            self.set_limit(url, rate, burst)
+
+    def set_limit(self, url, rate, burst=1):
+        """
+        Limits requests to `url` to `rate` requests per second, with bursts of up to `burst` requests
+
+        :raises: FBchatUserError if `rate` isn't positive, or `burst` is less than 1
+        """
+        endpoint = get_endpoint(url)
+        bucket = TokenBucket(rate, burst)
+        with self._lock:
+            self._buckets[endpoint] = bucket
+            self._stats[endpoint] = {
+                'requests': 0,
+                'delayed': 0,
+                'wait_time': 0.0,
+                'max_wait_time': 0.0,
+            }
+
+    def reserve(self, url):
+        """Reserves a slot for a request to `url`, and returns how many seconds to wait before sending it"""
+        endpoint = get_endpoint(url)
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            return 0
+        delay = bucket.reserve()
+        with self._lock:
+            stats = self._stats[endpoint]
+            stats['requests'] += 1
+            if delay > 0:
+                stats['delayed'] += 1
+                stats['wait_time'] += delay
+                stats['max_wait_time'] = max(stats['max_wait_time'], delay)
+        return delay
+
+    def acquire(self, url):
+        """Blocks until a request to `url` may be sent"""
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    def get_stats(self):
+        """
+        Returns statistics for each limited endpoint:
+        `requests` (total number of requests), `delayed` (number of requests that had to wait),
+        `wait_time` and `max_wait_time` (total and longest wait, in seconds) and `queued` (number of requests waiting right now)
+
+        :rtype: dict
+        """
+        with self._lock:
+            rtn = {}
+            for endpoint, stats in self._stats.items():
+                rtn[endpoint] = dict(stats, queued=self._buckets[endpoint].get_queued())
+            return rtn
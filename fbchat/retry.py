@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+
+from __future__ import unicode_literals
+from random import uniform
+import requests
+from .models import *
+from .utils import get_endpoint, ReqUrl
+
+
+class RetryPolicy(object):
+    """Decides whether, and when, a failed request to Facebook is sent again
+
+    Retries are spaced out with exponential backoff and "full jitter": Before retry number `n` (counting from 0),
+    the client waits a random amount of time between 0 and ``min(max_backoff, backoff * 2 ** n)`` seconds.
+    Requests that failed because the session expired (error #1357004) are resent right after the session is refreshed.
+
+    A request that timed out, or got a 5xx response, might still have been carried out by Facebook,
+    so these are only retried for GET requests and for the POST requests in `safe_urls`.
+    The POST requests in there only read data, except for :any:`ReqUrl.SEND`: The same data is sent on every retry,
+    which means that a retried message keeps its `offline_threading_id`, which Facebook uses to avoid sending the message twice.
+    Other requests, like changing a group or reacting to a message, are only retried when the session had expired.
+
+    Requests to the pull channels aren't retried by default, since the listening loop moves on to another channel instead
+    """
+
+    #: HTTP status codes that are worth retrying
+    retry_status_codes = (500, 502, 503, 504)
+    #: Facebook error codes that are worth retrying
+    retry_error_codes = ('1357004',)
+    #: Exceptions from `requests` that are worth retrying
+    retry_exceptions = (requests.Timeout, requests.ConnectionError)
+    #: POST requests that are safe to send twice
+    safe_urls = (ReqUrl.SEND, ReqUrl.GRAPHQL, ReqUrl.INFO, ReqUrl.ALL_USERS, ReqUrl.THREAD_SYNC)
+    #: The default retry budgets, which `budgets` are added to
+    default_budgets = {ReqUrl.STICKY: 0, ReqUrl.PING: 0}
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30, deadline=None, budgets=None):
+        """
+        :param max_retries: Maximum number of times a request is retried
+        :param backoff: The maximum delay before the first retry, in seconds. Doubles with every retry
+        :param max_backoff: The delays never get longer than this, in seconds
+        :param deadline: If set, requests aren't retried if that would take longer than this many seconds in total
+        :param budgets: Overrides `max_retries` for specific endpoints, labeled by their url (eg. ``{ReqUrl.SEND: 1}``)
+        :type max_retries: int
+        :type budgets: dict
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.budgets = {}
+        for url, retries in list(self.default_budgets.items()) + list((budgets or {}).items()):
+            self.budgets[get_endpoint(url)] = retries
+        self._safe_endpoints = set(get_endpoint(url) for url in self.safe_urls)
+
+    def get_retries(self, url):
+        """Returns the maximum number of times requests to `url` may be retried"""
+        return self.budgets.get(get_endpoint(url), self.max_retries)
+
+    def is_idempotent(self, method, url):
+        """Returns whether a request can be sent again, even if Facebook might have carried it out already"""
+        return method == 'GET' or get_endpoint(url) in self._safe_endpoints
+
+    def is_retryable(self, exception, idempotent=True):
+        """
+        Returns whether the request that raised `exception` is worth retrying
+
+        :param idempotent: Whether the request can be sent twice, see :func:`is_idempotent`
+        """
+        if isinstance(exception, FBchatFacebookError) and exception.fb_error_code in self.retry_error_codes:
+            return True
+        if not idempotent:
+            return False
+        if isinstance(exception, FBchatFacebookError):
+            return exception.request_status_code in self.retry_status_codes
+        return isinstance(exception, self.retry_exceptions)
+
+    def get_delay(self, attempt):
+        """Returns how many seconds to wait before retry number `attempt` (counting from 0)"""
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def allows(self, elapsed, delay):
+        """Returns whether the deadline allows waiting `delay` seconds more, when `elapsed` seconds have already passed"""
+        return self.deadline is None or elapsed + delay <= self.deadline
@@ -2,10 +2,15 @@
 
 from __future__ import unicode_literals
 import re
+import os
 import json
 from time import time
 from random import random
 import warnings
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
 import logging
 from .models import *
 
@@ -82,6 +87,19 @@ GENDERS = {
     #'': 'unknown_plural',
 }
 
+#: Default maximum number of connections that are kept alive to each host. Hosts not listed here use the `requests` default (10)
+POOL_SIZES = {
+    'www.facebook.com': 10,
+    'm.facebook.com': 2,
+    'upload.facebook.com': 2,
+    # The pull channels, see :func:`ReqUrl.change_pull_channel`
+    '0-edge-chat.facebook.com': 2,
+    '1-edge-chat.facebook.com': 2,
+    '2-edge-chat.facebook.com': 2,
+    '3-edge-chat.facebook.com': 2,
+    '4-edge-chat.facebook.com': 2,
+}
+
 class ReqUrl(object):
     """A class containing all urls used by `fbchat`"""
     SEARCH = "https://www.facebook.com/ajax/typeahead/search.php"
@@ -127,14 +145,147 @@ class ReqUrl(object):
 
 facebookEncoding = 'UTF-8'
 
+def get_endpoint(url):
+    """
+    Returns the url without its query string and trailing slash, which is used to label requests (eg. in retry budgets)
+    All pull channels are labeled as channel 0, the same as :any:`ReqUrl.STICKY` and :any:`ReqUrl.PING`
+    """
+    url = url.split('?', 1)[0].rstrip('/')
+    return re.sub(r'^https://\d+-edge-chat\.', 'https://0-edge-chat.', url)
+
+def get_host(url):
+    """
+    Returns the scheme and host of `url`. Requests to hosts that serve countless urls, like the CDN, are labeled by this instead of :func:`get_endpoint`,
+    so the labels don't grow with every file
+    """
+    parts = urlparse(url)
+    return '{}://{}'.format(parts.scheme, parts.netloc)
+
 def now():
     return int(time()*1000)
 
+_json_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+def find_json_start(text):
+    """Returns the index of the first JSON object in `text` (`str` or `bytes`), skipping prefixes like ``for (;;);``"""
+    idx = text.find(b'{' if isinstance(text, bytes) else '{')
+    if idx == -1:
+        raise FBchatException('No JSON object found: {}'.format(repr(text)))
+    return idx
+
 def strip_to_json(text):
+    return text[find_json_start(text):]
+
+def _json_loads_at(text, idx):
+    if isinstance(text, bytes):
+        text = get_decoded(text)
+        idx = find_json_start(text)
+    j, end = _json_decoder.raw_decode(text, idx)
+    if _whitespace.match(text, end).end() != len(text):
+        raise ValueError('Extra data after the JSON object, at position {}'.format(end))
+    return j
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+# Integers with 19 digits or more might not fit in 64 bits
+_long_integer = re.compile(r'\d{19}')
+_long_integer_bytes = re.compile(br'\d{19}')
+
+def _check_orjson_integers(text, idx=0):
+    """orjson decodes integers that don't fit in 64 bits as floats instead of failing, so documents that might have them are left to `json`"""
+    if (_long_integer_bytes if isinstance(text, bytes) else _long_integer).search(text, idx):
+        raise OverflowError('The document might have integers that don\'t fit in 64 bits')
+
+def _orjson_loads(text):
+    _check_orjson_integers(text)
+    return _json_modules['orjson'].loads(text)
+
+def _orjson_loads_at(text, idx):
+    _check_orjson_integers(text, idx)
+    # orjson parses `bytes` directly, so a memoryview lets it skip the prefix without copying anything
+    return _json_modules['orjson'].loads(memoryview(text)[idx:] if isinstance(text, bytes) else text[idx:])
+
+def _orjson_dumps(obj):
+    return _json_modules['orjson'].dumps(obj).decode('utf-8')
+
+def _ujson_loads_at(text, idx):
+    return _json_modules['ujson'].loads(text[idx:])
+
+def _ujson_dumps(obj):
+    return _json_modules['ujson'].dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+
+_json_modules = {'json': json}
+for _name in ('orjson', 'ujson'):
     try:
-        return text[text.index('{'):]
-    except ValueError:
-        raise FBchatException('No JSON object found: {}, {}'.format(repr(text), text.index('{')))
+        _json_modules[_name] = __import__(_name)
+    except ImportError:
+        pass
+
+_json_backends = {
+    'orjson': (_orjson_loads, _orjson_loads_at, _orjson_dumps),
+    'ujson': (lambda s: _json_modules['ujson'].loads(s), _ujson_loads_at, _ujson_dumps),
+    'json': (json.loads, _json_loads_at, _json_dumps),
+}
+
+#: JSON libraries that are used if they're installed, in order of preference. See :func:`set_json_backend`
+JSON_BACKENDS = ['orjson', 'ujson', 'json']
+
+def set_json_backend(name=None):
+    """
+    Sets the library used to encode and decode JSON.
+    All libraries give the same results, the faster ones (`orjson` and `ujson`) fall back to `json` for the rare documents they can't handle,
+    like documents with integers that don't fit in 64 bits
+
+    :param name: One of :any:`JSON_BACKENDS`. If `None`, the first one that is installed is used
+    :raises: FBchatUserError if the library is not installed
+    """
+    global _json_backend
+    if name is None:
+        name = next(backend for backend in JSON_BACKENDS if backend in _json_modules)
+    if name not in _json_backends:
+        raise FBchatUserError('Unknown JSON backend: {}'.format(name))
+    if name not in _json_modules:
+        raise FBchatUserError('JSON backend {} is not installed'.format(name))
+    _json_backend = name
+
+def get_json_backend():
+    """Returns the name of the library used to encode and decode JSON, see :func:`set_json_backend`"""
+    return _json_backend
+
+set_json_backend()
+
+def json_loads(text):
+    """Decodes the JSON document `text` (`str` or `bytes`)"""
+    if isinstance(text, bytes) and _json_backend == 'json':
+        # Python 3.5 can't decode `bytes`
+        text = get_decoded(text)
+    try:
+        return _json_backends[_json_backend][0](text)
+    except (ValueError, OverflowError):
+        # orjson and ujson reject some valid JSON, like integers that don't fit in 64 bits
+        if _json_backend == 'json':
+            raise
+        return json.loads(get_decoded(text) if isinstance(text, bytes) else text)
+
+def json_dumps(obj):
+    """Encodes `obj` as compact JSON"""
+    return _json_backends[_json_backend][2](obj)
+
+def parse_json_at(text, idx=0):
+    """Parses the JSON object that starts at `idx` in `text` (`str` or `bytes`), without copying the rest of `text` first"""
+    try:
+        return _json_backends[_json_backend][1](text, idx)
+    except (ValueError, OverflowError):
+        if _json_backend == 'json':
+            raise
+        return _json_loads_at(text, idx)
+
+def replace_file(src, dst):
+    """Renames `src` to `dst`, replacing `dst` if it exists"""
+    # `os.replace` doesn't exist in Python 2, where `os.rename` can't replace files on Windows
+    getattr(os, 'replace', os.rename)(src, dst)
 
 def get_decoded_r(r):
     return get_decoded(r._content)
@@ -143,10 +294,10 @@ def get_decoded(content):
     return content.decode(facebookEncoding)
 
 def parse_json(content):
-    return json.loads(content)
+    return json_loads(content)
 
 def get_json(r):
-    return json.loads(strip_to_json(get_decoded_r(r)))
+    return parse_json_at(r.content, find_json_start(r.content))
 
 def digitToChar(digit):
     if digit < 10:
@@ -187,19 +338,26 @@ def check_json(j):
     else:
         raise FBchatFacebookError('Error {} when sending request'.format(j['error']), fb_error_code=j['error'])
 
-def check_request(r, as_json=True):
+def check_request(r, as_json=True, decode=True):
+    """
+    :param as_json: Whether to parse the response as JSON
+    :param decode: If `as_json` is `False`, whether the response should be decoded to text, or returned as `bytes`
+    """
     if not r.ok:
         raise FBchatFacebookError('Error when sending request: Got {} response'.format(r.status_code), request_status_code=r.status_code)
 
-    content = get_decoded_r(r)
+    # JSON is parsed from the raw bytes, since some JSON backends don't need them decoded first
+    return check_content(r.content if as_json or not decode else get_decoded_r(r), as_json=as_json)
 
+def check_content(content, as_json=True):
     if content is None or len(content) == 0:
         raise FBchatFacebookError('Error when sending request: Got empty response')
 
     if as_json:
-        content = strip_to_json(content)
+        # The response is parsed where the JSON starts, instead of being sliced into a copy first
+        idx = find_json_start(content)
         try:
-            j = json.loads(content)
+            j = parse_json_at(content, idx)
         except ValueError:
             raise FBchatFacebookError('Error while parsing JSON: {}'.format(repr(content)))
         check_json(j)
@@ -215,6 +373,16 @@ def get_jsmods_require(j, index):
             log.warning('Error when getting jsmods_require: {}. Facebook might have changed protocol'.format(j))
     return None
 
+def get_url_expiry(url):
+    """Returns when a signed CDN url expires, as a UNIX timestamp, or `None` if it doesn't have an expiry"""
+    oe = parse_qs(urlparse(url).query).get('oe')
+    if not oe:
+        return None
+    try:
+        return int(oe[0], 16)
+    except ValueError:
+        return None
+
 def get_emojisize_from_tags(tags):
     if tags is None:
         return None
@@ -225,3 +393,17 @@ def get_emojisize_from_tags(tags):
         except (KeyError, IndexError):
             log.exception('Could not determine emoji size from {} - {}'.format(tags, tmp))
     return None
+
+class lazy_property(object):
+    """Like `property`, but the value is only computed on first access, and then stored on the instance like a normal attribute"""
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
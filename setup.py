@@ -20,7 +20,10 @@ requirements = [
 ]
 
 extras_requirements = {
-    ':python_version < "3.4"': ['enum34']
+    ':python_version < "3.4"': ['enum34'],
+    'async:python_version >= "3.5"': ['aiohttp'],
+    'fast:python_version >= "3.6"': ['orjson'],
+    'fast:python_version < "3.6"': ['ujson'],
 }
 
 version = None
@@ -79,4 +82,7 @@ setup(
     url=source,
     version=version,
     zip_safe=True,
+    entry_points={
+        'console_scripts': ['fbchat-export = fbchat.export:main'],
+    },
 )
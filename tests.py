@@ -3,14 +3,40 @@
 
 from __future__ import unicode_literals
 import json
+import re
 import logging
 import unittest
 from getpass import getpass
-from sys import argv
-from os import path, chdir
+from sys import argv, version_info
+from os import path, chdir, listdir
 from glob import glob
+import threading
+import gzip
+import shutil
+import tempfile
+from copy import deepcopy
+from io import BytesIO
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+import requests
 from fbchat import Client
+from fbchat.retry import RetryPolicy
+from fbchat import ratelimit, cache
+from fbchat.ratelimit import RateLimiter, TokenBucket
+from fbchat.cache import TTLCache
+from fbchat.metrics import MetricsRegistry
+from fbchat.batching import GraphQLBatcher
+from fbchat.export import Exporter
+from fbchat.directory import UserDirectory
+from fbchat.download import DownloadManager
+import time
 from fbchat.models import *
+from fbchat.utils import ReqUrl, POOL_SIZES, get_endpoint, lazy_property, JSON_BACKENDS, set_json_backend, get_json_backend, check_content, json_dumps, json_loads
+from fbchat.graphql import GraphQL, LazyMessage, graphql_to_message, graphql_to_messages, graphql_to_thread, graphql_to_thread_user, graphql_queries_to_json, graphql_response_to_json, iter_graphql_response
 import py_compile
 
 logging_level = logging.ERROR
@@ -113,6 +139,21 @@ class TestFbchat(unittest.TestCase):
 
             self.assertIsNotNone(client.send(Message(sticker=Sticker(test_sticker_id))))
 
+    def test_sendConcurrently(self):
+        # Sends from multiple threads at once, through the same client
+        for thread in threads:
+            results = [None] * 10
+            def send(i):
+                results[i] = client.send(Message(text='test_send_concurrently_{}★'.format(i)), thread_id=thread['id'], thread_type=thread['type'])
+            workers = [threading.Thread(target=send, args=(i,)) for i in range(len(results))]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            self.assertNotIn(None, results)
+            self.assertEqual(len(set(results)), len(results))
+
     def test_sendImages(self):
         image_url = 'https://cdn4.iconfinder.com/data/icons/ionicons/512/icon-image-128.png'
         image_local_url = path.join(path.dirname(__file__), 'tests/image.png')
@@ -186,6 +227,1110 @@ class TestFbchat(unittest.TestCase):
             client.setTypingStatus(TypingStatus.STOPPED)
 
 
+class TestJSONBackends(unittest.TestCase):
+    """Checks that every installed JSON backend gives the same results. Doesn't need an account"""
+
+    documents = [
+        'for (;;);{"__ar":1,"payload":{"actions":[{"message_id":"mid.$cAAAAA","timestamp":1510000000000}]}}',
+        'for (;;);{"t":"msg","ms":[{"delta":{"body":"\\u00e6 \\ud83d\\ude0d \\/ \\" \\\\ \u2028 \xe6\u00f8\u00e5 \U0001F60D"}}],"seq":3}\r\n',
+        '{"a":[1,-2,3.5,1e-7,-0.0,true,false,null,"",{}],"b":{"c":{"d":[[],[{}]]}},"large":18446744073709551615}',
+        '{"infinity": 1e400, "huge": 123456789012345678901234567890}',
+    ]
+    batch = '{"q0":{"response":{"message_thread":{"name":"\xe6\u00f8\u00e5","messages_count":2}}}}\r\n{"q1":{"data":{"viewer":{"id":"1234"}}}}\r\n{"successful_results":2,"error_results":0,"skipped_results":0}'
+    pretty_batch = '{\n  "q0": {\n    "response": {"a": 1}\n  }\n}{"q1": {"response": {"b": 2}}}\n{"successful_results": 2, "error_results": 0}'
+
+    def setUp(self):
+        self.backends = []
+        for backend in JSON_BACKENDS:
+            try:
+                set_json_backend(backend)
+                self.backends.append(backend)
+            except FBchatUserError:
+                pass
+        set_json_backend('json')
+
+    def tearDown(self):
+        set_json_backend()
+
+    def assertParity(self, func, *args):
+        set_json_backend('json')
+        expected = func(*args)
+        for backend in self.backends:
+            set_json_backend(backend)
+            self.assertEqual(repr(func(*args)), repr(expected), backend)
+
+    def test_check_content(self):
+        for document in self.documents:
+            self.assertParity(check_content, document.encode('utf-8'))
+            self.assertParity(check_content, document)
+            self.assertParity(json_loads, document[document.index('{'):])
+
+    def test_large_integers(self):
+        numbers = [2 ** 63 - 1, 2 ** 64 - 1, 2 ** 64, -2 ** 63, -2 ** 63 - 1, 123456789012345678901234567890, -123456789012345678901234567890]
+        document = '{"numbers":[' + ','.join(str(number) for number in numbers) + '],"id":"1234567890123456789012"}'
+        batch = '{"q0":{"data":' + document + '}}\r\n{"successful_results":1,"error_results":0}'
+        for backend in self.backends:
+            set_json_backend(backend)
+            for content in [document, document.encode('utf-8')]:
+                self.assertEqual(json_loads(content)['numbers'], numbers, backend)
+                self.assertEqual(check_content(b'for (;;);' + document.encode('utf-8'))['numbers'], numbers, backend)
+            self.assertEqual(graphql_response_to_json(batch)[0]['numbers'], numbers, backend)
+            self.assertEqual(list(iter_graphql_response([batch]))[0][1]['numbers'], numbers, backend)
+        for number in numbers:
+            self.assertParity(json_loads, '{"n":%d}' % number)
+
+    def test_graphql_response_to_json(self):
+        for batch in [self.batch, self.pretty_batch]:
+            self.assertParity(graphql_response_to_json, batch)
+            self.assertParity(graphql_response_to_json, batch.encode('utf-8'))
+
+    def test_graphql_response_partial(self):
+        batch = self.batch.replace('{"q0":{"response"', '{"q0":{"error":1545012,"errorDescription":"Bad query","response"')
+        self.assertRaises(FBchatFacebookError, graphql_response_to_json, batch)
+        self.assertParity(lambda: graphql_response_to_json(batch, partial=True))
+        results, errors = graphql_response_to_json(batch, partial=True)
+        self.assertEqual(results, {1: {'viewer': {'id': '1234'}}})
+        self.assertEqual(list(errors), [0])
+        self.assertEqual(errors[0].fb_error_code, '1545012')
+
+    def test_graphql_response_missing(self):
+        # The response only has results for two queries
+        self.assertEqual(graphql_response_to_json(self.batch, count=2), graphql_response_to_json(self.batch))
+        self.assertRaises(FBchatException, graphql_response_to_json, self.batch, count=3)
+        self.assertRaises(FBchatException, graphql_response_to_json, self.batch, count=1)
+        results, errors = graphql_response_to_json(self.batch, partial=True, count=3)
+        self.assertEqual(sorted(results), [0, 1])
+        self.assertEqual(list(errors), [2])
+        self.assertIsInstance(errors[2], FBchatFacebookError)
+
+    def test_iter_graphql_response(self):
+        for batch in [self.batch, self.pretty_batch]:
+            expected = list(enumerate(graphql_response_to_json(batch)))
+            for content in [batch, batch.encode('utf-8')]:
+                for size in [1, 2, 5, 64, len(content)]:
+                    chunks = [content[i:i+size] for i in range(0, len(content), size)]
+                    self.assertParity(lambda: list(iter_graphql_response(chunks)))
+                    self.assertEqual(list(iter_graphql_response(chunks)), expected)
+
+    def test_dumps(self):
+        obj = {'text': '\xe6 \U0001F60D / " \\ \n', 'list': [1, -2, 3.5, True, None], 'nested': {'a': {}}}
+        self.assertParity(json_dumps, obj)
+        queries = [
+            GraphQL(doc_id=GraphQL.DOC_ID_THREAD_INFO, params={'id': '1234', 'message_limit': 20}),
+            GraphQL(query=GraphQL.SEARCH_THREAD, params={'search': '"\xe6\\', 'limit': 1}),
+        ]
+        self.assertParity(graphql_queries_to_json, *queries)
+        self.assertEqual(json_loads(graphql_queries_to_json(*queries)), {'q0': queries[0].value, 'q1': queries[1].value})
+        for backend in self.backends:
+            set_json_backend(backend)
+            self.assertEqual(json_loads(json_dumps(obj)), obj, backend)
+
+    def test_invalid(self):
+        for backend in self.backends:
+            set_json_backend(backend)
+            for document in ['for (;;);', 'for (;;);{"a":', '{"a":1}x', '{"a":1}{"b":2}']:
+                with self.assertRaises(FBchatException, msg=backend):
+                    check_content(document.encode('utf-8'))
+
+
+def fake_response(url, body=b'', status_code=200, headers=None):
+    """Builds a `requests` response, as if it had been received from `url`"""
+    r = requests.models.Response()
+    r.url = url
+    r.status_code = status_code
+    r.headers.update(headers or {})
+    r.encoding = 'utf-8'
+    r._content = body.encode('utf-8') if not isinstance(body, bytes) else body
+    r._content_consumed = True
+    r.request = requests.Request('GET', url).prepare()
+    return r
+
+
+class FakeSession(object):
+    """
+    Stands in for the `requests` session of a client. Logging in always succeeds,
+    and the other requests are answered by `respond(method, url, payload)`, which returns the body of the response
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.cookies = requests.cookies.RequestsCookieJar()
+        # Requests to local servers are really sent
+        self.http = requests.session()
+        self.lock = threading.Lock()
+        # The number of times the client has (re)loaded the home page, which it does when logging in
+        self.logins = 0
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        if url.startswith('http://127.0.0.1:'):
+            return self.http.request(method, url, params=params, data=data, **kwargs)
+        if url == ReqUrl.BASE:
+            with self.lock:
+                self.logins += 1
+                # Every login gets a new token
+                fb_dtsg = str(self.logins)
+            return fake_response(url, '<input name="fb_dtsg" value="{}"><input name="h" value="h">"client_revision":1,'.format(fb_dtsg))
+        if url == ReqUrl.LOGIN:
+            return fake_response('https://m.facebook.com/home.php')
+        payload = dict(params or {})
+        payload.update(data or {})
+        body = self.respond(method, url, payload)
+        if body is None:
+            return fake_response(url, status_code=404)
+        return fake_response(url, body)
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+
+class OfflineClient(Client):
+    """A client that is logged in to a :class:`FakeSession` instead of Facebook"""
+
+    def __init__(self, respond=lambda method, url, payload: None, **kwargs):
+        self.respond = respond
+        super(OfflineClient, self).__init__('email', 'password', session_cookies={'c_user': '1'}, logging_level=logging_level, **kwargs)
+
+    def _createSession(self):
+        return FakeSession(self.respond)
+
+
+class TestConcurrency(unittest.TestCase):
+    """Sends from many threads at once through one client, against a fake Facebook. Doesn't need an account"""
+
+    def test_send_stress(self):
+        lock = threading.Lock()
+        counters = []
+        message_ids = []
+
+        def respond(method, url, payload):
+            with lock:
+                counters.append(payload['__req'])
+            if payload['fb_dtsg'] == '1':
+                # The session from the first login has expired
+                return 'for (;;);{"error":1357004,"errorDescription":"Please try closing and re-opening your browser window."}'
+            with lock:
+                message_ids.append(payload['offline_threading_id'])
+            return 'for (;;);' + json.dumps({'payload': {'actions': [{'message_id': 'mid.$' + payload['offline_threading_id']}]}})
+
+        client = OfflineClient(respond)
+        results = [None] * 2000
+
+        def send(worker):
+            for i in range(worker, len(results), 50):
+                results[i] = client.send(Message(text='test_send_stress_{}'.format(i)), thread_id='2', thread_type=ThreadType.USER)
+
+        workers = [threading.Thread(target=send, args=(i,)) for i in range(50)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertNotIn(None, results)
+        self.assertEqual(len(set(results)), len(results))
+        self.assertEqual(len(set(message_ids)), len(message_ids))
+        self.assertEqual(len(set(counters)), len(counters))
+        # Some messages were sent with the expired session, and resent
+        self.assertGreater(len(counters), len(results))
+        # The first login, and one refresh of the expired session
+        self.assertEqual(client._session.logins, 2)
+
+    def test_graphql_chunks(self):
+        def respond(method, url, payload):
+            # Leaves out the queries for negative IDs
+            queries = json.loads(payload['queries'])
+            results = [{name: {'data': {'id': query['query_params']['id']}}} for name, query in sorted(queries.items()) if query['query_params']['id'] >= 0]
+            return '\r\n'.join([json.dumps(result) for result in results] + ['{"successful_results":%d,"error_results":0}' % len(results)])
+
+        client = OfflineClient(respond, graphql_chunk_size=2)
+        queries = [GraphQL(doc_id='1', params={'id': i}) for i in range(5)]
+        self.assertEqual(client.graphql_requests(*queries), tuple({'id': i} for i in range(5)))
+        # The last query of the first chunk is missing, which must not shift the results of the other chunks
+        queries[1] = GraphQL(doc_id='1', params={'id': -1})
+        self.assertRaises(FBchatException, client.graphql_requests, *queries)
+        results, errors = client.graphql_requests_partial(*queries)
+        self.assertEqual(results, {0: {'id': 0}, 2: {'id': 2}, 3: {'id': 3}, 4: {'id': 4}})
+        self.assertEqual(list(errors), [1])
+        with self.assertRaises(FBchatPartialResultError) as cm:
+            client._checkPartialResults([10, 11, 12, 13, 14], results, errors)
+        self.assertEqual(list(cm.exception.errors), [11])
+        self.assertIn('11', str(cm.exception))
+
+
+    def test_fetch_image_urls(self):
+        requested = []
+
+        def respond(method, url, payload):
+            requested.append(payload['photo_id'])
+            if payload['photo_id'] == '3':
+                return None
+            # Image 2 expires in 30 seconds, which is too soon to be cached
+            expiry = '&oe={:x}'.format(int(time.time()) + 30) if payload['photo_id'] == '2' else ''
+            return 'for (;;);{"jsmods":{"require":[[0,1,2,["https://example.com/' + payload['photo_id'] + '.jpg?a=1' + expiry + '"]]]}}'
+
+        client = OfflineClient(respond)
+        self.assertRaises(FBchatFacebookError, client.fetchImageUrls, *range(5))
+        self.assertEqual(sorted(requested), ['0', '1', '2', '3', '4'])
+        # The urls that were fetched before one of them failed are cached
+        self.assertEqual(sorted(client.image_url_cache.get_many(['0', '1', '2', '4'])[0]), ['0', '1', '4'])
+        requested[:] = []
+        urls = client.fetchImageUrls(0, 1, 2)
+        self.assertEqual(requested, ['2'])
+        self.assertEqual(urls['0'], 'https://example.com/0.jpg?a=1')
+        self.assertTrue(urls['2'].startswith('https://example.com/2.jpg?a=1&oe='))
+
+
+    def test_fetch_image_urls_relogin(self):
+        def respond(method, url, payload):
+            if payload['fb_dtsg'] == '1':
+                # The session from the first login has expired
+                return 'for (;;);{"error":1357004,"errorDescription":"Please try closing and re-opening your browser window."}'
+            return 'for (;;);{"jsmods":{"require":[[0,1,2,["https://example.com/' + payload['photo_id'] + '.jpg"]]]}}'
+
+        client = OfflineClient(respond)
+        self.assertEqual(client.fetchImageUrls(1, 2), {'1': 'https://example.com/1.jpg', '2': 'https://example.com/2.jpg'})
+        # The session was refreshed once, and the requests were resent
+        self.assertEqual(client._session.logins, 2)
+
+class TestConnectionPools(unittest.TestCase):
+    """Doesn't need an account"""
+
+    def adapters(self, client):
+        """Returns the pool size and blocking of each host's adapter, in a real session of `client`"""
+        session = Client._createSession(client)
+        adapters = {host: session.get_adapter('https://{}/'.format(host)) for host in client.pool_sizes}
+        return {host: (adapter._pool_maxsize, adapter._pool_block) for host, adapter in adapters.items()}
+
+    def test_pool_sizes(self):
+        self.assertEqual(self.adapters(OfflineClient()), {host: (size, False) for host, size in POOL_SIZES.items()})
+        client = OfflineClient(pool_sizes={'www.facebook.com': 20, 'scontent.xx.fbcdn.net': 4}, pool_block=True)
+        expected = {host: (size, True) for host, size in POOL_SIZES.items()}
+        expected.update({'www.facebook.com': (20, True), 'scontent.xx.fbcdn.net': (4, True)})
+        self.assertEqual(self.adapters(client), expected)
+        # Other hosts use the default adapter
+        self.assertEqual(Client._createSession(client).get_adapter('https://example.com/')._pool_maxsize, requests.adapters.DEFAULT_POOLSIZE)
+
+    def test_prewarm_connections(self):
+        requested = []
+        lock = threading.Lock()
+
+        def respond(method, url, payload):
+            with lock:
+                requested.append((method, url))
+            return ''
+
+        client = OfflineClient(respond)
+        client.prewarmConnections()
+        hosts = sorted(host for host in POOL_SIZES if host.endswith('-edge-chat.facebook.com'))
+        self.assertEqual(sorted(requested), [('HEAD', 'https://{}/'.format(host)) for host in hosts])
+        requested[:] = []
+        client.prewarmConnections({'www.facebook.com': 2, 'upload.facebook.com': 1})
+        self.assertEqual(sorted(requested), [('HEAD', 'https://upload.facebook.com/')] + [('HEAD', 'https://www.facebook.com/')] * 2)
+
+
+class TestPagination(unittest.TestCase):
+    """Doesn't need an account"""
+
+    def setUp(self):
+        self.client = OfflineClient()
+
+    def test_thread_page(self):
+        seen = set()
+        threads = [User(str(i), last_message_timestamp=str(100 - i)) for i in range(3)]
+        new, before = self.client._threadPage(threads, 3, seen)
+        self.assertEqual((new, before), (threads, 98))
+        # The cursor is an int, like the `before` of `fetchThreadList` and `_messagePage`
+        self.assertIsInstance(before, int)
+        # Pages overlap at the `before` timestamp
+        threads = [User('2', last_message_timestamp='98'), User('3', last_message_timestamp='97')]
+        self.assertEqual(self.client._threadPage(threads, 2, seen), (threads[1:], 97))
+        self.assertEqual(self.client._threadPage(threads[1:], 2, seen), ([], None))
+        self.assertEqual(seen, {'0', '1', '2', '3'})
+
+    def test_thread_page_stuck(self):
+        # If a whole page has the same timestamp, listing can't go on, which is logged instead of cutting the list silently
+        seen = set()
+        threads = [User(str(i), last_message_timestamp='100') for i in range(3)]
+        self.assertEqual(self.client._threadPage(threads, 3, seen), (threads, 100))
+        with self.assertLogs('client', logging.WARNING) as cm:
+            self.assertEqual(self.client._threadPage(threads, 3, seen), ([], None))
+        self.assertIn('Stopped listing threads at 100', cm.output[0])
+
+
+    def message(self, uid, timestamp):
+        message = Message(text=uid)
+        message.uid = uid
+        message.timestamp = timestamp
+        return message
+
+    def test_message_page(self):
+        boundary = set()
+        messages = [self.message(str(i), str(100 - i // 2)) for i in range(4)]
+        self.assertEqual(self.client._messagePage(messages, 4, boundary), (messages, 99))
+        self.assertEqual(boundary, {'2', '3'})
+        # Pages overlap at the `before` timestamp
+        messages = messages[2:] + [self.message('4', '98')]
+        self.assertEqual(self.client._messagePage(messages, 4, boundary), (messages[2:], None))
+
+    def test_message_page_stuck(self):
+        boundary = set()
+        messages = [self.message(str(i), '100') for i in range(3)]
+        self.assertEqual(self.client._messagePage(messages, 3, boundary), (messages, 100))
+        with self.assertLogs('client', logging.WARNING) as cm:
+            self.assertEqual(self.client._messagePage(messages, 3, boundary), ([], None))
+        self.assertIn('Stopped fetching messages at 100', cm.output[0])
+
+class ExportClient(OfflineClient):
+    """Serves three groups with five messages each, and fails once when fetching a later page of messages from `fail_thread`"""
+
+    def __init__(self, fail_thread=None):
+        self.fail_thread = fail_thread
+        self.requests = []
+        super(ExportClient, self).__init__()
+
+    def graphql_request(self, query):
+        params = query.value['query_params']
+        self.requests.append(('threads', params['limit'], params['before']))
+        nodes = [{
+            'thread_type': 'GROUP',
+            'thread_key': {'thread_fbid': str(i)},
+            'last_message': {'nodes': [{'timestamp_precise': str(100 - i)}]},
+        } for i in range(3) if params['before'] is None or 100 - i <= int(params['before'])]
+        return {'viewer': {'message_threads': {'nodes': nodes[:params['limit']]}}}
+
+    def fetchThreadMessages(self, thread_id=None, limit=20, before=None, lazy=False):
+        self.requests.append((thread_id, limit, before))
+        if thread_id == self.fail_thread and before is not None:
+            self.fail_thread = None
+            raise FBchatFacebookError('Error when sending request: Got 500 response', request_status_code=500)
+        messages = [LazyMessage({'message_id': '{}-{}'.format(thread_id, i), 'timestamp_precise': str(50 - i)}) for i in range(5)]
+        return [message for message in messages if before is None or int(message.timestamp) <= before][:limit]
+
+
+class TestExporter(unittest.TestCase):
+    """Exports from a stub client. Doesn't need an account"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, *parts):
+        with gzip.open(path.join(self.directory, *parts), 'rb') as f:
+            return [json.loads(line.decode('utf-8')) for line in f]
+
+    def test_resume(self):
+        client = ExportClient(fail_thread='1')
+        exporter = Exporter(client, self.directory, locations=[ThreadLocation.INBOX], workers=1, page_size=2)
+        self.assertRaises(FBchatFacebookError, exporter.run)
+        # The threads are listed `page_size` at a time, and the other threads are exported even though one failed
+        self.assertEqual([request for request in client.requests if request[0] == 'threads'], [('threads', 2, None), ('threads', 2, 99), ('threads', 2, 98)])
+        self.assertEqual(len(self.read('messages', '0.jsonl.gz')), 5)
+        self.assertEqual(len(self.read('messages', '2.jsonl.gz')), 5)
+        self.assertEqual(len(self.read('messages', '1.jsonl.gz')), 2)
+
+        client.requests = []
+        self.assertEqual(exporter.run(), {'threads': 3, 'messages': 15})
+        # Only the failed thread is fetched again, starting at the page that failed
+        self.assertEqual(client.requests, [('1', 2, 49), ('1', 2, 48), ('1', 2, 47), ('1', 2, 46)])
+        self.assertEqual([thread['thread_key']['thread_fbid'] for thread in self.read('threads-INBOX.jsonl.gz')], ['0', '1', '2'])
+        self.assertEqual([message['message_id'] for message in self.read('messages', '1.jsonl.gz')], ['1-{}'.format(i) for i in range(5)])
+
+    def test_rate_limit(self):
+        client = ExportClient()
+        exporter = Exporter(client, self.directory, locations=[ThreadLocation.INBOX], workers=2, page_size=2, requests_per_second=1000)
+        exporter.run()
+        # The limit is the exporter's own, so the other requests of the client aren't limited by it
+        self.assertEqual(client.rate_limiter.get_stats(), {})
+        self.assertEqual(exporter.rate_limiter.get_stats()[get_endpoint(ReqUrl.GRAPHQL)]['requests'], len(client.requests))
+
+
+class TestUserDirectory(unittest.TestCase):
+    """Doesn't need an account"""
+
+    def user(self, uid, **kwargs):
+        return User(uid, name='User {}'.format(uid), first_name='User', url='https://facebook.com/{}'.format(uid), **kwargs)
+
+    def test_update(self):
+        directory = UserDirectory()
+        self.assertEqual(directory.update([self.user(1), self.user(2)]), 2)
+        self.assertEqual(directory.update([self.user(1), self.user(2)]), 0)
+        # Every attribute is compared, not only the ones from `fetchAllUsers`
+        self.assertEqual(directory.update([self.user(1, nickname='One'), self.user(2)]), 1)
+        self.assertEqual(directory.get(1).nickname, 'One')
+        self.assertEqual(directory.update([self.user(1, nickname='One')]), 1)
+        self.assertNotIn(2, directory)
+
+    def test_save_load(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            directory = UserDirectory(path.join(tmp, 'users.json'))
+            users = [self.user(1, last_name='One', nickname='Uno', own_nickname='Me', color=ThreadColor.VIKING, emoji='x', affinity=0.5, last_message_timestamp='123', message_count=3), self.user(2)]
+            directory.update(users)
+            directory.save()
+            loaded = UserDirectory(path.join(tmp, 'users.json'))
+            self.assertEqual(loaded.updated_at, directory.updated_at)
+            for user in users:
+                self.assertEqual(vars(loaded.get(user.uid)), vars(user))
+            self.assertEqual(loaded.search('user 1'), [loaded.get(1)])
+        finally:
+            shutil.rmtree(tmp)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files in `server.files` with support for `Range` requests.
+    Files whose name starts with `norange` are always sent whole, and the size of files starting with `nosize` is left out of `Content-Range`
+    """
+
+    def do_GET(self):
+        name = self.path.lstrip('/').split('?')[0]
+        self.server.requests.append((name, self.headers.get('Range')))
+        if name not in self.server.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        content = self.server.files[name]
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match is None or name.startswith('norange'):
+            self.send_response(200)
+        elif int(match.group(1)) >= len(content):
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        else:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(content) - 1), len(content) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, '*' if name.startswith('nosize') else len(content)))
+            content = content[start:end + 1]
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestDownloadManager(unittest.TestCase):
+    """Downloads from a local server. Doesn't need an account"""
+
+    def setUp(self):
+        self.server = RangeServer(('127.0.0.1', 0), RangeHandler)
+        self.server.files = {}
+        self.server.requests = []
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        self.directory = tempfile.mkdtemp()
+        self.client = OfflineClient()
+        self.manager = DownloadManager(self.client, self.directory, part_size=10, chunk_size=4)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def url(self, name, query=''):
+        return 'http://127.0.0.1:{}/{}{}'.format(self.server.server_address[1], name, query)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        files = {'a': bytes(bytearray(range(256))) * 2, 'b': b'small', 'norange': b'0123456789' * 3, 'nosize': b'abcdefghij' * 3, 'nosize-small': b'abc', 'empty': b''}
+        self.server.files.update(files)
+        paths = self.manager.download_many([self.url(name) for name in files])
+        for name, content in files.items():
+            self.assertEqual(self.read(paths[self.url(name)]), content)
+        # Large files are split into parts, unless the server doesn't support ranges, or doesn't tell their size
+        self.assertEqual(len([name for name, range in self.server.requests if name == 'a']), 52)
+        self.assertEqual([range for name, range in self.server.requests if name == 'norange'], ['bytes=0-9'])
+        self.assertEqual([range for name, range in self.server.requests if name == 'nosize'], ['bytes=0-9', 'bytes=10-'])
+        # The downloads count towards the client's metrics
+        self.assertEqual(self.client.metrics.get('fbchat_requests_total'), len(self.server.requests))
+        self.assertEqual(self.client.metrics.get('fbchat_requests_total', status=200), 1)
+        self.assertEqual(self.client.metrics.get('fbchat_requests_total', status=416), 1)
+        self.assertEqual(self.client.metrics.get('fbchat_response_bytes_total'), sum(len(content) for content in files.values()))
+        self.assertEqual(self.client.metrics.get('fbchat_downloads_total'), len(files))
+        # Every file has its own url, but they're all labeled by the host, so the number of labels doesn't grow with the files
+        labels = set(labels for name, labels in self.client.metrics._values if name == 'fbchat_requests_total')
+        self.assertEqual(set(dict(label)['endpoint'] for label in labels), {'http://127.0.0.1:{}'.format(self.server.server_address[1])})
+        self.assertEqual(len(labels), 3)
+
+    def test_cache(self):
+        self.server.files.update({'a': b'content', 'b': b'content'})
+        path = self.manager.download(self.url('a', '?oh=1&oe=2'))
+        # Signed anew, the url is found in the cache, and files with the same content are stored once
+        self.assertEqual(self.manager.download(self.url('a', '?oh=3&oe=4')), path)
+        self.assertEqual(self.manager.download(self.url('b')), path)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.manager.get_stats()['cached'], 1)
+        self.assertEqual(DownloadManager(self.client, self.directory).get_cached(self.url('a')), path)
+
+    def test_error(self):
+        self.server.files['a'] = b'content'
+        self.assertRaises(FBchatFacebookError, self.manager.download_many, [self.url('a'), self.url('missing')])
+        # The other downloads are finished
+        self.assertIsNotNone(self.manager.get_cached(self.url('a')))
+        self.assertEqual(listdir(path.join(self.directory, 'tmp')), [])
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """Doesn't need an account"""
+
+    def test_get_delay(self):
+        policy = RetryPolicy(backoff=0.5, max_backoff=3)
+        for attempt in range(10):
+            for i in range(20):
+                self.assertTrue(0 <= policy.get_delay(attempt) <= min(3, 0.5 * 2 ** attempt))
+
+    def test_get_retries(self):
+        policy = RetryPolicy(max_retries=3, budgets={ReqUrl.SEND: 1})
+        self.assertEqual(policy.get_retries(ReqUrl.GRAPHQL), 3)
+        self.assertEqual(policy.get_retries(ReqUrl.SEND + '?a=1'), 1)
+        # Every pull channel counts as the same endpoint
+        self.assertEqual(policy.get_retries('https://3-edge-chat.facebook.com/pull'), 0)
+        self.assertEqual(policy.get_retries(ReqUrl.PING), 0)
+        self.assertEqual(RetryPolicy(budgets={ReqUrl.STICKY: 2}).get_retries(ReqUrl.STICKY), 2)
+
+    def test_is_retryable(self):
+        policy = RetryPolicy()
+        expired = FBchatFacebookError('', fb_error_code='1357004')
+        unavailable = FBchatFacebookError('', request_status_code=503)
+        for idempotent in [True, False]:
+            self.assertTrue(policy.is_retryable(expired, idempotent))
+            self.assertFalse(policy.is_retryable(FBchatFacebookError('', request_status_code=400), idempotent))
+            self.assertFalse(policy.is_retryable(ValueError(), idempotent))
+        self.assertTrue(policy.is_retryable(unavailable))
+        self.assertTrue(policy.is_retryable(requests.Timeout()))
+        self.assertFalse(policy.is_retryable(unavailable, idempotent=False))
+        self.assertFalse(policy.is_retryable(requests.Timeout(), idempotent=False))
+
+    def test_is_idempotent(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.is_idempotent('GET', ReqUrl.THREAD_COLOR))
+        self.assertTrue(policy.is_idempotent('POST', ReqUrl.SEND))
+        self.assertTrue(policy.is_idempotent('POST', ReqUrl.GRAPHQL))
+        self.assertFalse(policy.is_idempotent('POST', ReqUrl.THREAD_COLOR))
+        self.assertFalse(policy.is_idempotent('POST', ReqUrl.READ_STATUS))
+
+    def test_allows(self):
+        self.assertTrue(RetryPolicy().allows(1000, 1000))
+        policy = RetryPolicy(deadline=1)
+        self.assertTrue(policy.allows(0.5, 0.5))
+        self.assertFalse(policy.allows(0.5, 0.6))
+
+    def test_client_retry(self):
+        client = OfflineClient(retry_policy=RetryPolicy(max_retries=2, backoff=0))
+        attempts = []
+
+        def failing(*errors):
+            def request():
+                attempts.append(None)
+                if len(attempts) <= len(errors):
+                    raise errors[len(attempts) - 1]
+                return 'ok'
+            del attempts[:]
+            return request
+
+        unavailable = FBchatFacebookError('', request_status_code=503)
+        self.assertEqual(client._retry(ReqUrl.GRAPHQL, failing(unavailable, requests.Timeout()), method='POST'), 'ok')
+        self.assertEqual(len(attempts), 3)
+        self.assertRaises(FBchatFacebookError, client._retry, ReqUrl.GRAPHQL, failing(unavailable, unavailable, unavailable))
+        self.assertEqual(len(attempts), 3)
+        # Changing a thread might already have happened, so it isn't resent
+        self.assertRaises(FBchatFacebookError, client._retry, ReqUrl.THREAD_COLOR, failing(unavailable), method='POST')
+        self.assertEqual(len(attempts), 1)
+        self.assertRaises(FBchatFacebookError, client._retry, ReqUrl.STICKY, failing(unavailable))
+        self.assertEqual(len(attempts), 1)
+        self.assertRaises(ValueError, client._retry, ReqUrl.GRAPHQL, failing(ValueError()))
+        self.assertEqual(len(attempts), 1)
+        # An expired session is refreshed, and the request is resent
+        logins = client._session.logins
+        self.assertEqual(client._retry(ReqUrl.THREAD_COLOR, failing(FBchatFacebookError('', fb_error_code='1357004')), method='POST'), 'ok')
+        self.assertEqual(client._session.logins, logins + 1)
+
+    def test_post_file(self):
+        client = OfflineClient(lambda method, url, payload: 'for (;;);{"payload":{}}')
+        self.assertEqual(client._postFile(ReqUrl.UPLOAD, fix_request=True, as_json=True), {'payload': {}})
+        # Files that were partially read are rewound before they're sent
+        f = BytesIO(b'image')
+        f.read(3)
+        client._postFile(ReqUrl.UPLOAD, {'upload_1024': ('image.png', f, 'image/png')})
+        self.assertEqual(f.tell(), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Runs on a fake clock. Doesn't need an account"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.clock = ratelimit.clock
+        ratelimit.clock = lambda: self.now
+
+    def tearDown(self):
+        ratelimit.clock = self.clock
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0])
+        # The next reservations wait for their token, in order
+        self.assertEqual([bucket.reserve() for i in range(3)], [0.5, 1.0, 1.5])
+        self.assertEqual(bucket.get_queued(), 3)
+
+    def test_refill(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        for i in range(3):
+            bucket.reserve()
+        self.now += 1
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0.5])
+        # The bucket never holds more than `burst` tokens
+        self.now += 100
+        self.assertEqual([bucket.reserve() for i in range(4)], [0, 0, 0, 0.5])
+        self.now += 0.5
+        self.assertEqual(bucket.get_queued(), 0)
+
+    def test_invalid(self):
+        for rate, burst in [(0, 1), (-1, 1), (1, 0)]:
+            self.assertRaises(FBchatUserError, TokenBucket, rate, burst)
+            self.assertRaises(FBchatUserError, RateLimiter().set_limit, ReqUrl.SEND, rate, burst)
+        self.assertRaises(FBchatUserError, RateLimiter, {ReqUrl.SEND: (0, 1)})
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter({ReqUrl.SEND: (1, 2)})
+        self.assertEqual([limiter.reserve(ReqUrl.SEND + '?a=1') for i in range(4)], [0, 0, 1, 2])
+        # Other endpoints aren't limited
+        self.assertEqual(limiter.reserve(ReqUrl.GRAPHQL), 0)
+        stats = limiter.get_stats()
+        self.assertEqual(list(stats), [ratelimit.get_endpoint(ReqUrl.SEND)])
+        self.assertEqual(stats[ratelimit.get_endpoint(ReqUrl.SEND)], {'requests': 4, 'delayed': 2, 'wait_time': 3, 'max_wait_time': 2, 'queued': 2})
+
+
+class TestTTLCache(unittest.TestCase):
+    """Runs on a fake clock. Doesn't need an account"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self.clock = cache.clock
+        cache.clock = lambda: self.now
+
+    def tearDown(self):
+        cache.clock = self.clock
+
+    def test_expiry(self):
+        ttl_cache = TTLCache(ttl=10)
+        ttl_cache.set('a', 1)
+        self.now += 9.9
+        self.assertEqual(ttl_cache.get('a'), 1)
+        self.now += 0.1
+        self.assertIsNone(ttl_cache.get('a'))
+        self.assertEqual(ttl_cache.get('a', 2), 2)
+        self.assertEqual(len(ttl_cache), 0)
+
+    def test_ttl_override(self):
+        ttl_cache = TTLCache(ttl=10)
+        ttl_cache.set_many({'a': 1, 'b': 2}, ttl=5)
+        # A longer `ttl` than the cache's own is capped
+        ttl_cache.set('c', 3, ttl=60)
+        self.now += 5
+        self.assertEqual(ttl_cache.get_many(['a', 'b', 'c']), ({'c': 3}, ['a', 'b']))
+        self.now += 5
+        self.assertEqual(ttl_cache.get_many(['c']), ({}, ['c']))
+        # Values that have already expired aren't stored
+        ttl_cache.set('d', 4, ttl=0)
+        self.assertEqual(len(ttl_cache), 0)
+
+    def test_lru_eviction(self):
+        ttl_cache = TTLCache(max_size=3)
+        ttl_cache.set_many({'a': 1, 'b': 2, 'c': 3})
+        # Looking up "a" makes "b" the least recently used
+        self.assertEqual(ttl_cache.get('a'), 1)
+        ttl_cache.set('d', 4)
+        self.assertEqual(ttl_cache.get_many(['a', 'b', 'c', 'd']), ({'a': 1, 'c': 3, 'd': 4}, ['b']))
+        # Storing "c" again makes it the most recently used
+        ttl_cache.set('c', 5)
+        ttl_cache.set_many({'e': 6})
+        self.assertEqual(ttl_cache.get_many(['a', 'c', 'd', 'e']), ({'c': 5, 'd': 4, 'e': 6}, ['a']))
+        self.assertEqual(len(ttl_cache), 3)
+
+    def test_disabled(self):
+        for ttl_cache in [TTLCache(ttl=0), TTLCache(max_size=0)]:
+            ttl_cache.set('a', 1)
+            self.assertIsNone(ttl_cache.get('a'))
+            self.assertEqual(len(ttl_cache), 0)
+
+    def test_stats(self):
+        ttl_cache = TTLCache()
+        self.assertEqual(ttl_cache.get_stats(), {'hits': 0, 'misses': 0, 'hit_rate': 0.0, 'size': 0})
+        ttl_cache.set('a', 1)
+        ttl_cache.get_many(['a', 'b', 'c'])
+        ttl_cache.get('a')
+        self.assertEqual(ttl_cache.get_stats(), {'hits': 2, 'misses': 2, 'hit_rate': 0.5, 'size': 1})
+        ttl_cache.invalidate('a')
+        ttl_cache.get('a')
+        self.assertEqual(ttl_cache.get_stats(), {'hits': 2, 'misses': 3, 'hit_rate': 0.4, 'size': 0})
+        ttl_cache.set('a', 1)
+        ttl_cache.clear()
+        self.assertEqual(len(ttl_cache), 0)
+
+
+class TestMetrics(unittest.TestCase):
+    """Doesn't need an account"""
+
+    def test_to_prometheus(self):
+        metrics = MetricsRegistry(buckets=(0.1, 1))
+        metrics.inc('fbchat_requests_total', endpoint='a', method='send', status=200)
+        metrics.inc('fbchat_requests_total', 2, endpoint='a', method='send', status='error')
+        metrics.observe('fbchat_request_duration_seconds', 0.5, endpoint='a', method='send')
+        metrics.observe('fbchat_request_duration_seconds', 5, endpoint='a', method='send')
+        self.assertEqual(metrics.get('fbchat_requests_total'), 3)
+        self.assertEqual(metrics.get('fbchat_requests_total', status=200), 1)
+        self.assertEqual(metrics.get('fbchat_requests_total', status='error'), 2)
+        self.assertEqual(metrics.get('fbchat_request_duration_seconds'), (2, 5.5))
+        self.assertEqual(metrics.to_prometheus().splitlines(), [
+            '# HELP fbchat_request_duration_seconds Time spent waiting for Facebook to respond',
+            '# TYPE fbchat_request_duration_seconds histogram',
+            'fbchat_request_duration_seconds_bucket{endpoint="a",method="send",le="0.1"} 0',
+            'fbchat_request_duration_seconds_bucket{endpoint="a",method="send",le="1"} 1',
+            'fbchat_request_duration_seconds_bucket{endpoint="a",method="send",le="+Inf"} 2',
+            'fbchat_request_duration_seconds_sum{endpoint="a",method="send"} 5.5',
+            'fbchat_request_duration_seconds_count{endpoint="a",method="send"} 2',
+            '# HELP fbchat_requests_total Number of requests sent to Facebook',
+            '# TYPE fbchat_requests_total counter',
+            'fbchat_requests_total{endpoint="a",method="send",status="200"} 1',
+            'fbchat_requests_total{endpoint="a",method="send",status="error"} 2',
+        ])
+
+    def test_method_labels(self):
+        def respond(method, url, payload):
+            if url == ReqUrl.SEND:
+                return 'for (;;);{"payload":{"actions":[{"message_id":"mid.$1"}]}}'
+            if url == ReqUrl.ATTACHMENT_PHOTO:
+                return 'for (;;);{"jsmods":{"require":[[0,1,2,["https://example.com/' + payload['photo_id'] + '.jpg"]]]}}'
+            if url == ReqUrl.GRAPHQL:
+                return '{"q0":{"data":{"viewer":{"message_threads":{"nodes":[]}}}}}\r\n{"successful_results":1,"error_results":0}'
+
+        client = OfflineClient(respond)
+        client.send(Message(text='a'), thread_id='2')
+        # Public methods calling each other are counted towards the outermost one
+        client.sendMessage('b', thread_id='2')
+        # Requests sent from worker threads are counted towards the method that started them
+        client.fetchImageUrls(*range(5))
+        self.assertEqual(list(client.iterThreads()), [])
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='send'), 1)
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='sendMessage'), 1)
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='fetchImageUrls'), 5)
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='iterThreads'), 1)
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='unknown'), 0)
+        self.assertEqual(client._getCaller(), 'unknown')
+        # The calling thread takes part in the work, and gets its own label back afterwards
+        client._local.caller = 'outer'
+        client._runConcurrently([client._getCaller] * 3, 2)
+        self.assertEqual(client._getCaller(), 'outer')
+        client._local.caller = None
+        self.assertEqual(client._runConcurrently([client._getCaller] * 3, 2), ['unknown'] * 3)
+        self.assertIsNone(client._local.caller)
+
+
+    def test_listen_labels(self):
+        def respond(method, url, payload):
+            if url == ReqUrl.STICKY and 'channel' in payload:
+                return 'for (;;);{"lb_info":{"sticky":"1","pool":"2"}}'
+            if url == ReqUrl.STICKY:
+                return 'for (;;);' + json.dumps({'seq': 1, 'ms': [{'type': 'delta', 'delta': {
+                    'class': 'NewMessage',
+                    'body': 'ping',
+                    'messageMetadata': {'messageId': 'mid.$1', 'actorFbId': '2', 'timestamp': '1', 'threadKey': {'otherUserFbId': '2'}, 'tags': ['hot_emoji_size:small']},
+                }}]})
+            if url == ReqUrl.SEND:
+                return 'for (;;);{"payload":{"actions":[{"message_id":"mid.$2"}]}}'
+
+        class EchoClient(OfflineClient):
+            def onMessage(self, message_object=None, thread_id=None, thread_type=None, **kwargs):
+                self.send(Message(text=message_object.text), thread_id=thread_id, thread_type=thread_type)
+                self.listening = False
+
+        client = EchoClient(respond)
+        client.listen(markAlive=False)
+        # Requests sent from the callbacks are labeled by the methods they call, instead of `listen`
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='send'), 1)
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='listen'), 2)
+        self.assertIsNone(client._local.caller)
+
+class TestGraphQLBatcher(unittest.TestCase):
+    """Sends the batches to a stub. Doesn't need an account"""
+
+    def setUp(self):
+        self.sent = []
+
+    def send(self, *queries):
+        # Doubles every query, and fails the negative ones
+        self.sent.append(queries)
+        results = {i: query * 2 for i, query in enumerate(queries) if query >= 0}
+        errors = {i: FBchatFacebookError('Bad query', fb_error_code='1545012') for i, query in enumerate(queries) if query < 0}
+        return results, errors
+
+    def request_concurrently(self, batcher, queries):
+        """Requests every query from its own thread, and returns the results and errors"""
+        results = [None] * len(queries)
+
+        def request(i):
+            try:
+                results[i] = batcher.request(queries[i])
+            except Exception as e:
+                results[i] = e
+
+        workers = [threading.Thread(target=request, args=(i,)) for i in range(len(queries))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def test_window(self):
+        batcher = GraphQLBatcher(self.send, window=0.2)
+        self.assertEqual(self.request_concurrently(batcher, [1, 2, 3, 4]), [2, 4, 6, 8])
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(sorted(self.sent[0]), [1, 2, 3, 4])
+        self.assertEqual((batcher.queries, batcher.batches), (4, 1))
+        # A query after the window starts a new batch
+        self.assertEqual(batcher.request(5), 10)
+        self.assertEqual(self.sent[1], (5,))
+
+    def test_max_size(self):
+        batcher = GraphQLBatcher(self.send, window=10, max_size=3)
+        start = time.time()
+        self.assertEqual(self.request_concurrently(batcher, list(range(6))), [0, 2, 4, 6, 8, 10])
+        # Full batches are sent right away, without waiting for the window
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(sorted(len(queries) for queries in self.sent), [3, 3])
+
+    def test_errors(self):
+        batcher = GraphQLBatcher(self.send, window=0.2)
+        results = self.request_concurrently(batcher, [1, -1, 2])
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual((results[0], results[2]), (2, 4))
+        self.assertIsInstance(results[1], FBchatFacebookError)
+
+        def fail(*queries):
+            raise FBchatFacebookError('Got 500 response', request_status_code=500)
+
+        batcher = GraphQLBatcher(fail, window=0.2)
+        for result in self.request_concurrently(batcher, [1, 2]):
+            self.assertIsInstance(result, FBchatFacebookError)
+
+    def test_missing_result(self):
+        batcher = GraphQLBatcher(lambda *queries: ({}, {}), window=0)
+        self.assertRaises(FBchatException, batcher.request, 1)
+
+def model_to_dict(obj):
+    """Converts a model and the models in its attributes to dicts, so models without `__eq__` can be compared"""
+    if isinstance(obj, list):
+        return [model_to_dict(item) for item in obj]
+    if isinstance(obj, dict):
+        return {key: model_to_dict(value) for key, value in obj.items()}
+    if hasattr(obj, '__dict__') and not isinstance(obj, Enum):
+        return dict(model_to_dict(vars(obj)), __class__=type(obj).__name__)
+    return obj
+
+def make_message(uid, **kwargs):
+    message = {
+        'message_id': 'mid.${}'.format(uid),
+        'message_sender': {'id': '2'},
+        'timestamp_precise': '1510000000000',
+        'unread': False,
+        'message': {'text': 'Message {}'.format(uid), 'ranges': []},
+        'sticker': None,
+        'blob_attachments': [],
+        'message_reactions': [],
+        'tags_list': ['source:messenger:web', 'inbox'],
+    }
+    message.update(kwargs)
+    return message
+
+def make_messages():
+    """A text, mention, sticker, attachment and reaction message"""
+    return [
+        make_message(1, tags_list=['hot_emoji_size:small'], unread=True),
+        make_message(2, message={'text': '@Jon hi', 'ranges': [{'entity': {'id': '3'}, 'offset': 0, 'length': 4}]}),
+        make_message(3, message=None, sticker={'id': '4', 'pack': {'id': '5'}, 'url': 'https://example.com/sticker.png', 'width': 64, 'height': 64, 'label': 'Like'}),
+        make_message(4, blob_attachments=[{
+            '__typename': 'MessageImage',
+            'legacy_attachment_id': '6',
+            'filename': 'image-6.png',
+            'original_dimensions': {'width': 100, 'height': 50},
+            'thumbnail': {'uri': 'https://example.com/thumbnail.png'},
+            'preview': {'uri': 'https://example.com/preview.png'},
+        }]),
+        make_message(5, message_reactions=[{'user': {'id': '2'}, 'reaction': '😍'}, {'user': {'id': '3'}, 'reaction': '👍'}]),
+    ]
+
+def make_thread(thread_type):
+    """A `ONE_TO_ONE` thread with the user 2, or the `GROUP` thread 10"""
+    thread = {
+        'thread_type': thread_type,
+        'thread_key': {'thread_fbid': '10' if thread_type == 'GROUP' else None, 'other_user_id': None if thread_type == 'GROUP' else '2'},
+        'name': 'Group' if thread_type == 'GROUP' else None,
+        'image': {'uri': 'https://example.com/group.png'},
+        'messages_count': 42,
+        'all_participants': {'nodes': [
+            {'messaging_actor': {'id': '1', 'name': 'Me Myself', 'short_name': 'Me'}},
+            {'messaging_actor': {
+                'id': '2',
+                'url': 'https://www.facebook.com/jon',
+                'name': 'Jon Snow',
+                'short_name': 'Jon',
+                'is_viewer_friend': True,
+                'gender': 'MALE',
+                'big_image_src': {'uri': 'https://example.com/jon.png'},
+            }},
+        ]},
+        'customization_info': {'emoji': '👍', 'outgoing_bubble_color': 'FF44BEC7', 'participant_customizations': [
+            {'participant_id': '1', 'nickname': 'Me'},
+            {'participant_id': '2', 'nickname': 'Jonny'},
+        ]},
+        'last_message': {'nodes': [{'timestamp_precise': '1510000000000'}]},
+    }
+    if thread_type == 'GROUP':
+        del thread['customization_info']['participant_customizations'][0]['nickname']
+    return thread
+
+class TestGraphQLConverters(unittest.TestCase):
+    """Compares the converters of GraphQL results on fixtures. Doesn't need an account"""
+
+    def test_graphql_to_messages(self):
+        messages = make_messages()
+        expected = [model_to_dict(graphql_to_message(message)) for message in make_messages()]
+        self.assertEqual([model_to_dict(message) for message in graphql_to_messages(messages)], expected)
+        # Unlike `graphql_to_message`, the messages aren't modified
+        self.assertEqual(messages, make_messages())
+
+    def assertLazyParity(self, lazy, eager):
+        """Checks that `lazy` has the same attributes as `eager`, and that it only converts each of them once"""
+        names = sorted(vars(eager))
+        values = [getattr(lazy, name) for name in names]
+        self.assertEqual([model_to_dict(value) for value in values], [model_to_dict(getattr(eager, name)) for name in names])
+        # The converted attributes are stored on the instance, so they're read again without converting the GraphQL result
+        names = [name for name in names if isinstance(getattr(type(lazy), name, None), lazy_property)]
+        self.assertTrue(names)
+        self.assertTrue(set(names) <= set(vars(lazy)))
+        lazy._graphql = None
+        for name in names:
+            self.assertIs(getattr(lazy, name), vars(lazy)[name])
+
+    def test_lazy_message(self):
+        for message in make_messages():
+            self.assertLazyParity(LazyMessage(message), graphql_to_message(deepcopy(message)))
+
+    def test_lazy_user(self):
+        thread = make_thread('ONE_TO_ONE')
+        self.assertLazyParity(graphql_to_thread(thread, lazy=True), graphql_to_thread(deepcopy(thread)))
+
+    def test_lazy_group(self):
+        thread = make_thread('GROUP')
+        self.assertLazyParity(graphql_to_thread(thread, lazy=True), graphql_to_thread(deepcopy(thread)))
+
+class TestThreadInfo(unittest.TestCase):
+    """Fetches threads and messages from a fake Facebook, with the user 2 and the group 10. Doesn't need an account"""
+
+    def setUp(self):
+        self.requests = []
+        self.info_requested = threading.Event()
+        self.wait_for_info = False
+        self.failed_info = 0
+        self.client = OfflineClient(self.respond)
+
+    def respond(self, method, url, payload):
+        self.requests.append(url)
+        if url == ReqUrl.GRAPHQL:
+            if self.wait_for_info:
+                # Answered once the profiles are requested too, or after a timeout if they're requested afterwards
+                self.concurrent = self.info_requested.wait(5)
+            results = []
+            for name, query in sorted(json.loads(payload['queries']).items()):
+                thread = make_thread('GROUP' if query['query_params']['id'] == '10' else 'ONE_TO_ONE')
+                thread['messages'] = {'nodes': make_messages(), 'page_info': {'has_previous_page': False}}
+                results.append(json.dumps({name: {'data': {'message_thread': thread}}}))
+            return '\r\n'.join(results)
+        if url == ReqUrl.INFO:
+            self.info_requested.set()
+            if self.failed_info > 0:
+                self.failed_info -= 1
+                return None
+            profiles = {_id: {'type': 'friend', 'name': 'Jon Snow', 'firstName': 'Jon', 'is_friend': True, 'gender': 2} for key, _id in payload.items() if key.startswith('ids[') and _id == '2'}
+            return 'for (;;);' + json.dumps({'payload': {'profiles': profiles}})
+
+    def test_fetch_thread_info_ids(self):
+        threads = self.client.fetchThreadInfo('2', '10', projection=Projection.IDS)
+        # Only the threads are fetched, and not the profile of the user
+        self.assertEqual(self.requests, [ReqUrl.GRAPHQL])
+        self.assertEqual(model_to_dict(threads), {'2': model_to_dict(User('2')), '10': model_to_dict(Group('10'))})
+
+    def test_fetch_thread_info_metadata(self):
+        for projection in (Projection.TEXT, Projection.METADATA):
+            self.requests[:] = []
+            threads = self.client.fetchThreadInfo('2', '10', projection=projection)
+            self.assertEqual(self.requests, [ReqUrl.GRAPHQL])
+            # The user only has the info that's in the thread
+            self.assertEqual(model_to_dict(threads['2']), model_to_dict(graphql_to_thread_user(make_thread('ONE_TO_ONE'))))
+            self.assertEqual(model_to_dict(threads['10']), model_to_dict(graphql_to_thread(make_thread('GROUP'))))
+        self.requests[:] = []
+        threads = self.client.fetchThreadInfo('2', '10')
+        self.assertEqual(sorted(self.requests), sorted([ReqUrl.GRAPHQL, ReqUrl.INFO]))
+        self.assertEqual((threads['2'].name, threads['2'].is_friend), ('Jon Snow', True))
+
+    def test_fetch_thread_info_prefetch(self):
+        self.wait_for_info = True
+        threads = self.client.fetchThreadInfo('2', thread_type=ThreadType.USER)
+        # The profile is fetched at the same time as the thread, and isn't fetched again afterwards
+        self.assertTrue(self.concurrent)
+        self.assertEqual(sorted(self.requests), sorted([ReqUrl.GRAPHQL, ReqUrl.INFO]))
+        self.assertEqual((threads['2'].name, threads['2'].is_friend, threads['2'].nickname), ('Jon Snow', True, 'Jonny'))
+
+    def test_fetch_thread_info_wrong_hint(self):
+        # The group doesn't have a profile, so it's only converted from the thread
+        threads = self.client.fetchThreadInfo('10', thread_type=ThreadType.USER)
+        self.assertEqual(model_to_dict(threads), {'10': model_to_dict(graphql_to_thread(make_thread('GROUP')))})
+        self.assertEqual(sorted(self.requests), sorted([ReqUrl.GRAPHQL, ReqUrl.INFO]))
+        # The profiles that couldn't be prefetched are fetched again once the threads are known
+        self.requests[:] = []
+        self.failed_info = 1
+        threads = self.client.fetchThreadInfo('2', '10', thread_type=ThreadType.USER)
+        self.assertEqual(self.requests.count(ReqUrl.INFO), 2)
+        self.assertEqual((threads['2'].name, threads['10'].name), ('Jon Snow', 'Group'))
+
+    def test_fetch_thread_messages_projection(self):
+        names = ['uid', 'author', 'timestamp', 'text', 'mentions', 'emoji_size', 'is_read', 'reactions', 'sticker', 'attachments']
+        fields = {
+            Projection.IDS: names[:3],
+            Projection.TEXT: names[:5],
+            Projection.METADATA: names[:8],
+            Projection.FULL: names,
+        }
+        full = self.client.fetchThreadMessages('2')
+        for projection, projected in fields.items():
+            messages = self.client.fetchThreadMessages('2', projection=projection)
+            self.assertEqual(len(messages), len(full))
+            for message, full_message in zip(messages, full):
+                # The fields that aren't part of the projection have their default values
+                expected = [model_to_dict(getattr(full_message if name in projected else Message(), name)) for name in names]
+                self.assertEqual([model_to_dict(getattr(message, name)) for name in names], expected)
+
+
 def start_test(param_client, param_group_id, param_user_id, param_threads, tests=[]):
     global client
     global group_id
@@ -200,15 +1345,25 @@ def start_test(param_client, param_group_id, param_user_id, param_threads, tests
     tests = ['test_' + test if 'test_' != test[:5] else test for test in tests]
 
     if len(tests) == 0:
-        suite = unittest.TestLoader().loadTestsFromTestCase(TestFbchat)
+        suite = unittest.TestSuite(unittest.TestLoader().loadTestsFromTestCase(test_case) for test_case in test_cases)
     else:
-        suite = unittest.TestSuite(map(TestFbchat, tests))
+        suite = unittest.TestSuite(next(test_case for test_case in test_cases if hasattr(test_case, test))(test) for test in tests)
     print('Starting test(s)')
     unittest.TextTestRunner(verbosity=2).run(suite)
 
 
+test_cases = [TestFbchat, TestJSONBackends, TestConcurrency, TestConnectionPools, TestPagination, TestExporter, TestUserDirectory, TestDownloadManager, TestRetryPolicy, TestRateLimiter, TestTTLCache, TestMetrics, TestGraphQLBatcher, TestGraphQLConverters, TestThreadInfo]
 client = None
 
+
+def load_tests(loader, tests, pattern):
+    # The tests of `AsyncClient` use syntax that Python 2 can't parse, so they're in their own module
+    if version_info >= (3, 5):
+        from tests_async import TestAsyncClient
+        tests.addTests(loader.loadTestsFromTestCase(TestAsyncClient))
+    return tests
+
+
 if __name__ == '__main__':
     # Python 3 does not use raw_input, whereas Python 2 does
     try:
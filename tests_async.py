@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+"""
+Offline tests for `AsyncClient`, against a local `aiohttp` server. Requires Python 3.5+, and is loaded by `tests.py` when available
+"""
+
+import asyncio
+import json
+import unittest
+from urllib.parse import urlparse
+from fbchat.models import *
+from fbchat.graphql import GraphQL
+from fbchat.utils import ReqUrl
+from tests import FakeSession, logging_level
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from fbchat import AsyncClient
+except ImportError:
+    web = None
+    AsyncClient = object
+
+
+def graphql_response(payload):
+    """Answers every query with its `id` parameter, and leaves out the queries with a negative `id`"""
+    queries = json.loads(payload['queries'])
+    results = [{name: {'data': {'id': query['query_params']['id']}}} for name, query in sorted(queries.items()) if query['query_params']['id'] >= 0]
+    return [json.dumps(result) + '\r\n' for result in results] + ['{"successful_results":%d,"error_results":0}' % len(results)]
+
+
+class AsyncOfflineClient(AsyncClient):
+    """
+    An `AsyncClient` that is logged in to a :class:`tests.FakeSession` answered by `respond`, and sends its other requests to `server`
+    """
+
+    def __init__(self, server, respond, **kwargs):
+        self.server = server
+        self.respond = respond
+        super(AsyncOfflineClient, self).__init__('email', 'password', session_cookies={'c_user': '1'}, logging_level=logging_level, **kwargs)
+
+    def _createSession(self):
+        return FakeSession(self.respond)
+
+    async def _request(self, method, url, headers=None, endpoint=None, **kwargs):
+        # The server is told which url the request was meant for
+        headers = dict(headers or {})
+        headers['X-Url'] = url
+        local_url = str(self.server.make_url(urlparse(url).path))
+        return await super(AsyncOfflineClient, self)._request(method, local_url, headers=headers, endpoint=endpoint or url, **kwargs)
+
+
+@unittest.skipIf(web is None, 'aiohttp is not installed')
+class TestAsyncClient(unittest.TestCase):
+    """Runs `AsyncClient` against a local server. Doesn't need an account"""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        self.server = TestServer(app)
+        self.wait(self.server.start_server())
+        self.streaming = asyncio.Event()
+        self.streaming.set()
+        self.clients = []
+        self.requests = []
+
+    def tearDown(self):
+        self.streaming.set()
+        for client in self.clients:
+            self.wait(client.close())
+        self.wait(self.server.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    async def handle(self, request):
+        """Answers the requests with `self.respond(method, url, payload)`. If it returns a list, the items are streamed one at a time"""
+        payload = dict(request.query)
+        if request.method == 'POST':
+            payload.update((k, v) for k, v in (await request.post()).items() if isinstance(v, str))
+        body = self.respond(request.method, request.headers['X-Url'], payload)
+        if body is None:
+            return web.Response(status=404)
+        if not isinstance(body, list):
+            return web.Response(body=body.encode('utf-8'))
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for chunk in body:
+            await response.write(chunk.encode('utf-8'))
+            await asyncio.sleep(0.05)
+        # Keeps the response open until the test ends, so the client has to release the connection itself
+        await self.streaming.wait()
+        await response.write_eof()
+        return response
+
+    def client(self, respond, cls=AsyncOfflineClient, **kwargs):
+        def record(method, url, payload):
+            self.requests.append(url)
+            return respond(method, url, payload)
+
+        self.respond = record
+        client = cls(self.server, record, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def test_graphql_requests_chunks(self):
+        client = self.client(lambda method, url, payload: ''.join(graphql_response(payload)), graphql_chunk_size=2)
+        queries = [GraphQL(doc_id='1', params={'id': i}) for i in range(5)]
+        self.assertEqual(self.wait(client.graphql_requests(*queries)), tuple({'id': i} for i in range(5)))
+        self.assertEqual(self.requests, [ReqUrl.GRAPHQL] * 3)
+        # A missing query doesn't shift the results of the other chunks
+        queries[1] = GraphQL(doc_id='1', params={'id': -1})
+        results, errors = self.wait(client.graphql_requests_partial(*queries))
+        self.assertEqual(results, {0: {'id': 0}, 2: {'id': 2}, 3: {'id': 3}, 4: {'id': 4}})
+        self.assertEqual(list(errors), [1])
+
+    def test_batcher(self):
+        client = self.client(lambda method, url, payload: ''.join(graphql_response(payload)), graphql_batch_window=0.05)
+
+        async def request_all():
+            return await asyncio.gather(*[client.graphql_request(GraphQL(doc_id='1', params={'id': i})) for i in range(-1, 5)], return_exceptions=True)
+
+        results = self.wait(request_all())
+        # The queries are sent in one request, and a failed query doesn't fail the others
+        self.assertEqual(self.requests, [ReqUrl.GRAPHQL])
+        self.assertIsInstance(results[0], FBchatException)
+        self.assertEqual(results[1:], [{'id': i} for i in range(5)])
+        self.assertEqual((client.graphql_batcher.queries, client.graphql_batcher.batches), (6, 1))
+
+    def test_iter_graphql_requests(self):
+        client = self.client(lambda method, url, payload: graphql_response(payload))
+        queries = [GraphQL(doc_id='1', params={'id': i}) for i in range(3)]
+
+        async def read_all():
+            results = []
+            async with client.iter_graphql_requests(*queries) as iterator:
+                async for result in iterator:
+                    results.append(result)
+            return results
+
+        self.assertEqual(self.wait(read_all()), [(i, {'id': i}) for i in range(3)])
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='iter_graphql_requests'), 1)
+
+    def test_iter_graphql_requests_close(self):
+        client = self.client(lambda method, url, payload: graphql_response(payload) if len(json.loads(payload['queries'])) > 1 else ''.join(graphql_response(payload)))
+        # With a single connection, later requests would wait forever if the connection wasn't released
+        client.pool_sizes = {urlparse(str(self.server.make_url('/'))).netloc: 1}
+        self.streaming.clear()
+        queries = [GraphQL(doc_id='1', params={'id': i}) for i in range(3)]
+
+        async def stop_early():
+            iterator = client.iter_graphql_requests(*queries)
+            first = await iterator.__anext__()
+            await iterator.aclose()
+            with self.assertRaises(StopAsyncIteration):
+                await iterator.__anext__()
+            async with client.iter_graphql_requests(*queries) as iterator:
+                async for result in iterator:
+                    break
+            return first, await client.graphql_requests(queries[2])
+
+        self.assertEqual(self.wait(asyncio.wait_for(stop_early(), 5)), ((0, {'id': 0}), ({'id': 2},)))
+
+    def test_send_relogin(self):
+        message_ids = []
+
+        def respond(method, url, payload):
+            if payload['fb_dtsg'] == '1':
+                # The session from the first login has expired
+                return 'for (;;);{"error":1357004,"errorDescription":"Please try closing and re-opening your browser window."}'
+            message_ids.append(payload['offline_threading_id'])
+            return 'for (;;);' + json.dumps({'payload': {'actions': [{'message_id': 'mid.$' + payload['offline_threading_id']}]}})
+
+        client = self.client(respond)
+
+        async def send_all():
+            return await asyncio.gather(*[client.send(Message(text='test_send_relogin_{}'.format(i)), thread_id='2') for i in range(10)])
+
+        results = self.wait(send_all())
+        self.assertEqual(len(set(results)), 10)
+        self.assertEqual(len(message_ids), 10)
+        # The session is refreshed once, even though every send failed with it
+        self.assertEqual(client._session.logins, 2)
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='send'), 20)
+
+    def test_post_file(self):
+        client = self.client(lambda method, url, payload: 'for (;;);{"payload":{}}')
+        self.assertEqual(self.wait(client._postFile(ReqUrl.UPLOAD, fix_request=True, as_json=True)), {'payload': {}})
+        self.assertEqual(self.requests, [ReqUrl.UPLOAD])
+
+    def test_listen_labels(self):
+        def respond(method, url, payload):
+            if url == ReqUrl.STICKY and 'channel' in payload:
+                return 'for (;;);{"lb_info":{"sticky":"1","pool":"2"}}'
+            if url == ReqUrl.STICKY:
+                return 'for (;;);' + json.dumps({'seq': 1, 'ms': [{'type': 'delta', 'delta': {
+                    'class': 'NewMessage',
+                    'body': 'ping',
+                    'messageMetadata': {'messageId': 'mid.$1', 'actorFbId': '2', 'timestamp': '1', 'threadKey': {'otherUserFbId': '2'}, 'tags': ['hot_emoji_size:small']},
+                }}]})
+            if url == ReqUrl.SEND:
+                return 'for (;;);{"payload":{"actions":[{"message_id":"mid.$2"}]}}'
+
+        class EchoClient(AsyncOfflineClient):
+            def onMessage(self, message_object=None, thread_id=None, thread_type=None, **kwargs):
+                self.reply = asyncio.ensure_future(self.send(Message(text=message_object.text), thread_id=thread_id, thread_type=thread_type))
+                self.listening = False
+
+        client = self.client(respond, cls=EchoClient)
+        self.wait(client.listen(markAlive=False))
+        self.assertEqual(self.wait(client.reply), 'mid.$2')
+        # The task started from the callback is labeled by the method it calls, instead of `listen`
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='send'), 1)
+        self.assertEqual(client.metrics.get('fbchat_requests_total', method='listen'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()